@@ -0,0 +1,41 @@
+"""Times gibbs.sample_discrete_log with the exact and the fast sampler, for
+a range of group counts
+
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from microscopes.common.rng import rng
+from microscopes.kernels import gibbs
+
+
+def measure(scores, sampler, ndraws, r):
+    start = time.time()
+    gibbs.sample_discrete_log(scores, r, size=ndraws, sampler=sampler)
+    return (time.time() - start) / ndraws
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--groups', type=int, action='append')
+    parser.add_argument('--draws', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    groups = args.groups or [10, 100, 1000]
+    r = rng(args.seed)
+    print '{:>8} {:>14} {:>14} {:>8}'.format(
+        'groups', 'exact (us)', 'fast (us)', 'speedup')
+    for k in groups:
+        scores = np.random.normal(scale=10., size=k)
+        exact = measure(scores, 'exact', args.draws, r)
+        fast = measure(scores, 'fast', args.draws, r)
+        print '{:>8} {:>14.3f} {:>14.3f} {:>8.2f}'.format(
+            k, exact * 1e6, fast * 1e6, exact / fast)
+
+
+if __name__ == '__main__':
+    main()
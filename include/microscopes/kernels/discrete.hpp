@@ -0,0 +1,90 @@
+#pragma once
+
+#include <microscopes/common/random_fwd.hpp>
+#include <microscopes/common/util.hpp>
+#include <microscopes/common/assert.hpp>
+
+#include <distributions/random.hpp>
+
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <cstring>
+#include <limits>
+#include <vector>
+
+namespace microscopes {
+namespace kernels {
+
+// categorical sampling from unnormalized log probabilities, as done once per
+// entity visit by the assignment kernels
+struct discrete {
+
+  enum method_t {
+    EXACT, // common::util::sample_discrete_log
+    FAST,  // fast_exp(), in a single pass over the scores
+  };
+
+  // exp(x), to within ~1e-5 relative error, for the x <= 0 arising from
+  // scores shifted by their max. x is split as x*log2(e) = n + f with
+  // |f| <= 1/2, and 2^f is a degree 5 polynomial. 2^n is added to the
+  // exponent bits in unsigned arithmetic, as n < 0
+  static inline float
+  fast_exp(float x)
+  {
+    if (!(x >= -87.f)) // exp(x) underflows below here (or x is nan)
+      return 0.;
+    const float t = x * 1.44269504088896341f;
+    const float n = std::floor(t + 0.5f);
+    const float f = t - n;
+    const float p =
+      1.f + f*(0.693147182f +
+      f*(0.240226507f +
+      f*(0.0555041087f +
+      f*(0.00961812911f +
+      f*0.00133335581f))));
+    uint32_t bits;
+    std::memcpy(&bits, &p, sizeof(bits));
+    bits += static_cast<uint32_t>(static_cast<int32_t>(n)) << 23;
+    float ret;
+    std::memcpy(&ret, &bits, sizeof(ret));
+    return ret;
+  }
+
+  // samples an index of scores. FAST overwrites scores with the
+  // (unnormalized) probabilities
+  static inline size_t
+  sample_log(std::vector<float> &scores, common::rng_t &rng, method_t method)
+  {
+    if (method == EXACT)
+      return common::util::sample_discrete_log(scores, rng);
+
+    const size_t n = scores.size();
+    MICROSCOPES_DCHECK(n > 0, "no scores");
+    float m = -std::numeric_limits<float>::infinity();
+    for (size_t i = 0; i < n; i++)
+      m = std::max(m, scores[i]);
+    if (m == -std::numeric_limits<float>::infinity()) {
+      // all the scores are -inf: shifting by m would give nans, and every
+      // index is as likely as the others
+      std::fill(scores.begin(), scores.end(), 1.f);
+      const size_t i = distributions::sample_unif01(rng) * n;
+      return std::min(i, n - 1);
+    }
+    float sum = 0.;
+    for (size_t i = 0; i < n; i++) {
+      scores[i] = fast_exp(scores[i] - m);
+      sum += scores[i];
+    }
+    float u = distributions::sample_unif01(rng) * sum;
+    for (size_t i = 0; i < n - 1; i++) {
+      if (u < scores[i])
+        return i;
+      u -= scores[i];
+    }
+    return n - 1;
+  }
+};
+
+} // namespace kernels
+} // namespace microscopes
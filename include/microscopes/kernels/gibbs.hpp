@@ -4,9 +4,13 @@
 #include <microscopes/common/entity_state.hpp>
 #include <microscopes/common/assert.hpp>
 #include <microscopes/common/util.hpp>
+#include <microscopes/kernels/discrete.hpp>
+#include <microscopes/kernels/stats.hpp>
 
+#include <map>
 #include <vector>
 #include <utility>
+#include <cstdint>
 
 namespace microscopes {
 namespace kernels {
@@ -14,20 +18,194 @@ namespace kernels {
 struct gibbs {
     typedef std::vector<std::pair<const models::hypers *, float>> grid_t;
 
+    // memoizes score_likelihood(fid) for every point of a feature's grid.
+    // the cached scores of a feature are keyed on the state (by address),
+    // the grid itself and a fingerprint of the assignment vector (the
+    // suffstats version), and are reused by hp() until any of them changes.
+    //
+    // this is only valid for features whose likelihood is a deterministic
+    // function of the hypers and the assignment (e.g. conjugate features).
+    // call invalidate() after changing a feature's suffstats by other means.
+    struct hp_memo_t {
+      struct table_t {
+        table_t()
+          : state_(), version_(), last_used_(), grid_(), valid_(), scores_()
+        {}
+        const common::entity_based_state_object *state_;
+        uint64_t version_;
+        size_t last_used_;
+        std::vector<const models::hypers *> grid_;
+        std::vector<char> valid_;
+        std::vector<float> scores_;
+      };
+
+      hp_memo_t() : capacity_(), tick_(), hits_(), misses_(), tables_() {}
+      explicit hp_memo_t(size_t capacity)
+        : capacity_(capacity), tick_(), hits_(), misses_(), tables_() {}
+
+      inline void invalidate() { tables_.clear(); }
+      inline void invalidate(size_t fid) { tables_.erase(fid); }
+
+      // the number of cached scores
+      size_t size() const;
+
+      size_t capacity_; // upper bound on size()
+      size_t tick_;
+      size_t hits_;
+      size_t misses_;
+      std::map<size_t, table_t> tables_; // feature id -> table
+    };
+
+    // how the pooled assignment kernels keep their recycled empty groups
+    // valid
+    enum pool_t {
+      UNPOOLED,
+      // the model is collapsed: every empty group scores the same, so there
+      // is nothing to redraw
+      POOL_COLLAPSED,
+      // the state implements group_redraw_t: the parameters of every
+      // recycled empty group are redrawn from the base measure, in place,
+      // for each entity
+      POOL_REDRAW,
+    };
+
+    // implemented by states whose groups carry parameters drawn from the
+    // base measure G_0 (non-collapsed models), for POOL_REDRAW
+    class group_redraw_t {
+    public:
+      virtual ~group_redraw_t() {}
+      // redraws the parameters of the empty group gid from G_0
+      virtual void redraw_group(size_t gid, common::rng_t &rng) = 0;
+    };
+
+    // counts of the proposals made by split_merge()
+    struct split_merge_stats_t {
+      split_merge_stats_t()
+        : nsplits_(), nsplits_accepted_(), nmerges_(), nmerges_accepted_() {}
+      size_t nsplits_;
+      size_t nsplits_accepted_;
+      size_t nmerges_;
+      size_t nmerges_accepted_;
+    };
+
+    // each kernel runs `niters` full sweeps before returning. if stats is
+    // not null, the time spent in each phase is accumulated into it
+    //
+    // with pooled set, the assignment kernels recycle empty groups from one
+    // entity to the next, instead of deleting them and creating new ones.
+    // this leaves the stationary distribution unchanged for collapsed
+    // models (POOL_COLLAPSED, the caller's declaration), and for states
+    // which redraw the recycled groups from G_0 (POOL_REDRAW, which raises
+    // if the state does not implement group_redraw_t)
+    //
+    // sampler picks how each entity's new group is drawn from its scores
+    // (see discrete::method_t)
+
+    static void
+    assign(common::entity_based_state_object &state,
+           common::rng_t &rng,
+           size_t niters=1,
+           kernel_stats_t *stats=nullptr,
+           pool_t pooled=UNPOOLED,
+           discrete::method_t sampler=discrete::EXACT);
+
+    static void
+    assign_resample(common::entity_based_state_object &state,
+                    size_t m,
+                    common::rng_t &rng,
+                    size_t niters=1,
+                    kernel_stats_t *stats=nullptr,
+                    pool_t pooled=UNPOOLED,
+                    discrete::method_t sampler=discrete::EXACT);
+
+    // partial sweeps, for incremental inference on a growing dataset: each
+    // sweep visits the n entities of eids, plus round(fraction * #) of the
+    // other entities (drawn anew for every sweep), in a random order.
+    // unassigned entities are added to the state rather than moved
+    static void
+    assign_subset(common::entity_based_state_object &state,
+                  const size_t *eids,
+                  size_t n,
+                  float fraction,
+                  common::rng_t &rng,
+                  size_t niters=1,
+                  kernel_stats_t *stats=nullptr,
+                  pool_t pooled=UNPOOLED,
+                  discrete::method_t sampler=discrete::EXACT);
+
+    // an approximate, data-parallel version of assign_resample, in the
+    // style of AD-LDA: the entities are visited in blocks of nthreads *
+    // sync. a block is removed from the state, and then each thread scores
+    // and samples its sync entities against what is left (so within a
+    // block, the entities do not see each other's moves). at the end of the
+    // block, the entities which picked an occupied group are added back,
+    // and the ones which picked an empty group are resampled one at a time,
+    // so that new clusters are not formed blindly. requires the state to
+    // support concurrent inplace_score_value() calls. the result is
+    // reproducible for a fixed seed, nthreads and sync. with sync = 0, a
+    // block holds about 1% of the entities; larger sync intervals scale
+    // better and drift further from an exact sweep. with nthreads = 1, the
+    // sweeps are exact (as in assign_resample)
+    static void
+    assign_parallel(common::entity_based_state_object &state,
+                    size_t m,
+                    common::rng_t &rng,
+                    size_t nthreads,
+                    size_t sync,
+                    size_t niters=1,
+                    kernel_stats_t *stats=nullptr,
+                    discrete::method_t sampler=discrete::EXACT);
+
+    // the restricted gibbs split-merge sampler of:
+    //   A Split-Merge Markov Chain Monte Carlo Procedure for the Dirichlet
+    //   Process Mixture Model
+    //   Sonia Jain, Radford Neal
+    //   Journal of Computational and Graphical Statistics, 2004
+    // makes nmoves proposals, each launched with nscans intermediate
+    // restricted gibbs scans. the target is score_assignment() plus the
+    // score_likelihood() of every component, so this is only valid for
+    // collapsed models
     static void
-    assign(common::entity_based_state_object &state, common::rng_t &rng);
+    split_merge(common::entity_based_state_object &state,
+                common::rng_t &rng,
+                size_t nmoves=1,
+                size_t nscans=5,
+                split_merge_stats_t *acceptance=nullptr,
+                kernel_stats_t *stats=nullptr);
 
     static void
-    assign_resample(common::entity_based_state_object &state, size_t m, common::rng_t &rng);
+    assign_resample_subset(common::entity_based_state_object &state,
+                           size_t m,
+                           const size_t *eids,
+                           size_t n,
+                           float fraction,
+                           common::rng_t &rng,
+                           size_t niters=1,
+                           kernel_stats_t *stats=nullptr,
+                           pool_t pooled=UNPOOLED,
+                           discrete::method_t sampler=discrete::EXACT);
 
+    // with nthreads > 1, the features are split into nthreads contiguous
+    // chunks, each sampled on its own thread with its own rng stream
+    // (seeded from rng). the result is reproducible for a fixed seed and
+    // nthreads. requires the state to support concurrent hp updates and
+    // likelihood evaluations on distinct features.
+    //
+    // if memo is not null, the likelihood scores are looked up in (and
+    // saved to) the memo
     static void
     hp(common::entity_based_state_object &state,
        const std::vector<std::pair<size_t, grid_t>> &params,
-       common::rng_t &rng);
+       common::rng_t &rng,
+       size_t niters=1,
+       size_t nthreads=1,
+       hp_memo_t *memo=nullptr,
+       kernel_stats_t *stats=nullptr);
 
     static void
     perftest(common::entity_based_state_object &state,
-             common::rng_t &rng);
+             common::rng_t &rng,
+             discrete::method_t sampler=discrete::EXACT);
 };
 
 } // namespace kernels
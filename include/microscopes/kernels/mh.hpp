@@ -0,0 +1,187 @@
+#pragma once
+
+#include <microscopes/common/random_fwd.hpp>
+#include <microscopes/common/scalar_functions.hpp>
+#include <microscopes/common/entity_state.hpp>
+#include <microscopes/common/assert.hpp>
+#include <microscopes/kernels/stats.hpp>
+
+#include <distributions/random.hpp>
+
+#include <cmath>
+#include <random>
+#include <string>
+#include <vector>
+
+namespace microscopes {
+namespace kernels {
+
+struct mh {
+
+  // runs nsteps of random walk metropolis on scorefn (an unnormalized log
+  // density), with gaussian proposals of standard deviation sigma. since
+  // the proposal is symmetric, there is no proposal correction. the number
+  // of accepted proposals is added to naccepted
+  template <typename T>
+  static inline float
+  sample(T scorefn,
+         float x0,
+         float sigma,
+         common::rng_t &rng,
+         size_t nsteps,
+         size_t &naccepted)
+  {
+    std::normal_distribution<float> noise(0., sigma);
+    float x = x0;
+    float fx = scorefn(x);
+    for (size_t i = 0; i < nsteps; i++) {
+      const float xprop = x + noise(rng);
+      const float fprop = scorefn(xprop);
+      const float lg_alpha = fprop - fx;
+      if (lg_alpha >= 0. ||
+          logf(distributions::sample_unif01(rng)) <= lg_alpha) {
+        x = xprop;
+        fx = fprop;
+        naccepted++;
+      }
+    }
+    return x;
+  }
+
+  // helper for cython
+  static inline float
+  sample_1d(common::scalar_fn scorefn,
+            float x0,
+            float sigma,
+            common::rng_t &rng,
+            size_t nsteps,
+            size_t &naccepted)
+  {
+    MICROSCOPES_DCHECK(scorefn.input_dim() == 1,
+        "not a scalar 1d function");
+    return sample([&scorefn](float x) { return scorefn({x}); },
+                  x0, sigma, rng, nsteps, naccepted);
+  }
+
+  struct mh_stats_t {
+    mh_stats_t() : nproposals_(), naccepted_() {}
+    size_t nproposals_;
+    size_t naccepted_;
+  };
+
+  // for the first nadapt proposals of a param, sigma is adapted by a
+  // robbins-monro step on log(sigma) toward the acceptance rate target.
+  // returns the new sigma
+  static inline float
+  adapt(float sigma,
+        const mh_stats_t &stats,
+        size_t nadapt,
+        float target,
+        bool accepted)
+  {
+    if (stats.nproposals_ > nadapt)
+      return sigma;
+    const float gain = 1. / powf(float(stats.nproposals_), 0.6);
+    return sigma * expf(gain * ((accepted ? 1.f : 0.f) - target));
+  }
+
+  struct mh_update_param_t {
+    mh_update_param_t() : key_(), index_() {}
+    mh_update_param_t(const std::string &key, size_t index)
+      : key_(key), index_(index) {}
+
+    std::string key_;
+    size_t index_;
+  };
+
+  // all the updates of a param are proposed together, each moved by an
+  // independent N(0, sigma^2)
+  struct mh_hp_param_t {
+    mh_hp_param_t()
+      : updates_(), prior_(), sigma_(), nadapt_(), target_(), stats_() {}
+    mh_hp_param_t(
+        const std::vector<mh_update_param_t> &updates,
+        common::scalar_fn prior,
+        float sigma,
+        size_t nadapt=0,
+        float target=0.44)
+      : updates_(updates),
+        prior_(prior),
+        sigma_(sigma),
+        nadapt_(nadapt),
+        target_(target),
+        stats_()
+    {
+      MICROSCOPES_DCHECK(updates.size() == prior_.input_dim(),
+          "# args mismatch");
+    }
+
+    std::vector<mh_update_param_t> updates_;
+    common::scalar_fn prior_;
+    mutable float sigma_; // adapted by the kernels
+    size_t nadapt_;
+    float target_;
+    mutable mh_stats_t stats_;
+  };
+
+  struct mh_hp_t {
+    mh_hp_t() : index_(), params_() {}
+    mh_hp_t(
+        size_t index,
+        const std::vector<mh_hp_param_t> &params)
+      : index_(index), params_(params) {}
+    size_t index_; // the feature ID
+    std::vector<mh_hp_param_t> params_;
+  };
+
+  struct mh_theta_param_t {
+    mh_theta_param_t()
+      : key_(), sigma_(), nadapt_(), target_(), stats_() {}
+    mh_theta_param_t(
+        const std::string &key,
+        float sigma,
+        size_t nadapt=0,
+        float target=0.44)
+      : key_(key), sigma_(sigma), nadapt_(nadapt), target_(target), stats_() {}
+
+    std::string key_;
+    mutable float sigma_; // adapted by the kernels
+    size_t nadapt_;
+    float target_;
+    mutable mh_stats_t stats_;
+  };
+
+  struct mh_theta_t {
+    mh_theta_t() : index_(), params_() {}
+    mh_theta_t(
+        size_t index,
+        const std::vector<mh_theta_param_t> &params)
+      : index_(index), params_(params) {}
+
+    size_t index_;
+    std::vector<mh_theta_param_t> params_;
+  };
+
+  // the counterparts of slice::hp and slice::theta. the model score at the
+  // current point is cached, so each step costs one likelihood evaluation
+  // (counted in stats->score_evals_, if stats is not null), and proposals
+  // outside the support of the prior cost none
+
+  static void
+  hp(common::entity_based_state_object &state,
+     const std::vector<mh_hp_param_t> &cparams,
+     const std::vector<mh_hp_t> &hparams,
+     common::rng_t &rng,
+     size_t niters=1,
+     kernel_stats_t *stats=nullptr);
+
+  static void
+  theta(common::entity_based_state_object &state,
+        const std::vector<mh_theta_t> &tparams,
+        common::rng_t &rng,
+        size_t niters=1,
+        kernel_stats_t *stats=nullptr);
+};
+
+} // namespace kernels
+} // namespace microscopes
@@ -0,0 +1,78 @@
+#pragma once
+
+#include <microscopes/kernels/gibbs.hpp>
+#include <microscopes/kernels/slice.hpp>
+#include <microscopes/common/random_fwd.hpp>
+#include <microscopes/common/entity_state.hpp>
+
+#include <vector>
+#include <utility>
+
+namespace microscopes {
+namespace kernels {
+
+// A fixed sequence of kernels, each run every `every_` sweeps. The kernel
+// parameters are resolved once (when the entries are built), so running the
+// schedule for many sweeps never goes back to python.
+class schedule {
+public:
+  enum kernel_t {
+    ASSIGN,
+    ASSIGN_RESAMPLE,
+    GIBBS_HP,
+    SLICE_HP,
+    SLICE_THETA,
+  };
+
+  struct entry_t {
+    entry_t()
+      : kernel_(), every_(1), m_(),
+        grid_(), cparams_(), hparams_(), tparams_(),
+        ncalls_(), seconds_() {}
+
+    kernel_t kernel_;
+    size_t every_;
+
+    // ASSIGN_RESAMPLE
+    size_t m_;
+
+    // GIBBS_HP
+    std::vector<std::pair<size_t, gibbs::grid_t>> grid_;
+
+    // SLICE_HP
+    std::vector<slice::slice_hp_param_t> cparams_;
+    std::vector<slice::slice_hp_t> hparams_;
+
+    // SLICE_THETA
+    std::vector<slice::slice_theta_t> tparams_;
+
+    // accumulated by run()
+    size_t ncalls_;
+    double seconds_;
+  };
+
+  schedule() : entries_(), nsweeps_() {}
+
+  inline void add(const entry_t &entry) { entries_.push_back(entry); }
+
+  inline const std::vector<entry_t> & entries() const { return entries_; }
+
+  inline entry_t & entry(size_t i) { return entries_[i]; }
+
+  inline size_t nsweeps() const { return nsweeps_; }
+
+  // the sweep count carries over between calls, so an entry run every k
+  // sweeps keeps its cadence no matter how the sweeps are batched
+  void run(common::entity_based_state_object &state,
+           common::rng_t &rng,
+           size_t niters);
+
+  void reset_timings();
+
+private:
+  std::vector<entry_t> entries_;
+  size_t nsweeps_;
+};
+
+} // namespace kernels
+} // namespace microscopes
@@ -4,6 +4,7 @@
 #include <microscopes/common/typedefs.hpp>
 #include <microscopes/common/scalar_functions.hpp>
 #include <microscopes/common/entity_state.hpp>
+#include <microscopes/kernels/stats.hpp>
 
 #include <distributions/random.hpp>
 
@@ -18,9 +19,16 @@ namespace kernels {
 
 struct slice {
 
+  // the procedure used to find the interval around the current point
+  enum interval_t {
+    STEPPING_OUT,
+    DOUBLING,
+  };
+
   template <typename T>
   static inline std::pair<float, float>
-  interval(T fn, float x0, float y, float w, common::rng_t &rng, unsigned m)
+  interval(T fn, float x0, float y, float w, common::rng_t &rng, unsigned m,
+           kernel_stats_t *stats=nullptr)
   {
     const float U = distributions::sample_unif01(rng);
     float L = x0 - w*U;
@@ -42,6 +50,12 @@ struct slice {
       K0--;
     }
 
+    if (stats) {
+      stats->stepping_out_ += (J - J0) + (K - K0);
+      if ((!J0 && J) || (!K0 && K))
+        stats->max_iters_++;
+    }
+
     //if ((!J0 && J) || (!K0 && K)) {
     //  std::cout << "WARNING: slice::interval hit maximum # of expansions" << std::endl
     //            << "  Left expansions: " << J0 << ", Right expansions: " << K0 << std::endl
@@ -53,25 +67,97 @@ struct slice {
     return std::make_pair(L, R);
   }
 
+  // the doubling procedure of fig. 4 in:
+  //   Slice Sampling
+  //   Radford Neal
+  //   The Annals of Statistics, 2003
+  // the interval is doubled at most p times
+  template <typename T>
+  static inline std::pair<float, float>
+  doubling(T fn, float x0, float y, float w, common::rng_t &rng, unsigned p,
+           kernel_stats_t *stats=nullptr)
+  {
+    const float U = distributions::sample_unif01(rng);
+    float L = x0 - w*U;
+    float R = L + w;
+    float fL = fn(L);
+    float fR = fn(R);
+    while (p > 0 && (y < fL || y < fR)) {
+      const float V = distributions::sample_unif01(rng);
+      if (V < 0.5) {
+        L -= R - L;
+        fL = fn(L);
+      } else {
+        R += R - L;
+        fR = fn(R);
+      }
+      p--;
+      if (stats)
+        stats->stepping_out_++;
+    }
+    if (stats && !p && (y < fL || y < fR))
+      stats->max_iters_++;
+    return std::make_pair(L, R);
+  }
+
+  // the acceptance test of fig. 6 in Neal (2003): x1 is only a valid draw
+  // if the doubling procedure could have produced [L, R] starting from x1
+  template <typename T>
+  static inline bool
+  doubling_accept(T fn, float x0, float x1, float y, float w, float L, float R)
+  {
+    bool D = false;
+    while (R - L > 1.1*w) {
+      const float M = (L + R) / 2.;
+      if ((x0 < M && x1 >= M) || (x0 >= M && x1 < M))
+        D = true;
+      if (x1 < M)
+        R = M;
+      else
+        L = M;
+      if (D && y >= fn(L) && y >= fn(R))
+        return false;
+    }
+    return true;
+  }
+
   template <typename T>
   static inline float
   shrink(T fn, float x0, float y, float L, float R, common::rng_t &rng, unsigned ntries)
   {
+    return shrink_bracket(fn, x0, y, L, R, rng, ntries, 0.);
+  }
+
+  // shrinks [L, R] in place, until a point in the slice is found. a
+  // positive w means [L, R] came from doubling() with that w, in which case
+  // the point must also pass doubling_accept()
+  template <typename T>
+  static inline float
+  shrink_bracket(T fn, float x0, float y, float &L, float &R, common::rng_t &rng, unsigned ntries, float w,
+                 kernel_stats_t *stats=nullptr)
+  {
+    const float L0 = L;
+    const float R0 = R;
     float x1 = 0.0;
     while (ntries) {
       const float U = distributions::sample_unif01(rng);
       x1 = L + U*(R-L);
-      if (y < fn(x1))
+      if (y < fn(x1) &&
+          (w <= 0. || doubling_accept(fn, x0, x1, y, w, L0, R0)))
         break;
       if (x1 < x0)
         L = x1;
       else
         R = x1;
       ntries--;
+      if (stats)
+        stats->shrinks_++;
     }
 
-    if (!ntries)
-      std::cout << "WARNING: slice::shrink hit maximum # of iterations" << std::endl;
+    if (!ntries) {
+      if (stats)
+        stats->max_iters_++;
+    }
 
     //std::cout << "slice::shrink():" << std::endl
     //          << "  x0=" << x0 << ", y=" << y << ", L=" << L << ", R=" << R << std::endl
@@ -90,6 +176,98 @@ struct slice {
     return shrink(scorefn, x0, y, p.first, p.second, rng, ntries);
   }
 
+  // like sample(), but with a choice of interval procedure. on return,
+  // width is the width of the final bracket, and nevals has been
+  // incremented by the number of evaluations of scorefn (as has stats, if
+  // not null)
+  template <typename T>
+  static inline float
+  draw(T &scorefn,
+       float x0,
+       float w,
+       interval_t procedure,
+       common::rng_t &rng,
+       float &width,
+       size_t &nevals,
+       unsigned m=10000,
+       unsigned ntries=100,
+       kernel_stats_t *stats=nullptr)
+  {
+    const size_t nevals0 = nevals;
+    auto fn = [&scorefn, &nevals](float x) { nevals++; return scorefn(x); };
+    const float y = logf(distributions::sample_unif01(rng)) + fn(x0);
+    const auto p = (procedure == DOUBLING) ?
+      doubling(fn, x0, y, w, rng, 20, stats) :
+      interval(fn, x0, y, w, rng, m, stats);
+    float L = p.first;
+    float R = p.second;
+    const float x1 = shrink_bracket(
+        fn, x0, y, L, R, rng, ntries, (procedure == DOUBLING) ? w : 0., stats);
+    width = R - L;
+    if (stats)
+      stats->score_evals_ += nevals - nevals0;
+    return x1;
+  }
+
+  // the hyperrectangle procedure of sec. 5.1 in Neal (2003): moves every
+  // coordinate of x at once (in place). the initial rectangle has side w
+  // along each coordinate, and is shrunk towards the current point on each
+  // rejection (there is no stepping out). on return, width is the mean side
+  // of the final rectangle, and nevals has been incremented by the number of
+  // evaluations of scorefn
+  template <typename T>
+  static inline void
+  draw_hyperrect(T &scorefn,
+                 std::vector<float> &x,
+                 float w,
+                 common::rng_t &rng,
+                 float &width,
+                 size_t &nevals,
+                 unsigned ntries=100,
+                 kernel_stats_t *stats=nullptr)
+  {
+    const size_t n = x.size();
+    const size_t nevals0 = nevals;
+    const std::vector<float> x0(x);
+    nevals++;
+    const float y = logf(distributions::sample_unif01(rng)) + scorefn(x0);
+    std::vector<float> L(n), R(n);
+    for (size_t i = 0; i < n; i++) {
+      L[i] = x0[i] - w*distributions::sample_unif01(rng);
+      R[i] = L[i] + w;
+    }
+    while (ntries) {
+      for (size_t i = 0; i < n; i++)
+        x[i] = L[i] + distributions::sample_unif01(rng)*(R[i]-L[i]);
+      nevals++;
+      if (y < scorefn(x))
+        break;
+      for (size_t i = 0; i < n; i++) {
+        if (x[i] < x0[i])
+          L[i] = x[i];
+        else
+          R[i] = x[i];
+      }
+      ntries--;
+      if (stats)
+        stats->shrinks_++;
+    }
+
+    if (!ntries) {
+      x = x0;
+      if (stats)
+        stats->max_iters_++;
+    }
+
+    if (stats)
+      stats->score_evals_ += nevals - nevals0;
+
+    width = 0.;
+    for (size_t i = 0; i < n; i++)
+      width += R[i] - L[i];
+    width /= n;
+  }
+
   // helper for cython
   static inline float
   sample_1d(common::scalar_fn scorefn,
@@ -97,11 +275,63 @@ struct slice {
             float w,
             common::rng_t &rng,
             unsigned m=10000,
-            unsigned ntries=100)
+            unsigned ntries=100,
+            interval_t procedure=STEPPING_OUT)
   {
     MICROSCOPES_DCHECK(scorefn.input_dim() == 1,
         "not a scalar 1d function");
-    return sample([&scorefn](float x) { return scorefn({x}); }, x0, w, rng, m, ntries);
+    auto fn = [&scorefn](float x) { return scorefn({x}); };
+    if (procedure == STEPPING_OUT)
+      return sample(fn, x0, w, rng, m, ntries);
+    float width = 0.;
+    size_t nevals = 0;
+    return draw(fn, x0, w, procedure, rng, width, nevals, m, ntries);
+  }
+
+  // bookkeeping for the draws of a single parameter. if the parameter has
+  // nadapt_ > 0 (and is not moved jointly), its step width is set to the
+  // mean width of the final brackets of its first nadapt_ draws (and frozen
+  // afterwards)
+  struct draw_stats_t {
+    draw_stats_t() : ndraws_(), nevals_(), nadapted_(), width_sum_() {}
+    size_t ndraws_;
+    size_t nevals_;
+    size_t nadapted_;
+    double width_sum_;
+  };
+
+  // draws the next value of a parameter P (a slice_hp_param_t or a
+  // slice_theta_param_t), adapting its step width
+  template <typename T, typename P>
+  static inline float
+  draw_param(T &scorefn, float x0, const P &p, common::rng_t &rng,
+             kernel_stats_t *stats=nullptr)
+  {
+    float width = 0.;
+    const float x1 = draw(
+        scorefn, x0, p.w_, p.interval_, rng, width, p.stats_.nevals_,
+        10000, 100, stats);
+    p.stats_.ndraws_++;
+    if (p.stats_.ndraws_ <= p.nadapt_ && width > 0. && std::isfinite(width)) {
+      p.stats_.nadapted_++;
+      p.stats_.width_sum_ += width;
+      p.w_ = p.stats_.width_sum_ / p.stats_.nadapted_;
+    }
+    return x1;
+  }
+
+  // like draw_param(), but moves all the coordinates x of a joint parameter
+  // P at once. the step width is not adapted: the hyperrectangle never
+  // steps out, so its final width is at most w_, and averaging those could
+  // only ever shrink w_
+  template <typename T, typename P>
+  static inline void
+  draw_joint_param(T &scorefn, std::vector<float> &x, const P &p, common::rng_t &rng,
+                   kernel_stats_t *stats=nullptr)
+  {
+    float width = 0.;
+    draw_hyperrect(scorefn, x, p.w_, rng, width, p.stats_.nevals_, 100, stats);
+    p.stats_.ndraws_++;
   }
 
   struct slice_update_param_t {
@@ -113,15 +343,26 @@ struct slice {
     size_t index_;
   };
 
+  // with joint_ set, the updates of a param are moved together by a
+  // hyperrectangle draw (which ignores interval_), rather than one
+  // coordinate at a time
   struct slice_hp_param_t {
-    slice_hp_param_t() : updates_(), prior_(), w_() {}
+    slice_hp_param_t()
+      : updates_(), prior_(), w_(), interval_(), nadapt_(), joint_(), stats_() {}
     slice_hp_param_t(
         const std::vector<slice_update_param_t> &updates,
         common::scalar_fn prior,
-        float w)
+        float w,
+        interval_t interval=STEPPING_OUT,
+        size_t nadapt=0,
+        bool joint=false)
       : updates_(updates),
         prior_(prior),
-        w_(w)
+        w_(w),
+        interval_(interval),
+        nadapt_(nadapt),
+        joint_(joint),
+        stats_()
     {
       MICROSCOPES_DCHECK(updates.size() == prior_.input_dim(),
           "# args mismatch");
@@ -129,7 +370,11 @@ struct slice {
 
     std::vector<slice_update_param_t> updates_;
     common::scalar_fn prior_;
-    float w_;
+    mutable float w_; // adapted by draw_param()
+    interval_t interval_;
+    size_t nadapt_;
+    bool joint_;
+    mutable draw_stats_t stats_;
   };
 
   struct slice_hp_t {
@@ -143,12 +388,20 @@ struct slice {
   };
 
   struct slice_theta_param_t {
-    slice_theta_param_t() : key_(), w_() {}
-    slice_theta_param_t(const std::string &key, float w)
-      : key_(key), w_(w) {}
+    slice_theta_param_t()
+      : key_(), w_(), interval_(), nadapt_(), stats_() {}
+    slice_theta_param_t(
+        const std::string &key,
+        float w,
+        interval_t interval=STEPPING_OUT,
+        size_t nadapt=0)
+      : key_(key), w_(w), interval_(interval), nadapt_(nadapt), stats_() {}
 
     std::string key_;
-    float w_;
+    mutable float w_; // adapted by draw_param()
+    interval_t interval_;
+    size_t nadapt_;
+    mutable draw_stats_t stats_;
   };
 
   struct slice_theta_t {
@@ -162,16 +415,27 @@ struct slice {
     std::vector<slice_theta_param_t> params_;
   };
 
+  // both kernels run `niters` full sweeps before returning. theta can split
+  // the groups across `nthreads` threads, each with its own rng stream
+  // seeded from rng (so the result depends on the seed and nthreads). if
+  // stats is not null, the evaluation and iteration counts of the draws are
+  // accumulated into it
+
   static void
   hp(common::entity_based_state_object &state,
      const std::vector<slice_hp_param_t> &cparams,
      const std::vector<slice_hp_t> &hparams,
-     common::rng_t &rng);
+     common::rng_t &rng,
+     size_t niters=1,
+     kernel_stats_t *stats=nullptr);
 
   static void
   theta(common::entity_based_state_object &state,
         const std::vector<slice_theta_t> &tparams,
-        common::rng_t &rng);
+        common::rng_t &rng,
+        size_t niters=1,
+        size_t nthreads=1,
+        kernel_stats_t *stats=nullptr);
 };
 
 } // namespace kernels
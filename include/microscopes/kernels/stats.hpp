@@ -0,0 +1,97 @@
+#pragma once
+
+#include <chrono>
+#include <cstddef>
+
+namespace microscopes {
+namespace kernels {
+
+// counters accumulated by the kernels, which take an optional pointer to
+// one. with a null pointer nothing is timed or counted, so the only cost is
+// a branch per phase
+struct kernel_stats_t {
+  typedef std::chrono::steady_clock clock;
+
+  enum phase_t {
+    REMOVE_VALUE = 0,
+    SCORE_VALUE,
+    SCORE_LIKELIHOOD,
+    SAMPLE_DISCRETE,
+    ADD_VALUE,
+    CREATE_GROUP,
+    DELETE_GROUP,
+    NPHASES,
+  };
+
+  kernel_stats_t() { reset(); }
+
+  void
+  reset()
+  {
+    for (size_t i = 0; i < NPHASES; i++) {
+      seconds_[i] = 0.;
+      calls_[i] = 0;
+    }
+    score_evals_ = 0;
+    stepping_out_ = 0;
+    shrinks_ = 0;
+    max_iters_ = 0;
+  }
+
+  void
+  merge(const kernel_stats_t &that)
+  {
+    for (size_t i = 0; i < NPHASES; i++) {
+      seconds_[i] += that.seconds_[i];
+      calls_[i] += that.calls_[i];
+    }
+    score_evals_ += that.score_evals_;
+    stepping_out_ += that.stepping_out_;
+    shrinks_ += that.shrinks_;
+    max_iters_ += that.max_iters_;
+  }
+
+  inline double seconds(phase_t phase) const { return seconds_[phase]; }
+  inline size_t calls(phase_t phase) const { return calls_[phase]; }
+
+  static const char *
+  phase_name(phase_t phase)
+  {
+    static const char *names[NPHASES] = {
+      "remove_value",
+      "inplace_score_value",
+      "score_likelihood",
+      "sample_discrete_log",
+      "add_value",
+      "create_group",
+      "delete_group",
+    };
+    return names[phase];
+  }
+
+  // runs f(), charging its wall time to phase of stats (if not null)
+  template <typename F>
+  static inline void
+  timed(kernel_stats_t *stats, phase_t phase, F f)
+  {
+    if (!stats) {
+      f();
+      return;
+    }
+    const auto start = clock::now();
+    f();
+    stats->seconds_[phase] +=
+      std::chrono::duration<double>(clock::now() - start).count();
+    stats->calls_[phase]++;
+  }
+
+  double seconds_[NPHASES];
+  size_t calls_[NPHASES];
+  size_t score_evals_;  // model score evaluations
+  size_t stepping_out_; // slice interval expansions (or doublings)
+  size_t shrinks_;      // slice bracket shrinks
+  size_t max_iters_;    // # of times a slice iteration limit was hit
+};
+
+} // namespace kernels
+} // namespace microscopes
@@ -0,0 +1,12 @@
+from libcpp.vector cimport vector
+from libc.stddef cimport size_t
+
+from microscopes.common._random_fwd_h cimport rng_t
+
+cdef extern from "microscopes/kernels/discrete.hpp" namespace "microscopes::kernels::discrete":
+    ctypedef enum method_t:
+        EXACT "microscopes::kernels::discrete::EXACT"
+        FAST "microscopes::kernels::discrete::FAST"
+
+    float fast_exp(float)
+    size_t sample_log(vector[float] &, rng_t &, method_t) nogil except +
@@ -5,10 +5,39 @@ from libc.stddef cimport size_t
 from microscopes.common._entity_state_h cimport entity_based_state_object
 from microscopes.common._random_fwd_h cimport rng_t
 from microscopes._models_h cimport hypers_raw_ptr
+from microscopes.kernels._stats_h cimport kernel_stats_t
+from microscopes.kernels._discrete_h cimport method_t
 
 cdef extern from "microscopes/kernels/gibbs.hpp" namespace "microscopes::kernels::gibbs":
     ctypedef vector[pair[hypers_raw_ptr, float]] grid_t
-    void assign(entity_based_state_object &, rng_t &) except +
-    void assign_resample(entity_based_state_object &, size_t, rng_t &) except +
-    void hp(entity_based_state_object &, vector[pair[size_t, grid_t]] &, rng_t &) except +
-    void perftest(entity_based_state_object &, rng_t &) except +
+
+    cdef enum pool_t:
+        UNPOOLED
+        POOL_COLLAPSED
+        POOL_REDRAW
+
+    cdef cppclass hp_memo_t:
+        hp_memo_t()
+        hp_memo_t(size_t)
+        void invalidate()
+        void invalidate(size_t)
+        size_t size()
+        size_t capacity_
+        size_t hits_
+        size_t misses_
+
+    cdef cppclass split_merge_stats_t:
+        split_merge_stats_t()
+        size_t nsplits_
+        size_t nsplits_accepted_
+        size_t nmerges_
+        size_t nmerges_accepted_
+
+    void split_merge(entity_based_state_object &, rng_t &, size_t, size_t, split_merge_stats_t *, kernel_stats_t *) nogil except +
+    void assign(entity_based_state_object &, rng_t &, size_t, kernel_stats_t *, pool_t, method_t) nogil except +
+    void assign_resample(entity_based_state_object &, size_t, rng_t &, size_t, kernel_stats_t *, pool_t, method_t) nogil except +
+    void assign_parallel(entity_based_state_object &, size_t, rng_t &, size_t, size_t, size_t, kernel_stats_t *, method_t) nogil except +
+    void assign_subset(entity_based_state_object &, const size_t *, size_t, float, rng_t &, size_t, kernel_stats_t *, pool_t, method_t) nogil except +
+    void assign_resample_subset(entity_based_state_object &, size_t, const size_t *, size_t, float, rng_t &, size_t, kernel_stats_t *, pool_t, method_t) nogil except +
+    void hp(entity_based_state_object &, vector[pair[size_t, grid_t]] &, rng_t &, size_t, size_t, hp_memo_t *, kernel_stats_t *) nogil except +
+    void perftest(entity_based_state_object &, rng_t &, method_t) except +
@@ -0,0 +1,247 @@
+# cython: embedsignature=True
+
+
+# cython imports
+from libcpp.vector cimport vector
+from libc.stddef cimport size_t
+
+from microscopes.kernels._mh_h cimport (
+    hp as c_hp,
+    theta as c_theta,
+    mh_stats_t,
+    mh_update_param_t,
+    mh_hp_param_t,
+    mh_hp_t,
+    mh_theta_param_t,
+    mh_theta_t,
+    sample_1d as c_sample_1d,
+)
+from microscopes.common._entity_state cimport entity_based_state_object
+from microscopes.common._entity_state_h cimport (
+    entity_based_state_object as c_entity_based_state_object,
+)
+from microscopes.common._scalar_functions cimport scalar_function
+from microscopes.common._rng cimport rng
+from microscopes.common._random_fwd_h cimport rng_t
+from microscopes.kernels._stats_h cimport kernel_stats_t
+from microscopes.kernels.stats cimport kernel_stats
+
+# python imports
+from microscopes.common import validator
+from microscopes.kernels.slice import _parse_descriptor
+
+
+def _validate_target(target):
+    if not (0. < target < 1.):
+        raise ValueError("target must be in (0, 1)")
+
+
+cdef mh_hp_param_t _build_hp_param(update_descs,
+                                   prior,
+                                   sigma,
+                                   size_t nadapt,
+                                   float target) except *:
+    cdef vector[mh_update_param_t] updates
+    if not hasattr(update_descs, '__iter__'):
+        update_descs = [update_descs]
+    for update_desc in update_descs:
+        key, idx = _parse_descriptor(update_desc, default=0)
+        updates.push_back(mh_update_param_t(key, idx))
+    validator.validate_type(prior, scalar_function)
+    validator.validate_positive(sigma)
+    return mh_hp_param_t(
+        updates, (<scalar_function>prior)._func, sigma, nadapt, target)
+
+
+cdef dict _mh_stats(float sigma, mh_stats_t &stats):
+    return {
+        'sigma': sigma,
+        'nproposals': stats.nproposals_,
+        'naccepted': stats.naccepted_,
+        'acceptance':
+            float(stats.naccepted_) / stats.nproposals_
+            if stats.nproposals_ else 0.,
+    }
+
+
+cdef class hp_plan:
+    """A precompiled set of `hp()` update descriptors, which also carries
+    the (adapted) proposal scales.
+
+    Parameters
+    ----------
+    cparam : dict, optional
+    hparams : dict, optional
+        Same format as the arguments of `hp()`.
+    nadapt : int, optional
+        If positive, the proposal scale of each parameter is adapted toward
+        the acceptance rate `target` over its first `nadapt` proposals (by
+        Robbins-Monro steps on the log scale), and then held fixed. These
+        draws should be discarded as burnin.
+    target : float, optional
+        The acceptance rate aimed for when adapting. The default suits
+        scalar parameters; about 0.234 suits tuple descriptors of several
+        coordinates.
+
+    Notes
+    -----
+    As with `slice.hp_plan`, a plan should be reused across calls (and not
+    shared between chains).
+
+    """
+
+    cdef vector[mh_hp_param_t] _cparam
+    cdef vector[mh_hp_t] _hparams
+
+    def __cinit__(self, cparam={}, hparams={}, int nadapt=0,
+                  float target=0.44):
+        validator.validate_nonnegative(nadapt, "nadapt")
+        _validate_target(target)
+        cdef vector[mh_hp_param_t] buf0
+        for update_descs, (prior, sigma) in cparam.iteritems():
+            self._cparam.push_back(_build_hp_param(
+                update_descs, prior, sigma, nadapt, target))
+        for fi, hparam in hparams.iteritems():
+            buf0.clear()
+            for update_descs, (prior, sigma) in hparam.iteritems():
+                buf0.push_back(_build_hp_param(
+                    update_descs, prior, sigma, nadapt, target))
+            self._hparams.push_back(mh_hp_t(fi, buf0))
+
+    def stats(self):
+        """Returns a list with one dict per parameter: its `component`
+        ('cluster' or the feature id), its `updates`, its current proposal
+        scale `sigma`, and its number of proposals, acceptances and
+        acceptance rate so far.
+
+        """
+        cdef size_t i, j
+        ret = []
+        for i in xrange(self._cparam.size()):
+            d = _mh_stats(self._cparam[i].sigma_, self._cparam[i].stats_)
+            d['component'] = 'cluster'
+            d['updates'] = [(u.key_, u.index_)
+                            for u in self._cparam[i].updates_]
+            ret.append(d)
+        for i in xrange(self._hparams.size()):
+            for j in xrange(self._hparams[i].params_.size()):
+                d = _mh_stats(self._hparams[i].params_[j].sigma_,
+                              self._hparams[i].params_[j].stats_)
+                d['component'] = self._hparams[i].index_
+                d['updates'] = [(u.key_, u.index_)
+                                for u in self._hparams[i].params_[j].updates_]
+                ret.append(d)
+        return ret
+
+
+cdef class theta_plan:
+    """A precompiled set of `theta()` descriptors (see `hp_plan`). A theta
+    parameter shares one proposal scale across all the groups it is sampled
+    in.
+
+    """
+
+    cdef vector[mh_theta_t] _tparams
+
+    def __cinit__(self, tparams={}, int nadapt=0, float target=0.44):
+        validator.validate_nonnegative(nadapt, "nadapt")
+        _validate_target(target)
+        cdef vector[mh_theta_param_t] buf0
+        for fi, params in tparams.iteritems():
+            buf0.clear()
+            for k, sigma in params.iteritems():
+                validator.validate_positive(sigma)
+                buf0.push_back(mh_theta_param_t(k, sigma, nadapt, target))
+            self._tparams.push_back(mh_theta_t(fi, buf0))
+
+    def stats(self):
+        """Returns a list with one dict per parameter: its `component`, its
+        `key`, and the proposal statistics of `hp_plan.stats()`.
+
+        """
+        cdef size_t i, j
+        ret = []
+        for i in xrange(self._tparams.size()):
+            for j in xrange(self._tparams[i].params_.size()):
+                d = _mh_stats(self._tparams[i].params_[j].sigma_,
+                              self._tparams[i].params_[j].stats_)
+                d['component'] = self._tparams[i].index_
+                d['key'] = self._tparams[i].params_[j].key_
+                ret.append(d)
+        return ret
+
+
+def sample_1d(scalar_function func, float x0, float sigma, rng r,
+              int nsteps=1):
+    """Runs `nsteps` of random walk Metropolis-Hastings on the log density
+    `func`, natively, with gaussian proposals of standard deviation `sigma`.
+
+    Returns
+    -------
+    x : float
+        The state after the last step.
+    acceptance : float
+        The fraction of accepted proposals.
+
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(sigma, "sigma")
+    validator.validate_positive(nsteps, "nsteps")
+    cdef size_t naccepted = 0
+    x = c_sample_1d(func._func, x0, sigma, r._thisptr[0], nsteps, naccepted)
+    return x, naccepted / float(nsteps)
+
+
+def hp(entity_based_state_object s, rng r, cparam={}, hparams={},
+       int niters=1, hp_plan plan=None, kernel_stats stats=None):
+    """Random walk Metropolis-Hastings on the hyperparameters, with the
+    same descriptors as `slice.hp()`, except that the second element of
+    each tuple is the standard deviation of the gaussian proposal:
+
+    hparams = {
+      0 : {
+            ('alpha', 'beta') : (log_noninformative_beta_prior, 0.1),
+          },
+    }
+
+    Each step costs a single likelihood evaluation (and none when the
+    proposal falls outside the support of the prior). To adapt the proposal
+    scales, pass an `hp_plan` with `nadapt` set as `plan`, and reuse it
+    across calls.
+
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(niters, "niters")
+    if plan is None:
+        plan = hp_plan(cparam, hparams)
+    elif cparam or hparams:
+        raise ValueError("cannot give both a plan and descriptors")
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = NULL
+    if stats is not None:
+        ps = &stats._thisobj
+    with nogil:
+        c_hp(px[0], plan._cparam, plan._hparams, pr[0], niters, ps)
+
+
+def theta(entity_based_state_object s, rng r, tparams={}, int niters=1,
+          theta_plan plan=None, kernel_stats stats=None):
+    """Random walk Metropolis-Hastings on the suffstats parameters, with the
+    descriptors of `slice.theta()` (the values being proposal standard
+    deviations). See `hp()`.
+
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(niters, "niters")
+    if plan is None:
+        plan = theta_plan(tparams)
+    elif tparams:
+        raise ValueError("cannot give both a plan and descriptors")
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = NULL
+    if stats is not None:
+        ps = &stats._thisobj
+    with nogil:
+        c_theta(px[0], plan._tparams, pr[0], niters, ps)
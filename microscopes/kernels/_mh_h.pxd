@@ -0,0 +1,68 @@
+from libcpp.vector cimport vector
+from libcpp.string cimport string
+from libc.stddef cimport size_t
+
+from microscopes.common._entity_state_h cimport entity_based_state_object
+from microscopes.common._scalar_functions_h cimport scalar_fn
+from microscopes.common._random_fwd_h cimport rng_t
+from microscopes.kernels._stats_h cimport kernel_stats_t
+
+cdef extern from "microscopes/kernels/mh.hpp" namespace "microscopes::kernels::mh":
+    float sample_1d(scalar_fn, float, float, rng_t &, size_t, size_t &) nogil except +
+
+    cdef cppclass mh_stats_t:
+        size_t nproposals_
+        size_t naccepted_
+
+    cdef cppclass mh_update_param_t:
+        mh_update_param_t()
+        mh_update_param_t(const string &, size_t) except +
+        string key_
+        size_t index_
+
+    cdef cppclass mh_hp_param_t:
+        mh_hp_param_t()
+        mh_hp_param_t(const vector[mh_update_param_t] &,
+                      scalar_fn,
+                      float,
+                      size_t,
+                      float) except +
+        vector[mh_update_param_t] updates_
+        float sigma_
+        size_t nadapt_
+        float target_
+        mh_stats_t stats_
+
+    cdef cppclass mh_hp_t:
+        mh_hp_t()
+        mh_hp_t(size_t, const vector[mh_hp_param_t] &) except +
+        size_t index_
+        vector[mh_hp_param_t] params_
+
+    cdef cppclass mh_theta_param_t:
+        mh_theta_param_t()
+        mh_theta_param_t(string &, float, size_t, float) except +
+        string key_
+        float sigma_
+        size_t nadapt_
+        float target_
+        mh_stats_t stats_
+
+    cdef cppclass mh_theta_t:
+        mh_theta_t()
+        mh_theta_t(size_t, vector[mh_theta_param_t] &) except +
+        size_t index_
+        vector[mh_theta_param_t] params_
+
+    void hp(entity_based_state_object &,
+            const vector[mh_hp_param_t] &,
+            const vector[mh_hp_t] &,
+            rng_t &,
+            size_t,
+            kernel_stats_t *) nogil except +
+
+    void theta(entity_based_state_object &,
+               const vector[mh_theta_t] &,
+               rng_t &,
+               size_t,
+               kernel_stats_t *) nogil except +
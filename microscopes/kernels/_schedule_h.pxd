@@ -0,0 +1,42 @@
+from libcpp.vector cimport vector
+from libcpp.utility cimport pair
+from libc.stddef cimport size_t
+
+from microscopes.common._entity_state_h cimport entity_based_state_object
+from microscopes.common._random_fwd_h cimport rng_t
+from microscopes.kernels._gibbs_h cimport grid_t
+from microscopes.kernels._slice_h cimport (
+    slice_hp_param_t,
+    slice_hp_t,
+    slice_theta_t,
+)
+
+cdef extern from "microscopes/kernels/schedule.hpp" namespace "microscopes::kernels::schedule":
+    cdef enum kernel_t:
+        ASSIGN
+        ASSIGN_RESAMPLE
+        GIBBS_HP
+        SLICE_HP
+        SLICE_THETA
+
+    cdef cppclass entry_t:
+        entry_t()
+        kernel_t kernel_
+        size_t every_
+        size_t m_
+        vector[pair[size_t, grid_t]] grid_
+        vector[slice_hp_param_t] cparams_
+        vector[slice_hp_t] hparams_
+        vector[slice_theta_t] tparams_
+        size_t ncalls_
+        double seconds_
+
+cdef extern from "microscopes/kernels/schedule.hpp" namespace "microscopes::kernels":
+    cdef cppclass schedule:
+        schedule()
+        void add(const entry_t &) except +
+        const vector[entry_t] & entries()
+        entry_t & entry(size_t)
+        size_t nsweeps()
+        void run(entity_based_state_object &, rng_t &, size_t) nogil except +
+        void reset_timings()
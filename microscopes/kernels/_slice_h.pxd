@@ -1,43 +1,82 @@
 from libcpp.vector cimport vector
 from libcpp.utility cimport pair
 from libcpp.string cimport string
+from libcpp cimport bool
 from libcpp.map cimport map
 from libc.stddef cimport size_t
 
 from microscopes.common._entity_state_h cimport entity_based_state_object
 from microscopes.common._scalar_functions_h cimport scalar_fn
 from microscopes.common._random_fwd_h cimport rng_t
+from microscopes.kernels._stats_h cimport kernel_stats_t
 
 cdef extern from "microscopes/kernels/slice.hpp" namespace "microscopes::kernels::slice":
+    ctypedef enum interval_t:
+        STEPPING_OUT "microscopes::kernels::slice::STEPPING_OUT"
+        DOUBLING "microscopes::kernels::slice::DOUBLING"
+
     float sample_1d(scalar_fn fn, float, float, rng_t &) except +
+    float sample_1d(scalar_fn fn, float, float, rng_t &,
+                    unsigned, unsigned, interval_t) except +
+
+    cdef cppclass draw_stats_t:
+        size_t ndraws_
+        size_t nevals_
+        size_t nadapted_
+        double width_sum_
 
     cdef cppclass slice_update_param_t:
         slice_update_param_t()
         slice_update_param_t(const string &, size_t) except +
+        string key_
+        size_t index_
 
     cdef cppclass slice_hp_param_t:
         slice_hp_param_t()
         slice_hp_param_t(const vector[slice_update_param_t] &,
                          scalar_fn,
-                         float) except +
+                         float,
+                         interval_t,
+                         size_t,
+                         bool) except +
+        vector[slice_update_param_t] updates_
+        float w_
+        interval_t interval_
+        size_t nadapt_
+        bool joint_
+        draw_stats_t stats_
 
     cdef cppclass slice_hp_t:
         slice_hp_t()
         slice_hp_t(size_t, const vector[slice_hp_param_t] &) except +
+        size_t index_
+        vector[slice_hp_param_t] params_
 
     cdef cppclass slice_theta_param_t:
         slice_theta_param_t()
-        slice_theta_param_t(string &, float) except +
+        slice_theta_param_t(string &, float, interval_t, size_t) except +
+        string key_
+        float w_
+        interval_t interval_
+        size_t nadapt_
+        draw_stats_t stats_
 
     cdef cppclass slice_theta_t:
         slice_theta_t()
         slice_theta_t(size_t, vector[slice_theta_param_t] &) except +
+        size_t index_
+        vector[slice_theta_param_t] params_
 
     void hp(entity_based_state_object &,
             const vector[slice_hp_param_t] &,
             const vector[slice_hp_t] &,
-            rng_t &) except +
+            rng_t &,
+            size_t,
+            kernel_stats_t *) nogil except +
 
     void theta(entity_based_state_object &,
                const vector[slice_theta_t] &,
-               rng_t &) except +
+               rng_t &,
+               size_t,
+               size_t,
+               kernel_stats_t *) nogil except +
@@ -0,0 +1,25 @@
+from libc.stddef cimport size_t
+
+cdef extern from "microscopes/kernels/stats.hpp" namespace "microscopes::kernels":
+    ctypedef enum phase_t "microscopes::kernels::kernel_stats_t::phase_t":
+        REMOVE_VALUE "microscopes::kernels::kernel_stats_t::REMOVE_VALUE"
+        SCORE_VALUE "microscopes::kernels::kernel_stats_t::SCORE_VALUE"
+        SCORE_LIKELIHOOD "microscopes::kernels::kernel_stats_t::SCORE_LIKELIHOOD"
+        SAMPLE_DISCRETE "microscopes::kernels::kernel_stats_t::SAMPLE_DISCRETE"
+        ADD_VALUE "microscopes::kernels::kernel_stats_t::ADD_VALUE"
+        CREATE_GROUP "microscopes::kernels::kernel_stats_t::CREATE_GROUP"
+        DELETE_GROUP "microscopes::kernels::kernel_stats_t::DELETE_GROUP"
+        NPHASES "microscopes::kernels::kernel_stats_t::NPHASES"
+
+    cdef cppclass kernel_stats_t:
+        kernel_stats_t()
+        void reset()
+        void merge(const kernel_stats_t &)
+        double seconds(phase_t)
+        size_t calls(phase_t)
+        size_t score_evals_
+        size_t stepping_out_
+        size_t shrinks_
+        size_t max_iters_
+
+    const char *phase_name "microscopes::kernels::kernel_stats_t::phase_name" (phase_t)
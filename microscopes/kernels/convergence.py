@@ -0,0 +1,67 @@
+"""Convergence diagnostics computed across chains: the split-Rhat and the
+effective sample size (ESS) of a scalar summary, as in Gelman et al.,
+Bayesian Data Analysis (3rd edition), chapter 11.
+
+Both functions take the draws as an array of shape (nchains, ndraws).
+
+"""
+
+import numpy as np
+
+
+def _split(draws):
+    draws = np.asarray(draws, dtype=np.float64)
+    if draws.ndim != 2:
+        raise ValueError("expecting an array of shape (nchains, ndraws)")
+    half = draws.shape[1] // 2
+    if half < 2:
+        raise ValueError("need at least 4 draws per chain")
+    return np.vstack([draws[:, :half], draws[:, -half:]])
+
+
+def _variances(chains):
+    # the within-chain variance W, and the estimate var+ of the marginal
+    # posterior variance
+    n = chains.shape[1]
+    W = chains.var(axis=1, ddof=1).mean()
+    B = n * chains.mean(axis=1).var(ddof=1)
+    return W, (n - 1.) / n * W + B / n
+
+
+def split_rhat(draws):
+    """The potential scale reduction of the draws, with each chain split in
+    halves (so that trends within the chains count as well). Values close to
+    1 indicate that the chains have mixed.
+
+    """
+    chains = _split(draws)
+    W, var_plus = _variances(chains)
+    if W == 0.:
+        # constant chains: mixed only if they all agree
+        return 1. if var_plus == 0. else np.inf
+    return np.sqrt(var_plus / W)
+
+
+def ess(draws):
+    """The effective sample size of the draws, across all the chains. The
+    autocorrelations are estimated from the variograms of the (split)
+    chains, and summed over Geyer's initial positive sequence.
+
+    """
+    chains = _split(draws)
+    m, n = chains.shape
+    _, var_plus = _variances(chains)
+    if var_plus == 0.:
+        return float(m * n)
+    rho = []
+    for t in xrange(1, n):
+        V = ((chains[:, t:] - chains[:, :-t]) ** 2).mean()
+        rho.append(1. - V / (2. * var_plus))
+    # sum the autocorrelations in pairs, until a pair sums to a negative
+    tau = 1.
+    for t in xrange(0, len(rho) - 1, 2):
+        pair = rho[t] + rho[t + 1]
+        if pair < 0.:
+            break
+        tau += 2. * pair
+    return m * n / tau
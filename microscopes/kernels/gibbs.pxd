@@ -0,0 +1,17 @@
+from libcpp.vector cimport vector
+from libcpp.utility cimport pair
+from libc.stddef cimport size_t
+
+from microscopes.kernels._gibbs_h cimport grid_t
+from microscopes.common._entity_state cimport entity_based_state_object
+from microscopes._models_h cimport hypers_shared_ptr
+
+cdef class grid:
+    cdef vector[pair[size_t, grid_t]] _grid
+    cdef vector[hypers_shared_ptr] _ptrs
+
+
+cdef int _build_grids(entity_based_state_object,
+                      object,
+                      vector[pair[size_t, grid_t]] &,
+                      vector[hypers_shared_ptr] &) except -1
@@ -9,36 +9,53 @@ from libc.stddef cimport size_t
 from microscopes.kernels._gibbs_h cimport (
     assign as c_assign,
     assign_resample as c_assign_resample,
+    assign_subset as c_assign_subset,
+    assign_resample_subset as c_assign_resample_subset,
+    assign_parallel as c_assign_parallel,
+    split_merge as c_split_merge,
     hp as c_hp,
     perftest as c_perftest,
     grid_t,
+    pool_t,
+    UNPOOLED,
+    POOL_COLLAPSED,
+    POOL_REDRAW,
+    hp_memo_t,
+    split_merge_stats_t,
+)
+from microscopes.kernels._discrete_h cimport (
+    method_t,
+    EXACT,
+    FAST,
+    sample_log as c_sample_log,
 )
 from microscopes.common._entity_state cimport entity_based_state_object
+from microscopes.common._entity_state_h cimport (
+    entity_based_state_object as c_entity_based_state_object,
+)
 from microscopes.common._rng cimport rng
+from microscopes.common._random_fwd_h cimport rng_t
 from microscopes.common._typedefs_h cimport hyperparam_bag_t
 from microscopes._models_h cimport hypers_shared_ptr, hypers_raw_ptr
 from microscopes._models cimport _base
+from microscopes.kernels._stats_h cimport kernel_stats_t
+from microscopes.kernels.stats cimport kernel_stats
+from numpy cimport ndarray, int64_t, PyArray_DATA, import_array
 
 # python imports
 from microscopes._models import _base
 from microscopes.common import validator
+import numpy as np
 
-
-def assign(entity_based_state_object s, rng r):
-    validator.validate_not_none(r, "r")
-    c_assign(s.raw_px()[0], r._thisptr[0])
-
-
-def assign_resample(entity_based_state_object s, int m, rng r):
-    validator.validate_not_none(r, "r")
-    c_assign_resample(s.raw_px()[0], m, r._thisptr[0])
+import_array()
 
 
-def hp(entity_based_state_object s, dict params, rng r):
-    validator.validate_not_none(r, "r")
-    cdef vector[pair[size_t, grid_t]] g
+cdef int _build_grids(entity_based_state_object s,
+                      params,
+                      vector[pair[size_t, grid_t]] &g,
+                      vector[hypers_shared_ptr] &ptrs) except -1:
+    # the hypers in `g` are owned by `ptrs`
     cdef grid_t g0
-    cdef vector[hypers_shared_ptr] ptrs
     cdef hyperparam_bag_t raw
     for fi, ps in params.iteritems():
         g0.clear()
@@ -53,9 +70,386 @@ def hp(entity_based_state_object s, dict params, rng r):
             g0.push_back(
                 pair[hypers_raw_ptr, float](ptrs.back().get(), prior_score))
         g.push_back(pair[size_t, grid_t](fi, g0))
-    c_hp(s._thisptr.get()[0], g, r._thisptr[0])
+    return 0
+
+
+cdef class grid:
+    """A precompiled set of `hp()` grids, built once and then passed to
+    `hp()` in place of the params dict. The hypers objects and the prior
+    scores of every grid point are created up front, so calling `hp()` with
+    a grid does no per-call python work or allocation.
+
+    Parameters
+    ----------
+    s : entity based state object
+        A state with the same models as the states the grid will be used
+        with.
+    params : dict
+        Same format as the params of `hp()`, i.e. a dict mapping a feature
+        id to {'hpdf': prior_fn, 'hgrid': [hp0, hp1, ...]}.
+
+    """
+
+    def __cinit__(self, entity_based_state_object s, params):
+        _build_grids(s, params, self._grid, self._ptrs)
+
+    def __len__(self):
+        return self._grid.size()
+
+
+cdef class hp_memo:
+    """A bounded memo of the likelihood scores computed by `hp()`, for use
+    with a precompiled `grid`. The scores of a feature are reused across
+    calls to `hp()` on the same state for as long as the assignment does not
+    change. A memo shared by several states recomputes the scores whenever
+    the state changes, so keep one memo per state.
+
+    Only valid for features whose likelihood is a deterministic function of
+    the hypers and the assignment (e.g. conjugate features). Call
+    `invalidate()` after changing a feature's suffstats by other means.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        The maximum number of cached scores (one per feature and grid
+        point). The least recently used features are evicted first.
+
+    """
+
+    cdef hp_memo_t _thisobj
+    # the grids whose points and the states which are keyed (by address) in
+    # the memo, kept alive so that those addresses are not reused
+    cdef list _grids
+    cdef list _states
+
+    def __cinit__(self, int capacity=1000000):
+        validator.validate_positive(capacity, "capacity")
+        self._thisobj.capacity_ = capacity
+        self._grids = []
+        self._states = []
+
+    def invalidate(self, fid=None):
+        if fid is None:
+            self._thisobj.invalidate()
+            self._grids = []
+            self._states = []
+        else:
+            validator.validate_nonnegative(fid, "fid")
+            self._thisobj.invalidate(<size_t>fid)
+
+    property hits:
+        def __get__(self):
+            return self._thisobj.hits_
+
+    property misses:
+        def __get__(self):
+            return self._thisobj.misses_
+
+    def stats(self):
+        return {
+            'hits': self._thisobj.hits_,
+            'misses': self._thisobj.misses_,
+            'size': self._thisobj.size(),
+            'capacity': self._thisobj.capacity_,
+        }
+
+    def reset_stats(self):
+        self._thisobj.hits_ = 0
+        self._thisobj.misses_ = 0
+
+
+# the kernels below run all `niters` sweeps natively, without holding the
+# GIL, so independent states can be sampled concurrently from python threads.
+# given a `kernel_stats` object as `stats`, they accumulate their counters
+# into it. the assignment kernels take a `sampler`, the method used to draw
+# each entity's group from its scores: 'exact' (the default) or 'fast' (see
+# `sample_discrete_log`)
+
+
+cdef inline kernel_stats_t *_stats_px(kernel_stats stats):
+    if stats is None:
+        return NULL
+    return &stats._thisobj
+
+
+_samplers = {'exact': EXACT, 'fast': FAST}
+
+
+def _parse_sampler(sampler):
+    if sampler not in _samplers:
+        raise ValueError(
+            "sampler must be one of {}".format(sorted(_samplers.keys())))
+    return _samplers[sampler]
+
+
+_pools = {
+    'collapsed': POOL_COLLAPSED,
+    'redraw': POOL_REDRAW,
+}
+
+
+def _parse_pooled(pooled):
+    if pooled is False or pooled is None:
+        return UNPOOLED
+    if pooled not in _pools:
+        raise ValueError(
+            "pooled must be False or one of {}".format(sorted(_pools.keys())))
+    return _pools[pooled]
+
+
+def sample_discrete_log(scores, rng r, int size=1, sampler='exact'):
+    """Draws `size` indices from the categorical distribution with the
+    (unnormalized) log probabilities `scores`, as the assignment kernels do
+    for every entity.
+
+    With `sampler='fast'`, the probabilities are computed with a polynomial
+    exp approximation (~1e-5 relative error) in a single pass, instead of
+    by `sample_discrete_log` from microscopes.common.
+
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(size, "size")
+    cdef method_t method = _parse_sampler(sampler)
+    cdef vector[float] c_scores = list(scores)
+    if not c_scores.size():
+        raise ValueError("empty scores")
+    cdef vector[float] buf
+    cdef ndarray[int64_t, ndim=1] ret = np.empty(size, dtype=np.int64)
+    cdef int i
+    for i in xrange(size):
+        buf = c_scores
+        ret[i] = c_sample_log(buf, r._thisptr[0], method)
+    return ret
+
+
+def assign(entity_based_state_object s, rng r, int niters=1,
+           kernel_stats stats=None, pooled=False, sampler='exact'):
+    """
+    With `pooled`, a group emptied by removing an entity is kept as the
+    (single) empty group in place of the current one, so a group is only
+    created once the empty group has been picked. `pooled` says why this
+    is exact:
+
+      'collapsed' : the model is collapsed, so all the empty groups score
+                    the same (this is not checked)
+      'redraw'    : the state redraws the parameters of the empty groups
+                    kept from the base measure, in place (it must implement
+                    `gibbs::group_redraw_t`, or a RuntimeError is raised)
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(niters, "niters")
+    cdef method_t method = _parse_sampler(sampler)
+    cdef pool_t pool = _parse_pooled(pooled)
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = _stats_px(stats)
+    with nogil:
+        c_assign(px[0], pr[0], niters, ps, pool, method)
+
+
+def assign_resample(entity_based_state_object s, int m, rng r, int niters=1,
+                    kernel_stats stats=None, pooled=False,
+                    sampler='exact'):
+    """
+    With `pooled`, the `m` empty groups are recycled from one entity to the
+    next (only the shortfall is created, and only the surplus deleted)
+    instead of being recreated for every entity, as Algorithm 8 does. The
+    values of `pooled` are those of `assign`: with 'redraw', the groups
+    kept are redrawn from the base measure for every entity, which makes
+    this valid for non-conjugate models.
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(m, "m")
+    validator.validate_positive(niters, "niters")
+    cdef method_t method = _parse_sampler(sampler)
+    cdef pool_t pool = _parse_pooled(pooled)
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = _stats_px(stats)
+    with nogil:
+        c_assign_resample(px[0], m, pr[0], niters, ps, pool, method)
+
+
+def assign_parallel(entity_based_state_object s, rng r, int nthreads,
+                    int m=1, int sync=0, int niters=1,
+                    kernel_stats stats=None, sampler='exact'):
+    """
+    An approximate, multi-threaded version of `assign_resample`, for a
+    single chain on a large dataset. The entities are sampled in blocks of
+    `nthreads` * `sync`: each thread scores and samples `sync` entities
+    against the state without the block, and the block is merged back in at
+    the end. Within a block, entities do not see each other's moves, so this
+    trades a small bias for speed; a larger `sync` scales better. The groups
+    emptied by removing the block stay available to it, next to the `m`
+    fresh groups. The entities which picked an empty group are resampled
+    one at a time when the block is merged back, so that they do not all
+    end up in one cluster.
+
+    With the default `sync` of 0, a block holds about 1% of the entities.
+    With `nthreads` = 1, the sweeps are exact (as in `assign_resample`).
+
+    The state must support concurrent `inplace_score_value()` calls. The
+    result is reproducible for a fixed seed, `nthreads` and `sync`. If a
+    thread raises, the block is put back where it was before the error is
+    re-raised.
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(nthreads, "nthreads")
+    validator.validate_positive(m, "m")
+    validator.validate_nonnegative(sync, "sync")
+    validator.validate_positive(niters, "niters")
+    cdef method_t method = _parse_sampler(sampler)
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = _stats_px(stats)
+    with nogil:
+        c_assign_parallel(
+            px[0], m, pr[0], nthreads, sync, niters, ps, method)
+
+
+def split_merge(entity_based_state_object s, rng r, int nmoves=1,
+                int nscans=5, kernel_stats stats=None):
+    """
+    Makes `nmoves` restricted gibbs split-merge proposals (Jain & Neal,
+    2004), each launched with `nscans` intermediate restricted scans. A
+    split-merge move can split or merge whole clusters in one step, which
+    incremental moves like `assign` take many sweeps to do. Only valid for
+    collapsed models.
+
+    Returns
+    -------
+    acceptance : dict
+        The number of split and merge proposals made and accepted, as
+        `splits`, `splits_accepted`, `merges` and `merges_accepted`.
+
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(nmoves, "nmoves")
+    validator.validate_nonnegative(nscans, "nscans")
+    cdef split_merge_stats_t acceptance
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = _stats_px(stats)
+    with nogil:
+        c_split_merge(px[0], pr[0], nmoves, nscans, &acceptance, ps)
+    return {
+        'splits': acceptance.nsplits_,
+        'splits_accepted': acceptance.nsplits_accepted_,
+        'merges': acceptance.nmerges_,
+        'merges_accepted': acceptance.nmerges_accepted_,
+    }
+
+
+cdef ndarray _entity_buffer(entity_based_state_object s, entities):
+    # zero-copy when entities is already a contiguous array of np.uintp
+    cdef ndarray buf = np.ascontiguousarray(entities, dtype=np.uintp)
+    if buf.ndim != 1:
+        raise ValueError("entities must be 1-dimensional")
+    if buf.shape[0] and buf.max() >= s.raw_px().nentities():
+        raise ValueError("entity index out of range")
+    return buf
+
+
+def _validate_fraction(fraction):
+    if not (0. <= fraction <= 1.):
+        raise ValueError("fraction must be in [0, 1]")
+
+
+def assign_subset(entity_based_state_object s, entities, rng r,
+                  float fraction=0., int niters=1, kernel_stats stats=None,
+                  pooled=False, sampler='exact'):
+    """
+    Like `assign`, but each sweep only visits the given `entities`, plus a
+    random `fraction` of the other entities already assigned (redrawn for
+    every sweep), so its cost is proportional to the update. The given
+    entities which are not yet assigned are added to the state; the other
+    unassigned entities are left out.
+
+    Parameters
+    ----------
+    entities : array-like of int
+        The entity indices. A contiguous `np.uintp` array is used without
+        copying.
+    fraction : float, optional
+        In [0, 1].
+
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(niters, "niters")
+    _validate_fraction(fraction)
+    cdef method_t method = _parse_sampler(sampler)
+    cdef pool_t pool = _parse_pooled(pooled)
+    cdef ndarray buf = _entity_buffer(s, entities)
+    cdef const size_t *pe = <const size_t *> PyArray_DATA(buf)
+    cdef size_t n = buf.shape[0]
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = _stats_px(stats)
+    with nogil:
+        c_assign_subset(
+            px[0], pe, n, fraction, pr[0], niters, ps, pool, method)
+
+
+def assign_resample_subset(entity_based_state_object s, int m, entities,
+                           rng r, float fraction=0., int niters=1,
+                           kernel_stats stats=None, pooled=False,
+                           sampler='exact'):
+    """
+    Like `assign_resample`, restricted to a subset of the entities (see
+    `assign_subset`).
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(m, "m")
+    validator.validate_positive(niters, "niters")
+    _validate_fraction(fraction)
+    cdef method_t method = _parse_sampler(sampler)
+    cdef pool_t pool = _parse_pooled(pooled)
+    cdef ndarray buf = _entity_buffer(s, entities)
+    cdef const size_t *pe = <const size_t *> PyArray_DATA(buf)
+    cdef size_t n = buf.shape[0]
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = _stats_px(stats)
+    with nogil:
+        c_assign_resample_subset(
+            px[0], m, pe, n, fraction, pr[0], niters, ps, pool, method)
+
+
+def hp(entity_based_state_object s, params, rng r, int niters=1,
+       int nthreads=1, hp_memo memo=None, kernel_stats stats=None):
+    """
+    `params` is either a dict (see `grid`) or a precompiled `grid`.
+
+    With `nthreads` > 1, the features are split across `nthreads` threads,
+    each with its own random stream. The result is reproducible for a fixed
+    seed and `nthreads`.
+
+    `memo` is an optional `hp_memo`, which requires a precompiled `grid`.
+    """
+    validator.validate_not_none(r, "r")
+    validator.validate_positive(niters, "niters")
+    validator.validate_positive(nthreads, "nthreads")
+    cdef grid g
+    if isinstance(params, grid):
+        g = params
+    elif memo is not None:
+        raise ValueError("memoization requires a precompiled grid")
+    else:
+        g = grid(s, params)
+    cdef hp_memo_t *pm = NULL
+    if memo is not None:
+        if not any(x is g for x in memo._grids):
+            memo._grids.append(g)
+        if not any(x is s for x in memo._states):
+            memo._states.append(s)
+        pm = &memo._thisobj
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = _stats_px(stats)
+    with nogil:
+        c_hp(px[0], g._grid, pr[0], niters, nthreads, pm, ps)
 
 
-def perftest(entity_based_state_object s, rng r):
+def perftest(entity_based_state_object s, rng r, sampler='exact'):
     validator.validate_not_none(r, "r")
-    c_perftest(s.raw_px()[0], r._thisptr[0])
+    c_perftest(s.raw_px()[0], r._thisptr[0], _parse_sampler(sampler))
@@ -1,5 +1,23 @@
 import numpy as np
 
+from microscopes.kernels._mh import (
+    sample_1d,
+    hp,
+    theta,
+    hp_plan,
+    theta_plan,
+)
+
+__all__ = [
+    'sample',
+    'sample_chains',
+    'sample_1d',
+    'hp',
+    'theta',
+    'hp_plan',
+    'theta_plan',
+]
+
 
 def sample(xt, pdf, condpdf, condsamp):
     # sample xprop ~ Q(.|xt)
@@ -15,3 +33,41 @@ def sample(xt, pdf, condpdf, condsamp):
         return xprop
     else:
         return xt
+
+
+def sample_chains(xt, pdf, condpdf, condsamp, nsteps=1):
+    """Advances K independent chains `nsteps` times, with array-valued
+    callbacks (so each step costs four calls for all the chains together).
+
+    Parameters
+    ----------
+    xt : array, shape (K,) or (K, ...)
+        The current state of each chain.
+    pdf : function
+        `pdf(x)` returns the log densities of the K points in `x`.
+    condpdf : function
+        `condpdf(a, b)` returns the K log densities log Q(b[k]|a[k]).
+    condsamp : function
+        `condsamp(a)` returns K proposals, drawn from Q(.|a[k]).
+    nsteps : int, optional
+
+    Returns
+    -------
+    x : array
+        The states of the chains after the last step.
+    acceptance : array, shape (K,)
+        The fraction of accepted proposals of each chain.
+
+    """
+    x = np.array(xt, copy=True)
+    fx = pdf(x)
+    naccepted = np.zeros(x.shape[0], dtype=np.int64)
+    for _ in xrange(nsteps):
+        xprop = condsamp(x)
+        fprop = pdf(xprop)
+        lg_alpha = fprop - fx + condpdf(xprop, x) - condpdf(x, xprop)
+        accept = np.log(np.random.random(size=x.shape[0])) <= lg_alpha
+        x[accept] = xprop[accept]
+        fx = np.where(accept, fprop, fx)
+        naccepted += accept
+    return x, naccepted / float(nsteps)
@@ -5,16 +5,32 @@ for various backends
 
 from microscopes.common import validator
 from microscopes.common.rng import rng
+from microscopes.kernels import convergence
+import numpy as np
+import threading
 import warnings
+import Queue
 import logging
 import time
 import tempfile
 import pickle
 import hashlib
+import traceback
 import multiprocessing as mp
+import os
+import uuid
+import errno
+import contextlib
 
 _logger = logging.getLogger(__name__)
 
+_has_fork = hasattr(os, 'fork')
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     import multyvac
     _has_multyvac = True
@@ -22,16 +38,288 @@ except ImportError:
     _has_multyvac = False
 
 
-def _mp_work(args):
-    runner, niters, seed, statearg = args
-    if statearg is not None:
+# expensive states shared with the multiprocessing workers, keyed by digest.
+# this is populated in the parent right before the workers are forked, so
+# the workers inherit the states (copy-on-write) instead of unpickling a
+# private copy per runner
+_mp_shared_states = {}
+
+# expensive states a worker has already loaded from a local state cache,
+# keyed by path
+_mp_loaded_states = {}
+
+
+def _state_filename(digest):
+    return 'state-{}'.format(digest)
+
+
+class _state_cache(object):
+    """A local, content-addressed cache of pickled expensive states. The
+    layout mirrors the multyvac volumes: the state with digest `d` is stored
+    in the file `state-<d>` at the root of the cache directory.
+
+    Files are written atomically, so that concurrent runners can share a
+    cache directory. When `max_bytes` is given, the least recently used
+    states are evicted to keep the cache under that size.
+
+    """
+
+    def __init__(self, path, max_bytes=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._path = path
+        self._max_bytes = max_bytes
+
+    def path(self, digest):
+        return os.path.join(self._path, _state_filename(digest))
+
+    def contains(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def touch(self, digest):
+        # mtimes double as the LRU clock (atimes are unreliable, e.g. on
+        # filesystems mounted with noatime)
+        os.utime(self.path(digest), None)
+
+    def put(self, digest, state):
+        if self.contains(digest):
+            self.touch(digest)
+            return False
+        f = tempfile.NamedTemporaryFile(dir=self._path, delete=False)
+        try:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.rename(f.name, self.path(digest))
+        except:
+            f.close()
+            os.unlink(f.name)
+            raise
+        return True
+
+    def get(self, digest):
+        with open(self.path(digest), 'rb') as fp:
+            state = pickle.load(fp)
+        self.touch(digest)
+        return state
+
+    def evict(self, keep=()):
+        """Removes least recently used states until the cache fits in
+        `max_bytes`. States whose digests are in `keep` are never removed.
+
+        """
+        if self._max_bytes is None:
+            return
+        keep = set(_state_filename(digest) for digest in keep)
+        entries = []
+        total = 0
+        for name in os.listdir(self._path):
+            if not name.startswith('state-'):
+                continue
+            st = os.stat(os.path.join(self._path, name))
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        for _, size, name in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            if name in keep:
+                continue
+            _logger.info("evicting %s from the state cache", name)
+            os.unlink(os.path.join(self._path, name))
+            total -= size
+
+
+def _atomic_write(path, data):
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False)
+    try:
+        f.write(data)
+        f.close()
+        os.rename(f.name, path)
+    except:
+        f.close()
+        os.unlink(f.name)
+        raise
+
+
+_MANIFEST = 'checkpoint'
+_LOCK = 'lock'
+
+# the checkpoint directories locked by this process (record locks do not
+# exclude each other within a process)
+_checkpoint_locks = set()
+_checkpoint_locks_mutex = threading.Lock()
+
+
+class _checkpoint_writer(object):
+    """Writes the checkpoints of a runner on a background thread, so that
+    the sampling loop only pays for fetching the runners. Only the latest
+    checkpoint waiting to be written is kept: when the disk falls behind,
+    checkpoints are skipped rather than queued.
+
+    A checkpoint is a set of chain files and a manifest naming them. The
+    manifest is renamed into place last, and the chain files of the previous
+    checkpoint are only removed afterwards, so the directory always holds a
+    complete checkpoint.
+
+    A run checkpoints under `locked()`, which holds an exclusive lock on the
+    directory (across processes where `fcntl` is available), so two runs
+    cannot share a directory and delete each other's chain files. The
+    writer thread only runs while the lock is held.
+
+    """
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self._cond = threading.Condition()
+        self._pending = None
+        self._busy = False
+        self._error = None
+        self._closed = False
+        self._thread = None
+
+    def _start(self):
+        self._closed = False
+        self._thread = threading.Thread(target=self._main)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Writes the latest checkpoint submitted, then stops the writer
+        thread
+
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("checkpoint failed:\n{}".format(error))
+
+    def submit(self, files, manifest):
+        with self._cond:
+            self._check()
+            self._pending = (files, manifest)
+            self._cond.notify_all()
+
+    def _drain(self):
+        with self._cond:
+            while self._pending is not None or self._busy:
+                self._cond.wait(1.0)
+
+    def flush(self):
+        """Waits until the latest checkpoint submitted is written"""
+        self._drain()
+        with self._cond:
+            self._check()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Holds the directory lock, until the checkpoints submitted in the
+        meantime are written
+
+        """
+        key = os.path.realpath(self.path)
+        with _checkpoint_locks_mutex:
+            if key in _checkpoint_locks:
+                raise RuntimeError(
+                    "checkpoint directory {} is in use".format(self.path))
+            _checkpoint_locks.add(key)
+        fd = None
+        try:
+            if fcntl is not None:
+                # a POSIX record lock, as these are not inherited by the
+                # forked workers (which would hold a flock() past the run)
+                fd = os.open(os.path.join(self.path, _LOCK),
+                             os.O_RDWR | os.O_CREAT)
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    raise RuntimeError(
+                        "checkpoint directory {} is in use".format(self.path))
+            self._start()
+            try:
+                yield
+            finally:
+                self.close()
+        finally:
+            if fd is not None:
+                # closing the descriptor releases the lock
+                os.close(fd)
+            with _checkpoint_locks_mutex:
+                _checkpoint_locks.discard(key)
+
+    def _main(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                files, manifest = self._pending
+                self._pending = None
+                self._busy = True
+            try:
+                for name, data in files:
+                    _atomic_write(os.path.join(self.path, name), data)
+                _atomic_write(os.path.join(self.path, _MANIFEST), manifest)
+                names = set(name for name, _ in files)
+                for name in os.listdir(self.path):
+                    if name.startswith('chain-') and name not in names:
+                        os.unlink(os.path.join(self.path, name))
+            except Exception:
+                error = traceback.format_exc()
+            else:
+                error = None
+            with self._cond:
+                self._busy = False
+                if error is not None:
+                    self._error = error
+                self._cond.notify_all()
+
+
+def _check_tempered(runners):
+    # none of the kernels temper the likelihood, so the runners have to
+    for runner in runners:
+        if not (hasattr(runner, 'set_temperature') and
+                hasattr(runner, 'score_likelihood')):
+            raise ValueError(
+                "tempered runners must implement "
+                "set_temperature() and score_likelihood()")
+
+
+def _mp_load_state(statearg):
+    kind = statearg[0]
+    if kind == 'shared':
+        return _mp_shared_states[statearg[1]]
+    elif kind == 'local':
+        path = statearg[1]
+        if path not in _mp_loaded_states:
+            with open(path, 'rb') as fp:
+                _mp_loaded_states[path] = pickle.load(fp)
+        return _mp_loaded_states[path]
+    elif kind == 'multyvac':
         import multyvac
-        import pickle
-        import os
-        volume, name = statearg
+        _, volume, name = statearg
         volume = multyvac.volume.get(volume)
         with open(os.path.join(volume.mount_path, name)) as fp:
-            runner.expensive_state = pickle.load(fp)
+            return pickle.load(fp)
+    else:
+        assert False, 'should not be reached'
+
+
+def _mp_work(args):
+    runner, niters, seed, statearg = args
+    if statearg is not None:
+        runner.expensive_state = _mp_load_state(statearg)
     prng = rng(seed)
     runner.run(r=prng, niters=niters)
     if statearg is not None:
@@ -39,6 +327,199 @@ def _mp_work(args):
     return runner
 
 
+def default_snapshot(runner):
+    """The default snapshot of `runner.iter_run()`: a dict with the
+    `assignments`, the `cluster_hp` and the `feature_hps` of the runner's
+    latent (as the mixture model latents have). Other latents need an
+    explicit snapshot, since the whole latent would be sent to the parent
+    at every snapshot.
+
+    """
+    latent = runner.get_latent()
+    if not all(hasattr(latent, attr) for attr in
+               ('assignments', 'get_cluster_hp', 'get_feature_hp',
+                'nfeatures')):
+        raise ValueError(
+            "no default snapshot for a latent without assignments")
+    return {
+        'assignments': latent.assignments(),
+        'cluster_hp': latent.get_cluster_hp(),
+        'feature_hps': [latent.get_feature_hp(i)
+                        for i in xrange(latent.nfeatures())],
+    }
+
+
+def _run_chunks(runner, prng, niters, every, snapshot, stop):
+    """Runs `runner` for `niters`, `every` iterations at a time, yielding
+    the number of iterations done and a snapshot after each chunk. Returns
+    early once the event `stop` is set.
+
+    """
+    done = 0
+    while done < niters and not stop.is_set():
+        n = min(every, niters - done)
+        runner.run(r=prng, niters=n)
+        done += n
+        yield done, snapshot(runner)
+
+
+def _mp_iter_work(args):
+    """The streaming counterpart of `_mp_work()`: the snapshots, and then
+    the runner (or the error), are sent back through `progress`.
+
+    """
+    (idx, runner, niters, every, seed, statearg,
+     snapshot, progress, stop) = args
+    try:
+        if statearg is not None:
+            runner.expensive_state = _mp_load_state(statearg)
+        for it, snap in _run_chunks(runner, rng(seed), niters, every,
+                                    snapshot, stop):
+            progress.put((idx, 'snapshot', (it, snap)))
+        if statearg is not None:
+            runner.expensive_state = None
+    except Exception:
+        progress.put((idx, 'error', traceback.format_exc()))
+    else:
+        progress.put((idx, 'done', runner))
+
+
+def _mp_task(args):
+    """A single task of the dynamic scheduler: runs one slice of a chain.
+    Errors are sent back with the result, so that the scheduler never waits
+    on a task which failed.
+
+    """
+    idx, runner, niters, seed, statearg = args
+    start = time.time()
+    try:
+        runner = _mp_work((runner, niters, seed, statearg))
+    except Exception:
+        return idx, False, traceback.format_exc(), None
+    return idx, True, runner, time.time() - start
+
+
+def _cost_estimate(runner):
+    """A guess of the relative time per iteration of a runner which has not
+    been timed yet: the number of entities times the number of features of
+    its latent state, when the latent has both (and 1 otherwise).
+
+    """
+    latent = runner.get_latent()
+    try:
+        return latent.nentities() * latent.nfeatures()
+    except (AttributeError, TypeError):
+        return 1
+
+
+def _lpt_placement(costs, nworkers):
+    """Places each chain on a worker, by the longest processing time
+    rule: the chains are taken from the most to the least costly, each going
+    to the least loaded worker so far. With equal costs, this is a
+    round-robin placement.
+
+    """
+    loads = [0] * nworkers
+    placement = [None] * len(costs)
+    for idx in sorted(xrange(len(costs)), key=lambda idx: -costs[idx]):
+        wid = min(xrange(nworkers), key=lambda wid: loads[wid])
+        placement[idx] = wid
+        loads[wid] += costs[idx]
+    return placement
+
+
+def _expensive_state_digests(runners):
+    """Returns the hex digest of each runner's expensive state (None for
+    runners without one). Runners pointing at the same state object are only
+    hashed once.
+
+    """
+    # XXX(stephentu): we shouldn't reach in there like this
+    digests = []
+    digest_cache = {}
+    for runner in runners:
+        if runner.expensive_state is None:
+            digests.append(None)
+            continue
+        cache_key = id(runner.expensive_state)
+        if cache_key in digest_cache:
+            digest = digest_cache[cache_key]
+        else:
+            h = hashlib.sha1()
+            runner.expensive_state_digest(h)
+            digest = h.hexdigest()
+            digest_cache[cache_key] = digest
+        digests.append(digest)
+    return digests
+
+
+def _mp_resident_main(wid, runners, stateargs, commands, results, stop):
+    """Main loop of a resident worker process.
+
+    `runners` maps a chain index to its runner object. The runners live in
+    this process for the lifetime of the worker; only commands (seeds and
+    iteration counts on the way in, acknowledgements on the way out) cross
+    the process boundary, unless the parent explicitly asks for the latents
+    or the runners themselves. Replies are `(wid, ok, ret)`, with `ok` None
+    for the progress messages of 'iter_run'.
+
+    """
+    for idx, statearg in stateargs.iteritems():
+        if statearg is not None:
+            runners[idx].expensive_state = _mp_load_state(statearg)
+    while True:
+        cmd, payload = commands.get()
+        if cmd == 'stop':
+            break
+        try:
+            if cmd == 'run':
+                for idx, niters, seed in payload:
+                    runners[idx].run(r=rng(seed), niters=niters)
+                ret = None
+            elif cmd == 'iter_run':
+                # the resident chains advance in turns, one chunk at a time,
+                # and each snapshot is sent back as soon as it is taken
+                chains, every, snapshot = payload
+                chunks = [(idx, _run_chunks(runners[idx], rng(seed), niters,
+                                            every, snapshot, stop))
+                          for idx, niters, seed in chains]
+                while chunks:
+                    for idx, it in list(chunks):
+                        try:
+                            results.put((wid, None, (idx,) + next(it)))
+                        except StopIteration:
+                            chunks.remove((idx, it))
+                ret = None
+            elif cmd == 'tempered':
+                # only the log-likelihoods go back, for the swap decisions
+                ret = []
+                for idx, niters, seed, beta in payload:
+                    runners[idx].set_temperature(beta)
+                    runners[idx].run(r=rng(seed), niters=niters)
+                    ret.append((idx, runners[idx].score_likelihood()))
+            elif cmd == 'latents':
+                ret = [(idx, runners[idx].get_latent()) for idx in payload]
+            elif cmd == 'runners':
+                # the expensive states stay behind: the parent still holds
+                # its own reference to them
+                ret = []
+                for idx in payload:
+                    runner = runners[idx]
+                    state = runner.expensive_state
+                    runner.expensive_state = None
+                    try:
+                        blob = pickle.dumps(runner, pickle.HIGHEST_PROTOCOL)
+                    finally:
+                        runner.expensive_state = state
+                    ret.append((idx, blob))
+            else:
+                raise ValueError("unknown command: {}".format(cmd))
+        except Exception:
+            results.put((wid, False, traceback.format_exc()))
+        else:
+            results.put((wid, True, ret))
+
+
 def _mvac_list_files_in_dir(volume, path):
     ents = volume.ls(path)
     return [x['path'] for x in ents if x['type'] == 'f']
@@ -56,14 +537,80 @@ class runner(object):
     runners : list of runner objects
     backend : string, one of {'multiprocessing', 'multyvac'}
         Indicates the parallelization strategy to be used across
-        runners. Note for the 'multiprocessing' backend, the only
-        valid kwarg is 'processes'. For the 'multyvac' backend,
-        the valid kwargs are 'layer', 'core', and 'volume'.
+        runners. Note for the 'multiprocessing' backend, the valid
+        kwargs are 'processes', 'persistent', 'cache_dir', 'cache_size',
+        'schedule', 'slices', 'temperatures', 'swap_every',
+        'checkpoint_dir', and 'checkpoint_every'. For the 'multyvac'
+        backend, the valid kwargs are 'layer', 'core', and 'volume'.
 
     processes : int, optional
         For the 'multiprocessing' backend, the number of processes
         in the process pool. Defaults to the number of processes
         on the current machine.
+    persistent : bool, optional
+        For the 'multiprocessing' backend. If True, the worker processes are
+        started on the first call to `run()` and live until `close()` is
+        called. Each runner stays resident inside its worker between calls
+        to `run()`, so only seeds and iteration counts are sent to the
+        workers. The runners are only sent back on `get_latents()` (which
+        returns just the latents) and `get_runners()`. Defaults to False.
+    cache_dir : string, optional
+        For the 'multiprocessing' backend. A local directory used as a
+        content-addressed cache of the runners' expensive states, laid out
+        like a multyvac volume. States already in the cache are not written
+        again. Where `os.fork` is available, the workers inherit the states
+        from the parent process; otherwise they load them from the cache.
+    cache_size : int, optional
+        The maximum size of `cache_dir`, in bytes. The least recently used
+        states are evicted when the cache grows beyond this size. Defaults to
+        no limit.
+    schedule : string, one of {'static', 'dynamic'}, optional
+        For the non-persistent 'multiprocessing' backend. 'static' (the
+        default) hands all the runners to the pool at once. 'dynamic'
+        dispatches one chain at a time to whichever worker is idle, the
+        costliest chains first. The cost of a chain is its measured time per
+        iteration in the previous call to `run()`, or before any measurement,
+        the number of entities times the number of features of its latent.
+        This keeps all the workers busy when the chains differ in size, or
+        outnumber the processes. Persistent workers are always assigned their
+        runners by cost (longest processing time first).
+    slices : int, optional
+        With the 'dynamic' schedule, each chain runs its `niters` in this
+        many consecutive slices, which lets idle workers pick up the
+        remaining work of the long chains. Each slice sends the runner to a
+        worker and back, so this only pays off when an iteration is costly
+        compared to pickling a runner. Defaults to 1.
+    temperatures : list of floats, optional
+        For the persistent 'multiprocessing' backend. Runs the runners as
+        replicas of a parallel tempering scheme, the i-th one starting at
+        the inverse temperature `temperatures[i]`, in (0, 1]. The runners
+        must then implement `set_temperature(beta)`, after which they target
+        the prior times the likelihood raised to `beta`, and
+        `score_likelihood()`, which returns the (untempered)
+        log-likelihood of their current state. Every `swap_every`
+        iterations, replicas adjacent on the temperature ladder propose to
+        swap their temperatures (the even and the odd pairs in turn). Only
+        the temperatures and log-likelihoods cross the process boundaries.
+        The replicas at inverse temperature 1 sample from the posterior; see
+        `temperatures()` and `swap_stats()`. None of the kernels in
+        `microscopes.kernels` temper the likelihood: the runners have to
+        provide the tempering themselves. `iter_run()` and
+        `run_until_converged()` do not support tempering.
+    swap_every : int, optional
+        Defaults to 10.
+    checkpoint_dir : string, optional
+        For the 'multiprocessing' backend. A local directory to which `run()`
+        checkpoints every chain, every `checkpoint_every` iterations. A
+        checkpoint holds each runner pickled without its expensive state
+        (each expensive state is stored once, in a `state-<digest>` file as
+        in `cache_dir`, and linked from the state cache when possible),
+        along with the seeds of the remaining iterations. The files are
+        written by a background thread. An interrupted `run()` is continued
+        with `resume()`. A run holds a lock on the directory, so a second
+        run checkpointing to the same directory raises instead. Checkpoints
+        require `persistent` workers, which pickle the runners themselves.
+    checkpoint_every : int, optional
+        Defaults to 1000. The chains are synchronized at every checkpoint.
 
     layer : string
         The multyvac layer which has the datamicroscopes dependencies
@@ -79,6 +626,11 @@ class runner(object):
 
     Notes
     -----
+    With the 'multiprocessing' backend, runners whose expensive states have
+    the same digest share a single copy of the state, which the worker
+    processes inherit when they are forked rather than unpickling a private
+    copy per runner.
+
     To use the multyvac backend, you must first authenticate your machine (e.g.
     by running multyvac setup) beforehand.
 
@@ -90,11 +642,88 @@ class runner(object):
             raise ValueError("invalid backend: {}".format(backend))
         self._backend = backend
         if backend == 'multiprocessing':
-            validator.validate_kwargs(kwargs, ('processes',))
+            validator.validate_kwargs(
+                kwargs,
+                ('processes', 'persistent', 'cache_dir', 'cache_size',
+                 'schedule', 'slices', 'temperatures', 'swap_every',
+                 'checkpoint_dir', 'checkpoint_every',))
             if 'processes' not in kwargs:
                 kwargs['processes'] = mp.cpu_count()
             validator.validate_positive(kwargs['processes'], 'processes')
             self._processes = kwargs['processes']
+            self._persistent = bool(kwargs.get('persistent', False))
+            self._workers = None
+            self._stop = None
+            self._schedule = kwargs.get('schedule', 'static')
+            if self._schedule not in ('static', 'dynamic'):
+                raise ValueError(
+                    "invalid schedule: {}".format(self._schedule))
+            self._slices = kwargs.get('slices', 1)
+            validator.validate_positive(self._slices, 'slices')
+            if self._slices > 1 and self._schedule != 'dynamic':
+                raise ValueError("slices requires the dynamic schedule")
+            # seconds per iteration of each runner, measured by the dynamic
+            # scheduler
+            self._seconds = [None for _ in xrange(len(self._runners))]
+            if 'temperatures' in kwargs:
+                if not self._persistent:
+                    raise ValueError("temperatures require persistent workers")
+                betas = list(kwargs['temperatures'])
+                if len(betas) != len(self._runners):
+                    raise ValueError("need one temperature per runner")
+                if not all(0. < beta <= 1. for beta in betas):
+                    raise ValueError("temperatures must be in (0, 1]")
+                _check_tempered(self._runners)
+                self._betas = betas
+                self._swap_every = kwargs.get('swap_every', 10)
+                validator.validate_positive(self._swap_every, 'swap_every')
+                self._swap_round = 0
+                self._swaps = [[0, 0] for _ in xrange(len(betas) - 1)]
+            elif 'swap_every' in kwargs:
+                raise ValueError("swap_every requires temperatures")
+            else:
+                self._betas = None
+            if 'checkpoint_dir' in kwargs:
+                if not self._persistent:
+                    raise ValueError(
+                        "checkpoint_dir requires persistent workers")
+                self._writer = _checkpoint_writer(kwargs['checkpoint_dir'])
+                self._checkpoint_every = kwargs.get('checkpoint_every', 1000)
+                validator.validate_positive(
+                    self._checkpoint_every, 'checkpoint_every')
+            elif 'checkpoint_every' in kwargs:
+                raise ValueError("checkpoint_every requires a checkpoint_dir")
+            else:
+                self._writer = None
+            self._checkpoint_digests = None
+            if 'cache_size' in kwargs:
+                if 'cache_dir' not in kwargs:
+                    raise ValueError("cache_size requires a cache_dir")
+                validator.validate_positive(
+                    kwargs['cache_size'], 'cache_size')
+            if 'cache_dir' in kwargs:
+                self._cache = _state_cache(
+                    kwargs['cache_dir'], kwargs.get('cache_size', None))
+            else:
+                self._cache = None
+            # runners sharing the same expensive state (by digest) are
+            # handed a single copy, either inherited by the workers at fork
+            # or (without fork) loaded once per worker from the state cache
+            if _has_fork or self._cache is not None:
+                self._digests = _expensive_state_digests(self._runners)
+            else:
+                self._digests = [None for _ in xrange(len(self._runners))]
+            if self._cache is not None:
+                start = time.time()
+                for runner, digest in zip(self._runners, self._digests):
+                    if digest is None:
+                        continue
+                    if self._cache.put(digest, runner.expensive_state):
+                        _logger.info(
+                            "cached state-%s since not found", digest)
+                self._cache.evict(keep=self._digests)
+                _logger.info(
+                    "state caching took %f seconds", (time.time() - start))
         elif backend == 'multyvac':
             if not _has_multyvac:
                 raise ValueError("multyvac module not installed on machine")
@@ -113,6 +742,7 @@ class runner(object):
                     raise ValueError(
                         "no such volume: {}".format(self._volume))
 
+            self._stop = threading.Event()
             self._layer = kwargs['layer']
             if (not multyvac.config.api_key or
                     not multyvac.config.api_secret_key):
@@ -137,19 +767,7 @@ class runner(object):
                 self._digests = [None for _ in xrange(len(self._runners))]
                 return
 
-            # XXX(stephentu): we shouldn't reach in there like this
-            self._digests = []
-            digest_cache = {}
-            for runner in self._runners:
-                cache_key = id(runner.expensive_state)
-                if cache_key in digest_cache:
-                    digest = digest_cache[cache_key]
-                else:
-                    h = hashlib.sha1()
-                    runner.expensive_state_digest(h)
-                    digest = h.hexdigest()
-                    digest_cache[cache_key] = digest
-                self._digests.append(digest)
+            self._digests = _expensive_state_digests(self._runners)
 
             uploaded = set(_mvac_list_files_in_dir(volume, ""))
             _logger.info("starting state uploads")
@@ -162,8 +780,8 @@ class runner(object):
                 pickle.dump(runner.expensive_state, f)
                 f.flush()
                 # XXX(stephentu) this seems to fail for large files
-                #volume.put_file(f.name, 'state-{}'.format(digest))
-                volume.sync_up(f.name, 'state-{}'.format(digest))
+                #volume.put_file(f.name, _state_filename(digest))
+                volume.sync_up(f.name, _state_filename(digest))
                 f.close()
                 uploaded.add(digest)
             _logger.info("state upload took %f seconds", (time.time() - start))
@@ -183,15 +801,46 @@ class runner(object):
         """
         validator.validate_type(r, rng, param_name='r')
         validator.validate_positive(niters, param_name='niters')
-        if self._backend == 'multiprocessing':
-            pool = mp.Pool(processes=self._processes)
-            args = [(runner, niters, r.next(), None)
-                    for runner in self._runners]
-            # map_async() + get() allows us to workaround a bug where
-            # control-C doesn't kill multiprocessing workers
-            self._runners = pool.map_async(_mp_work, args).get(10000000)
-            pool.close()
-            pool.join()
+        if getattr(self, '_writer', None) is not None:
+            # the seed of each round is drawn up front, so a resumed run
+            # draws the same numbers
+            every = self._checkpoint_every
+            seeds = [r.next() for _ in xrange((niters + every - 1) // every)]
+            self._run_rounds(niters, 0, every, seeds)
+        else:
+            self._run(r, niters)
+
+    def _run(self, r, niters):
+        if (self._backend == 'multiprocessing' and self._persistent and
+                self._betas is not None):
+            self._mp_run_tempered(r, niters)
+        elif self._backend == 'multiprocessing' and self._persistent:
+            if self._workers is None:
+                self._mp_start_workers()
+            payloads = [[] for _ in self._workers]
+            for idx in xrange(len(self._runners)):
+                payloads[self._placement[idx]].append(
+                    (idx, niters, r.next()))
+            self._mp_command('run', payloads)
+        elif (self._backend == 'multiprocessing' and
+              self._schedule == 'dynamic'):
+            self._mp_run_dynamic(r, niters)
+        elif self._backend == 'multiprocessing':
+            states = self._mp_share_states()
+            try:
+                pool = mp.Pool(processes=self._processes)
+                args = [(runner, niters, r.next(), self._mp_statearg(digest))
+                        for runner, digest in zip(self._runners,
+                                                  self._digests)]
+                # map_async() + get() allows us to workaround a bug where
+                # control-C doesn't kill multiprocessing workers
+                runners = pool.map_async(_mp_work, args).get(10000000)
+                pool.close()
+                pool.join()
+            finally:
+                self._mp_unshare_states(self._runners, states)
+            self._mp_unshare_states(runners, states)
+            self._runners = runners
         elif self._backend == 'multyvac':
 
             # XXX(stephentu): the only parallelism strategy thus far is every
@@ -202,7 +851,8 @@ class runner(object):
             expensive_states = []
             for i, (runner, digest) in enumerate(zipped):
                 if has_volume:
-                    statearg = (self._volume, 'state-{}'.format(digest))
+                    statearg = ('multyvac', self._volume,
+                                _state_filename(digest))
                     expensive_states.append(runner.expensive_state)
                     runner.expensive_state = None
                 else:
@@ -226,7 +876,646 @@ class runner(object):
         else:
             assert False, 'should not be reached'
 
+    def _mp_costs(self):
+        """Returns the estimated time per iteration of each runner.
+        Measured times are only used once every runner has one, since they
+        are not comparable with the structural estimates.
+
+        """
+        if all(seconds is not None for seconds in self._seconds):
+            return list(self._seconds)
+        return [_cost_estimate(runner) for runner in self._runners]
+
+    def _mp_run_dynamic(self, r, niters):
+        nslices = min(self._slices, niters)
+        slices = [(i + 1) * niters // nslices - i * niters // nslices
+                  for i in xrange(nslices)]
+        # the seeds are drawn chain by chain, so the result does not depend
+        # on the order in which the slices complete
+        seeds = [[r.next() for _ in xrange(nslices)] for _ in self._runners]
+        costs = self._mp_costs()
+        remaining = [niters for _ in self._runners]
+        completed = [0 for _ in self._runners]
+        elapsed = [0. for _ in self._runners]
+
+        # each chain has at most one slice in flight; ready holds the chains
+        # whose next slice can be dispatched
+        ready = range(len(self._runners))
+        done = Queue.Queue()
+        states = self._mp_share_states()
+        runners = list(self._runners)
+        try:
+            pool = mp.Pool(processes=self._processes)
+            try:
+                # the results of the slices in flight, by chain
+                inflight = {}
+                while ready or inflight:
+                    ready.sort(key=lambda idx: -costs[idx] * remaining[idx])
+                    while ready and len(inflight) < self._processes:
+                        idx = ready.pop(0)
+                        k = completed[idx]
+                        args = (idx, runners[idx], slices[k], seeds[idx][k],
+                                self._mp_statearg(self._digests[idx]))
+                        inflight[idx] = pool.apply_async(
+                            _mp_task, (args,), callback=done.put)
+                    # the callback is not called when a slice fails outside
+                    # of _mp_task (e.g. the runner does not pickle), so the
+                    # results are polled in between. a timeout also allows
+                    # us to workaround a bug where control-C doesn't kill
+                    # multiprocessing workers
+                    try:
+                        idx, ok, ret, seconds = done.get(True, 1.0)
+                    except Queue.Empty:
+                        for result in inflight.itervalues():
+                            if result.ready() and not result.successful():
+                                result.get()
+                        continue
+                    del inflight[idx]
+                    if not ok:
+                        raise RuntimeError(
+                            "chain {} failed:\n{}".format(idx, ret))
+                    runners[idx] = ret
+                    elapsed[idx] += seconds
+                    remaining[idx] -= slices[completed[idx]]
+                    completed[idx] += 1
+                    if completed[idx] < nslices:
+                        ready.append(idx)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        finally:
+            self._mp_unshare_states(self._runners, states)
+        self._mp_unshare_states(runners, states)
+        self._runners = runners
+        self._seconds = [t / niters for t in elapsed]
+
+    def iter_run(self, r, niters=10000, every=1, snapshot=default_snapshot):
+        """Like `run()`, but yields `(chain, iteration, snapshot)` every
+        `every` iterations of each chain (and after its last iteration),
+        while the chains keep running. `iteration` counts from the start of
+        this call, and the tuples of different chains arrive interleaved, in
+        the order in which they were taken.
+
+        Parameters
+        ----------
+        r : rng
+        niters : int
+        every : int, optional
+        snapshot : function, optional
+            Maps a runner to its snapshot. It is called in the worker, so it
+            must be picklable (e.g. a module level function), and it should
+            return something small: each snapshot is sent to the parent. The
+            default is `default_snapshot()`, which only applies to latents
+            with assignments.
+
+        Notes
+        -----
+        The runners are only updated once the generator is exhausted; if it
+        is closed early, they are left as they were before the call (except
+        with persistent workers, where closing stops the resident chains
+        after their current chunk, and they keep the iterations they have
+        run). With the 'multiprocessing' backend, each chain draws a single
+        seed and runs its chunks off one random stream. The 'multyvac'
+        backend runs all the chains `every` iterations at a time through
+        `run()`, and takes the snapshots locally in between.
+
+        """
+        validator.validate_type(r, rng, param_name='r')
+        validator.validate_positive(niters, param_name='niters')
+        validator.validate_positive(every, param_name='every')
+        if getattr(self, '_betas', None) is not None:
+            raise ValueError("iter_run() does not support tempering")
+        if self._backend == 'multiprocessing' and self._persistent:
+            if self._workers is None:
+                self._mp_start_workers()
+            chains = [[] for _ in self._workers]
+            for idx in xrange(len(self._runners)):
+                chains[self._placement[idx]].append((idx, niters, r.next()))
+            payloads = [(c, every, snapshot) if c else None for c in chains]
+            self._stop.clear()
+            it = self._mp_iter_command('iter_run', payloads, [])
+            try:
+                for progress in it:
+                    yield progress
+            except GeneratorExit:
+                # closed early: stop the resident chains rather than
+                # waiting for them to complete their niters
+                self.stop()
+                raise
+            finally:
+                it.close()
+        elif self._backend == 'multiprocessing':
+            for progress in self._mp_iter_run(r, niters, every, snapshot):
+                yield progress
+        elif self._backend == 'multyvac':
+            self._stop.clear()
+            done = 0
+            while done < niters and not self._stop.is_set():
+                n = min(every, niters - done)
+                self.run(r, n)
+                done += n
+                for idx, runner in enumerate(self._runners):
+                    yield idx, done, snapshot(runner)
+        else:
+            assert False, 'should not be reached'
+
+    def _mp_run_tempered(self, r, niters):
+        if self._workers is None:
+            self._mp_start_workers()
+        prng = np.random.RandomState(r.next())
+        done = 0
+        while done < niters:
+            n = min(self._swap_every, niters - done)
+            payloads = [[] for _ in self._workers]
+            for idx in xrange(len(self._runners)):
+                payloads[self._placement[idx]].append(
+                    (idx, n, r.next(), self._betas[idx]))
+            scores = dict(self._mp_command('tempered', payloads))
+            done += n
+
+            # the replicas from the coldest to the hottest. the swap of the
+            # temperatures of replicas i and j is accepted with probability
+            # min(1, exp((beta_i - beta_j) * (L_j - L_i)))
+            ladder = sorted(xrange(len(self._runners)),
+                            key=lambda idx: -self._betas[idx])
+            for k in xrange(self._swap_round % 2, len(ladder) - 1, 2):
+                i, j = ladder[k], ladder[k + 1]
+                lg_alpha = ((self._betas[i] - self._betas[j]) *
+                            (scores[j] - scores[i]))
+                self._swaps[k][0] += 1
+                if lg_alpha >= 0. or np.log(prng.random_sample()) <= lg_alpha:
+                    self._betas[i], self._betas[j] = \
+                        self._betas[j], self._betas[i]
+                    self._swaps[k][1] += 1
+            self._swap_round += 1
+
+    def _run_rounds(self, niters, done, every, seeds):
+        """Runs the chains `every` iterations at a time, with one seed per
+        round, checkpointing after each round (if there is a
+        `checkpoint_dir`).
+
+        """
+        if self._writer is None:
+            for seed in seeds:
+                n = min(every, niters - done)
+                self._run(rng(seed), n)
+                done += n
+            return
+        with self._writer.locked():
+            self._checkpoint_states()
+            for k, seed in enumerate(seeds):
+                n = min(every, niters - done)
+                self._run(rng(seed), n)
+                done += n
+                self._checkpoint({
+                    'niters': niters,
+                    'done': done,
+                    'every': every,
+                    'seeds': seeds[k + 1:],
+                })
+            self._writer.flush()
+
+    def _get_checkpoint_digests(self):
+        if self._checkpoint_digests is None:
+            if all(digest is not None or runner.expensive_state is None
+                   for runner, digest in zip(self._runners, self._digests)):
+                self._checkpoint_digests = list(self._digests)
+            else:
+                self._checkpoint_digests = \
+                    _expensive_state_digests(self._runners)
+        return self._checkpoint_digests
+
+    def _checkpoint_states(self):
+        """Stores each expensive state (once) in the checkpoint directory"""
+        cache = _state_cache(self._writer.path)
+        for runner, digest in zip(self._runners,
+                                  self._get_checkpoint_digests()):
+            if digest is None or cache.contains(digest):
+                continue
+            if self._cache is not None and self._cache.contains(digest):
+                try:
+                    os.link(self._cache.path(digest), cache.path(digest))
+                    continue
+                except OSError:
+                    # e.g. on another filesystem
+                    pass
+            cache.put(digest, runner.expensive_state)
+
+    def _runner_blobs(self):
+        """Returns each runner pickled without its expensive state"""
+        if self._backend == 'multiprocessing' and self._workers is not None:
+            return self._mp_fetch('runners')
+        blobs = []
+        for runner in self._runners:
+            state = runner.expensive_state
+            runner.expensive_state = None
+            try:
+                blobs.append(pickle.dumps(runner, pickle.HIGHEST_PROTOCOL))
+            finally:
+                runner.expensive_state = state
+        return blobs
+
+    def _checkpoint(self, manifest):
+        tag = uuid.uuid4().hex
+        files = [('chain-{}-{}'.format(idx, tag), blob)
+                 for idx, blob in enumerate(self._runner_blobs())]
+        manifest['chains'] = [name for name, _ in files]
+        manifest['digests'] = self._get_checkpoint_digests()
+        if self._betas is not None:
+            manifest['tempering'] = {
+                'betas': list(self._betas),
+                'swaps': [list(p) for p in self._swaps],
+                'swap_round': self._swap_round,
+                'swap_every': self._swap_every,
+            }
+        self._writer.submit(
+            files, pickle.dumps(manifest, pickle.HIGHEST_PROTOCOL))
+
+    def resume(self, path):
+        """Continues the `run()` checkpointed in the directory `path`,
+        exactly where it stopped: the runners are replaced by the
+        checkpointed ones, and run for their remaining iterations with the
+        remaining seeds. If this runner has a `checkpoint_dir`, the
+        checkpointing goes on there (and `path` may be the same directory).
+
+        Expensive states are taken from this runner's runners when their
+        digests match the checkpointed ones, and are otherwise loaded from
+        the `state-<digest>` files of `path`.
+
+        """
+        if self._backend != 'multiprocessing':
+            raise ValueError("checkpoints require the multiprocessing backend")
+        if not self._persistent:
+            raise ValueError("checkpoints require persistent workers")
+        with open(os.path.join(path, _MANIFEST), 'rb') as fp:
+            manifest = pickle.load(fp)
+        if len(manifest['chains']) != len(self._runners):
+            raise ValueError("checkpoint has {} chains, expected {}".format(
+                len(manifest['chains']), len(self._runners)))
+
+        current = dict(zip(_expensive_state_digests(self._runners),
+                           (runner.expensive_state
+                            for runner in self._runners)))
+        current.pop(None, None)
+        cache = _state_cache(path)
+        runners = []
+        for name, digest in zip(manifest['chains'], manifest['digests']):
+            with open(os.path.join(path, name), 'rb') as fp:
+                runner = pickle.load(fp)
+            if digest is not None:
+                if digest not in current:
+                    current[digest] = cache.get(digest)
+                runner.expensive_state = current[digest]
+            runners.append(runner)
+
+        tempering = manifest.get('tempering')
+        if tempering is not None:
+            _check_tempered(runners)
+        elif self._betas is not None:
+            raise ValueError("the checkpoint is not tempered")
+
+        if self._cache is not None:
+            for runner, digest in zip(runners, manifest['digests']):
+                if digest is not None:
+                    self._cache.put(digest, runner.expensive_state)
+
+        # the resident workers (if any) hold the old runners
+        self.close()
+        self._runners = runners
+        if _has_fork or self._cache is not None:
+            self._digests = list(manifest['digests'])
+        self._checkpoint_digests = list(manifest['digests'])
+        self._seconds = [None for _ in self._runners]
+        if tempering is not None:
+            self._betas = tempering['betas']
+            self._swaps = tempering['swaps']
+            self._swap_round = tempering['swap_round']
+            self._swap_every = tempering['swap_every']
+        self._run_rounds(manifest['niters'], manifest['done'],
+                         manifest['every'], manifest['seeds'])
+
+    def temperatures(self):
+        """Returns the current inverse temperature of each runner (with the
+        `temperatures` kwarg).
+
+        """
+        if getattr(self, '_betas', None) is None:
+            raise ValueError("not a tempered runner")
+        return list(self._betas)
+
+    def swap_stats(self):
+        """Returns a list with one dict per pair of adjacent rungs of the
+        temperature ladder, from the coldest: the inverse temperatures
+        `betas` of the pair, and its number of swap `attempts`, of
+        `accepted` swaps, and its `acceptance` rate.
+
+        """
+        if getattr(self, '_betas', None) is None:
+            raise ValueError("not a tempered runner")
+        betas = sorted(self._betas, reverse=True)
+        ret = []
+        for k, (attempts, accepted) in enumerate(self._swaps):
+            ret.append({
+                'betas': (betas[k], betas[k + 1]),
+                'attempts': attempts,
+                'accepted': accepted,
+                'acceptance': float(accepted) / attempts if attempts else 0.,
+            })
+        return ret
+
+    def stop(self):
+        """Asks the chains of the running `iter_run()` (if any) to stop
+        after their current chunk. The generator then ends as if the chains
+        had run for their `niters`, and the runners are updated.
+
+        """
+        if self._stop is not None:
+            self._stop.set()
+
+    def run_until_converged(self, r, summaries, max_iters=10000, every=10,
+                            rhat=1.01, min_ess=400, max_seconds=None):
+        """Runs the chains until the given scalar summaries have mixed
+        across the chains, or `max_iters` or `max_seconds` run out.
+
+        Every `every` iterations, each chain reports `summaries(runner)`,
+        a tuple of floats (e.g. the number of groups, the joint score, or a
+        hyperparameter), taken in the workers as in `iter_run()`. Once the
+        chains have all reported, the split-Rhat and the effective sample
+        size of each summary are computed over the latter half of the
+        reports (the first half being treated as burnin; see
+        `microscopes.kernels.convergence`), and all the chains
+        are stopped once every summary has an Rhat of at most `rhat` and an
+        ESS of at least `min_ess`.
+
+        Parameters
+        ----------
+        r : rng
+        summaries : function
+            Maps a runner to a tuple of floats. It must be picklable.
+        max_iters : int, optional
+        every : int, optional
+        rhat : float, optional
+        min_ess : float, optional
+        max_seconds : float, optional
+            A time budget. The chains are stopped once it runs out.
+
+        Notes
+        -----
+        The chains must run side by side: with the non-persistent
+        'multiprocessing' backend, this needs at least one process per chain
+        (resident workers interleave their chains instead).
+
+        Returns
+        -------
+        diagnostics : dict
+            With the number of iterations run by each chain (`niters`), the
+            wall time (`seconds`), whether the thresholds were met
+            (`converged`), and the last `rhat` and `ess` of each summary
+            (None if there were too few reports).
+
+        """
+        if rhat <= 1.:
+            raise ValueError("rhat must be greater than 1")
+        validator.validate_nonnegative(min_ess, param_name='min_ess')
+        if max_seconds is not None:
+            validator.validate_positive(max_seconds, param_name='max_seconds')
+        if getattr(self, '_betas', None) is not None:
+            raise ValueError(
+                "run_until_converged() does not support tempering")
+        if (self._backend == 'multiprocessing' and not self._persistent and
+                self._processes < len(self._runners)):
+            warnings.warn("fewer processes than chains: the chains will not "
+                          "be compared until the first ones have finished")
+        traces = [[] for _ in self._runners]
+        iters = [0 for _ in self._runners]
+        start = time.time()
+        stopped = False
+        converged = False
+        rhats = esses = None
+        for idx, it, summary in self.iter_run(
+                r, niters=max_iters, every=every, snapshot=summaries):
+            traces[idx].append(np.atleast_1d(summary))
+            iters[idx] = it
+            if stopped:
+                continue
+            n = min(len(trace) for trace in traces)
+            if len(traces[idx]) == n and n >= 8:
+                # the chains report in lockstep, so a check is made as soon
+                # as the slowest chain has reported
+                draws = np.array([trace[n // 2:n] for trace in traces],
+                                 dtype=np.float64)
+                rhats = [convergence.split_rhat(draws[:, :, i])
+                         for i in xrange(draws.shape[2])]
+                esses = [convergence.ess(draws[:, :, i])
+                         for i in xrange(draws.shape[2])]
+                converged = (max(rhats) <= rhat and min(esses) >= min_ess)
+            timeout = (max_seconds is not None and
+                       time.time() - start > max_seconds)
+            if converged or timeout:
+                _logger.info("stopping the chains after %d iterations: %s",
+                             n * every, 'converged' if converged else
+                             'out of time')
+                self.stop()
+                stopped = True
+        return {
+            'niters': iters,
+            'seconds': time.time() - start,
+            'converged': converged,
+            'rhat': rhats,
+            'ess': esses,
+        }
+
+    def _mp_iter_run(self, r, niters, every, snapshot):
+        # a manager queue can be handed to the pool tasks, unlike a plain
+        # multiprocessing queue
+        manager = mp.Manager()
+        progress = manager.Queue()
+        self._stop = manager.Event()
+        states = self._mp_share_states()
+        runners = list(self._runners)
+        try:
+            pool = mp.Pool(processes=self._processes)
+            try:
+                for idx, digest in enumerate(self._digests):
+                    args = (idx, runners[idx], niters, every, r.next(),
+                            self._mp_statearg(digest), snapshot, progress,
+                            self._stop)
+                    pool.apply_async(_mp_iter_work, (args,))
+                pending = len(runners)
+                while pending:
+                    # a timeout allows us to workaround a bug where control-C
+                    # doesn't kill multiprocessing workers
+                    idx, kind, ret = progress.get(True, 10000000)
+                    if kind == 'snapshot':
+                        yield (idx,) + ret
+                    elif kind == 'done':
+                        runners[idx] = ret
+                        pending -= 1
+                    else:
+                        raise RuntimeError(
+                            "chain {} failed:\n{}".format(idx, ret))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        finally:
+            self._mp_unshare_states(self._runners, states)
+            self._stop = None
+            manager.shutdown()
+        self._mp_unshare_states(runners, states)
+        self._runners = runners
+
+    def _mp_statearg(self, digest):
+        if digest is None:
+            return None
+        # the states in memory are inherited at fork, which beats reading
+        # them back from the cache
+        if _has_fork or self._cache is None:
+            return ('shared', digest)
+        return ('local', self._cache.path(digest))
+
+    def _mp_share_states(self):
+        """Moves the expensive states off the runners and into
+        `_mp_shared_states`, so that forked workers inherit them. Returns the
+        original states, to be handed to `_mp_unshare_states()`.
+
+        """
+        states = [runner.expensive_state for runner in self._runners]
+        for runner, digest in zip(self._runners, self._digests):
+            if digest is None:
+                continue
+            _mp_shared_states.setdefault(digest, runner.expensive_state)
+            runner.expensive_state = None
+        return states
+
+    def _mp_unshare_states(self, runners, states):
+        for runner, state in zip(runners, states):
+            runner.expensive_state = state
+        for digest in self._digests:
+            _mp_shared_states.pop(digest, None)
+
+    def _mp_start_workers(self):
+        nworkers = min(self._processes, len(self._runners))
+        self._placement = _lpt_placement(self._mp_costs(), nworkers)
+        self._results = mp.Queue()
+        self._stop = mp.Event()
+        self._workers = []
+        states = self._mp_share_states()
+        try:
+            for wid in xrange(nworkers):
+                resident = {idx: runner
+                            for idx, runner in enumerate(self._runners)
+                            if self._placement[idx] == wid}
+                stateargs = {idx: self._mp_statearg(self._digests[idx])
+                             for idx in resident}
+                commands = mp.Queue()
+                proc = mp.Process(
+                    target=_mp_resident_main,
+                    args=(wid, resident, stateargs, commands, self._results,
+                          self._stop))
+                proc.daemon = True
+                proc.start()
+                self._workers.append((proc, commands))
+        finally:
+            self._mp_unshare_states(self._runners, states)
+
+    def _mp_command(self, cmd, payloads):
+        """Sends `cmd` to every worker with a non-empty payload, and waits
+        for all of them to reply. Returns the concatenated replies.
+
+        """
+        replies = []
+        for _ in self._mp_iter_command(cmd, payloads, replies):
+            pass
+        return replies
+
+    def _mp_iter_command(self, cmd, payloads, replies):
+        """Generator version of `_mp_command()`, which yields the progress
+        messages of the workers as they arrive, and extends `replies`.
+
+        """
+        pending = set()
+        for wid, payload in enumerate(payloads):
+            if not payload:
+                continue
+            self._workers[wid][1].put((cmd, payload))
+            pending.add(wid)
+        errors = []
+        closed = False
+        while pending:
+            try:
+                wid, ok, ret = self._results.get(True, 1.0)
+            except Queue.Empty:
+                for wid in pending:
+                    if not self._workers[wid][0].is_alive():
+                        raise RuntimeError(
+                            "resident worker {} died".format(wid))
+                continue
+            if ok is None:
+                if not closed:
+                    try:
+                        yield ret
+                    except GeneratorExit:
+                        # the workers still have to be waited on, so that
+                        # their replies do not leak into the next command
+                        closed = True
+                continue
+            pending.remove(wid)
+            if ok:
+                if ret is not None:
+                    replies.extend(ret)
+            else:
+                errors.append(ret)
+        if errors:
+            raise RuntimeError(
+                "resident worker failed:\n{}".format(errors[0]))
+
+    def _mp_fetch(self, cmd):
+        payloads = [[] for _ in self._workers]
+        for idx, wid in enumerate(self._placement):
+            payloads[wid].append(idx)
+        return [ret for _, ret in sorted(self._mp_command(cmd, payloads))]
+
+    def close(self):
+        """Shuts down the resident worker processes (if any), after fetching
+        the runners back from them (as in `get_runners()`), so that a later
+        `run()` carries on from where the workers were.
+
+        """
+        if self._backend != 'multiprocessing' or self._workers is None:
+            return
+        try:
+            self.get_runners()
+        finally:
+            # the workers are stopped even if they could not be fetched from
+            for proc, commands in self._workers:
+                commands.put(('stop', None))
+            for proc, _ in self._workers:
+                proc.join()
+            self._workers = None
+
+    def get_runners(self):
+        """Returns the list of runners. With resident workers, the runners
+        are first fetched back from the worker processes (they also remain
+        resident in the workers).
+
+        """
+        if self._backend == 'multiprocessing' and self._workers is not None:
+            states = [runner.expensive_state for runner in self._runners]
+            blobs = self._mp_fetch('runners')
+            self._runners = [pickle.loads(blob) for blob in blobs]
+            for runner, state in zip(self._runners, states):
+                runner.expensive_state = state
+        return list(self._runners)
+
     def get_latents(self):
         """Returns a list of the current state of each of the runners.
         """
+        if self._backend == 'multiprocessing' and self._workers is not None:
+            return self._mp_fetch('latents')
         return [runner.get_latent() for runner in self._runners]
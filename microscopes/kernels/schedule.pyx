@@ -0,0 +1,196 @@
+# cython: embedsignature=True
+
+
+# cimports
+from libcpp.vector cimport vector
+from libcpp.utility cimport pair
+from libc.stddef cimport size_t
+
+from microscopes.kernels._schedule_h cimport (
+    schedule as c_schedule,
+    entry_t,
+    kernel_t,
+    ASSIGN,
+    ASSIGN_RESAMPLE,
+    GIBBS_HP,
+    SLICE_HP,
+    SLICE_THETA,
+)
+from microscopes.kernels.gibbs cimport grid, _build_grids
+from microscopes.kernels.slice cimport (
+    hp_plan,
+    theta_plan,
+    _build_hp_params,
+    _build_theta_params,
+)
+from microscopes.common._entity_state cimport entity_based_state_object
+from microscopes.common._entity_state_h cimport (
+    entity_based_state_object as c_entity_based_state_object,
+)
+from microscopes.common._rng cimport rng
+from microscopes.common._random_fwd_h cimport rng_t
+from microscopes._models_h cimport hypers_shared_ptr
+
+# python imports
+from microscopes.common import validator
+
+
+_kernels = {
+    'assign': ASSIGN,
+    'assign_resample': ASSIGN_RESAMPLE,
+    'gibbs_hp': GIBBS_HP,
+    'slice_hp': SLICE_HP,
+    'slice_theta': SLICE_THETA,
+}
+
+
+cdef class schedule:
+    """A sequence of kernels which is validated and converted to native
+    structures once, and can then be run for many sweeps in a single native
+    call (with the GIL released).
+
+    Parameters
+    ----------
+    s : entity based state object
+        The state the schedule will be run against. It is only used to
+        resolve the `gibbs_hp` grids.
+    kernels : list
+        A list of `(name, config)` or `(name, config, every)` tuples. The
+        kernel is run on every sweep which is a multiple of `every` (which
+        defaults to 1). The valid names and their configs are:
+
+          'assign'          : {}
+          'assign_resample' : {'m': m}
+          'gibbs_hp'        : the params of `gibbs.hp()`, or a
+                              precompiled `gibbs.grid`
+          'slice_hp'        : {'cparam': ..., 'hparams': ...}, as in
+                              `slice.hp()`, or a `slice.hp_plan`
+          'slice_theta'     : {'tparams': ...}, as in `slice.theta()`,
+                              or a `slice.theta_plan`
+
+    A plan is shared with the schedule: the widths it adapts and the draw
+    stats it gathers during `run()` are written back to the plan (see
+    `hp_plan.stats()`).
+
+    example invocation:
+
+    sched = schedule(s, [
+        ('assign', {}),
+        ('gibbs_hp', {0: {'hpdf': ..., 'hgrid': ...}}, 5),
+        ('slice_theta', {'tparams': {0: {'p': 0.1}}}, 10),
+    ])
+    sched.run(s, r, 1000)
+    print sched.timings()
+    """
+
+    cdef c_schedule _thisobj
+    cdef vector[hypers_shared_ptr] _ptrs
+    cdef list _grids
+    cdef list _names
+    # (index, plan) of the entries built from a slice plan
+    cdef list _plans
+
+    def __cinit__(self, entity_based_state_object s, kernels):
+        self._grids = []
+        self._names = []
+        self._plans = []
+        cdef entry_t e
+        for kernel in kernels:
+            if len(kernel) == 2:
+                name, config = kernel
+                every = 1
+            else:
+                name, config, every = kernel
+            if name not in _kernels:
+                raise ValueError("invalid kernel: {}".format(name))
+            validator.validate_positive(every, "every")
+            e = entry_t()
+            e.kernel_ = _kernels[name]
+            e.every_ = every
+            if name == 'assign':
+                if config:
+                    raise ValueError("assign does not take a config")
+            elif name == 'assign_resample':
+                validator.validate_kwargs(config, ('m',))
+                validator.validate_positive(config['m'], "m")
+                e.m_ = config['m']
+            elif name == 'gibbs_hp' and isinstance(config, grid):
+                # the grid owns the hypers: keep it alive with the schedule
+                e.grid_ = (<grid>config)._grid
+                self._grids.append(config)
+            elif name == 'gibbs_hp':
+                _build_grids(s, config, e.grid_, self._ptrs)
+            elif name == 'slice_hp' and isinstance(config, hp_plan):
+                self._plans.append((len(self._names), config))
+            elif name == 'slice_hp':
+                validator.validate_kwargs(config, ('cparam', 'hparams',))
+                _build_hp_params(
+                    config.get('cparam', {}),
+                    config.get('hparams', {}),
+                    e.cparams_,
+                    e.hparams_)
+            elif name == 'slice_theta' and isinstance(config, theta_plan):
+                self._plans.append((len(self._names), config))
+            elif name == 'slice_theta':
+                validator.validate_kwargs(config, ('tparams',))
+                _build_theta_params(config.get('tparams', {}), e.tparams_)
+            self._thisobj.add(e)
+            self._names.append(name)
+
+    def run(self, entity_based_state_object s, rng r, int niters=1):
+        validator.validate_not_none(r, "r")
+        validator.validate_positive(niters, "niters")
+        cdef c_entity_based_state_object *px = s.raw_px()
+        cdef rng_t *pr = r._thisptr
+        self._load_plans()
+        try:
+            with nogil:
+                self._thisobj.run(px[0], pr[0], niters)
+        finally:
+            self._store_plans()
+
+    cdef _load_plans(self):
+        # the plans may have been adapted (e.g. by slice.hp()) since the
+        # last run
+        cdef entry_t *e
+        for i, plan in self._plans:
+            e = &self._thisobj.entry(i)
+            if isinstance(plan, hp_plan):
+                e.cparams_ = (<hp_plan>plan)._cparam
+                e.hparams_ = (<hp_plan>plan)._hparams
+            else:
+                e.tparams_ = (<theta_plan>plan)._tparams
+
+    cdef _store_plans(self):
+        # hands the adapted widths and the draw stats back to the plans
+        cdef entry_t *e
+        for i, plan in self._plans:
+            e = &self._thisobj.entry(i)
+            if isinstance(plan, hp_plan):
+                (<hp_plan>plan)._cparam = e.cparams_
+                (<hp_plan>plan)._hparams = e.hparams_
+            else:
+                (<theta_plan>plan)._tparams = e.tparams_
+
+    def nsweeps(self):
+        return self._thisobj.nsweeps()
+
+    def timings(self):
+        """Returns, for each kernel in the schedule, a dict with the kernel
+        name, the number of times it was run, and the total wall time spent
+        in it (in seconds).
+
+        """
+        cdef const vector[entry_t] *entries = &self._thisobj.entries()
+        ret = []
+        for i, name in enumerate(self._names):
+            ret.append({
+                'kernel': name,
+                'every': entries[0][i].every_,
+                'ncalls': entries[0][i].ncalls_,
+                'seconds': entries[0][i].seconds_,
+            })
+        return ret
+
+    def reset_timings(self):
+        self._thisobj.reset_timings()
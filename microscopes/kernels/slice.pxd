@@ -0,0 +1,30 @@
+from libcpp.vector cimport vector
+
+from microscopes.kernels._slice_h cimport (
+    interval_t,
+    slice_hp_param_t,
+    slice_hp_t,
+    slice_theta_t,
+)
+
+cdef class hp_plan:
+    cdef vector[slice_hp_param_t] _cparam
+    cdef vector[slice_hp_t] _hparams
+
+
+cdef class theta_plan:
+    cdef vector[slice_theta_t] _tparams
+
+
+cdef int _build_hp_params(object,
+                          object,
+                          vector[slice_hp_param_t] &,
+                          vector[slice_hp_t] &,
+                          interval_t interval=*,
+                          size_t nadapt=*,
+                          bint joint=*) except -1
+
+cdef int _build_theta_params(object,
+                             vector[slice_theta_t] &,
+                             interval_t interval=*,
+                             size_t nadapt=*) except -1
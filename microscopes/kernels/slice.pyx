@@ -15,11 +15,21 @@ from microscopes.kernels._slice_h cimport (
     slice_hp_t,
     slice_theta_param_t,
     slice_theta_t,
+    draw_stats_t,
+    interval_t,
+    STEPPING_OUT,
+    DOUBLING,
     sample_1d as c_sample_1d,
 )
 from microscopes.common._entity_state cimport entity_based_state_object
+from microscopes.common._entity_state_h cimport (
+    entity_based_state_object as c_entity_based_state_object,
+)
 from microscopes.common._scalar_functions cimport scalar_function
 from microscopes.common._rng cimport rng
+from microscopes.common._random_fwd_h cimport rng_t
+from microscopes.kernels._stats_h cimport kernel_stats_t
+from microscopes.kernels.stats cimport kernel_stats
 
 # python imports
 from microscopes.common import validator
@@ -35,13 +45,194 @@ def _parse_descriptor(desc, default=None):
     return m.group(1), int(m.group(2))
 
 
-def sample(scalar_function func, float x0, float w, rng r):
+_intervals = {'stepping_out': STEPPING_OUT, 'doubling': DOUBLING}
+
+
+def _parse_interval(interval):
+    if interval not in _intervals:
+        raise ValueError(
+            "interval must be one of {}".format(sorted(_intervals.keys())))
+    return _intervals[interval]
+
+
+cdef slice_hp_param_t _build_hp_param(update_descs,
+                                      prior,
+                                      w,
+                                      interval_t interval=STEPPING_OUT,
+                                      size_t nadapt=0,
+                                      bint joint=False) except *:
+    cdef vector[slice_update_param_t] updates
+    if not hasattr(update_descs, '__iter__'):
+        update_descs = [update_descs]
+    for update_desc in update_descs:
+        key, idx = _parse_descriptor(update_desc, default=0)
+        updates.push_back(slice_update_param_t(key, idx))
+    validator.validate_type(prior, scalar_function)
+    validator.validate_positive(w)
+    return slice_hp_param_t(
+        updates, (<scalar_function>prior)._func, w, interval, nadapt, joint)
+
+
+cdef int _build_hp_params(cparam,
+                          hparams,
+                          vector[slice_hp_param_t] &c_cparam,
+                          vector[slice_hp_t] &c_hparams,
+                          interval_t interval=STEPPING_OUT,
+                          size_t nadapt=0,
+                          bint joint=False) except -1:
+    cdef vector[slice_hp_param_t] buf0
+    for update_descs, (prior, w) in cparam.iteritems():
+        c_cparam.push_back(_build_hp_param(
+            update_descs, prior, w, interval, nadapt, joint))
+    for fi, hparam in hparams.iteritems():
+        buf0.clear()
+        for update_descs, (prior, w) in hparam.iteritems():
+            buf0.push_back(_build_hp_param(
+                update_descs, prior, w, interval, nadapt, joint))
+        c_hparams.push_back(slice_hp_t(fi, buf0))
+    return 0
+
+
+cdef int _build_theta_params(tparams,
+                             vector[slice_theta_t] &c_tparams,
+                             interval_t interval=STEPPING_OUT,
+                             size_t nadapt=0) except -1:
+    cdef vector[slice_theta_param_t] buf0
+    for fi, params in tparams.iteritems():
+        buf0.clear()
+        for k, w in params.iteritems():
+            validator.validate_positive(w)
+            buf0.push_back(slice_theta_param_t(k, w, interval, nadapt))
+        c_tparams.push_back(slice_theta_t(fi, buf0))
+    return 0
+
+
+cdef dict _draw_stats(float w, draw_stats_t &stats):
+    return {
+        'w': w,
+        'ndraws': stats.ndraws_,
+        'nadapted': stats.nadapted_,
+        'nevals': stats.nevals_,
+        'nevals_per_draw':
+            float(stats.nevals_) / stats.ndraws_ if stats.ndraws_ else 0.,
+    }
+
+
+cdef class hp_plan:
+    """A precompiled set of `hp()` update descriptors. The descriptors are
+    parsed and validated once, so calling `hp()` with a plan goes straight
+    into the native loop.
+
+    Parameters
+    ----------
+    cparam : dict, optional
+    hparams : dict, optional
+        Same format as the arguments of `hp()`.
+    interval : {'stepping_out', 'doubling'}, optional
+        The procedure used to find the slice interval. Doubling needs far
+        fewer evaluations when the given step widths are much too small.
+    nadapt : int, optional
+        If positive, the step width of each parameter is set to the mean
+        width of the final slice brackets over its first `nadapt` draws, and
+        then held fixed. Since the width changes, these draws should be
+        discarded as burnin. The widths of the parameters moved jointly are
+        not adapted.
+    joint : bool, optional
+        If True, the coordinates of each tuple descriptor, such as
+        ``('alpha', 'beta')``, are moved together by a hyperrectangle slice
+        draw (with side `w` in each coordinate), instead of one coordinate at
+        a time. This needs far fewer score evaluations per effective sample
+        for correlated hyperparameters. `interval` does not apply to these.
+
+    Notes
+    -----
+    The adapted widths and the draw statistics live in the plan, so a plan
+    should be reused across calls (and not shared between chains).
+
+    """
+
+    def __cinit__(self, cparam={}, hparams={},
+                  interval='stepping_out', int nadapt=0, joint=False):
+        validator.validate_nonnegative(nadapt, "nadapt")
+        _build_hp_params(cparam, hparams, self._cparam, self._hparams,
+                         _parse_interval(interval), nadapt, joint)
+
+    def stats(self):
+        """Returns a list with one dict per parameter: its `component`
+        ('cluster' or the feature id), its `updates`, its current step width
+        `w`, and the number of draws, of draws the width was adapted on and
+        of score evaluations so far.
+
+        """
+        cdef size_t i, j
+        ret = []
+        for i in xrange(self._cparam.size()):
+            d = _draw_stats(self._cparam[i].w_, self._cparam[i].stats_)
+            d['component'] = 'cluster'
+            d['updates'] = [(u.key_, u.index_)
+                            for u in self._cparam[i].updates_]
+            ret.append(d)
+        for i in xrange(self._hparams.size()):
+            for j in xrange(self._hparams[i].params_.size()):
+                d = _draw_stats(self._hparams[i].params_[j].w_,
+                                self._hparams[i].params_[j].stats_)
+                d['component'] = self._hparams[i].index_
+                d['updates'] = [(u.key_, u.index_)
+                                for u in self._hparams[i].params_[j].updates_]
+                ret.append(d)
+        return ret
+
+
+cdef class theta_plan:
+    """A precompiled set of `theta()` descriptors (see `hp_plan`).
+
+    Parameters
+    ----------
+    tparams : dict, optional
+        Same format as the argument of `theta()`.
+    interval : {'stepping_out', 'doubling'}, optional
+    nadapt : int, optional
+        See `hp_plan`. A theta parameter shares one step width across all
+        the groups it is sampled in.
+
+    """
+
+    def __cinit__(self, tparams={}, interval='stepping_out', int nadapt=0):
+        validator.validate_nonnegative(nadapt, "nadapt")
+        _build_theta_params(tparams, self._tparams,
+                            _parse_interval(interval), nadapt)
+
+    def stats(self):
+        """Returns a list with one dict per parameter: its `component`, its
+        `key`, its current step width `w`, and the number of draws, of draws
+        the width was adapted on and of score evaluations so far.
+
+        """
+        cdef size_t i, j
+        ret = []
+        for i in xrange(self._tparams.size()):
+            for j in xrange(self._tparams[i].params_.size()):
+                d = _draw_stats(self._tparams[i].params_[j].w_,
+                                self._tparams[i].params_[j].stats_)
+                d['component'] = self._tparams[i].index_
+                d['key'] = self._tparams[i].params_[j].key_
+                ret.append(d)
+        return ret
+
+
+def sample(scalar_function func, float x0, float w, rng r,
+           interval='stepping_out'):
     validator.validate_not_none(r, "r")
-    return c_sample_1d(func._func, x0, w, r._thisptr[0])
+    return c_sample_1d(func._func, x0, w, r._thisptr[0],
+                       10000, 100, _parse_interval(interval))
 
 
-def hp(entity_based_state_object s, rng r, cparam={}, hparams={}):
+def hp(entity_based_state_object s, rng r, cparam={}, hparams={}, int niters=1,
+       hp_plan plan=None, kernel_stats stats=None):
     """
+    Runs `niters` sweeps natively, with the GIL released. Instead of
+    `cparam` and `hparams`, a precompiled `hp_plan` can be given as `plan`.
+    The slice counters are accumulated into `stats`, if given.
 
     example invocation:
 
@@ -57,56 +248,47 @@ def hp(entity_based_state_object s, rng r, cparam={}, hparams={}):
     hp(s, None, hparams, r)
     """
     validator.validate_not_none(r, "r")
+    validator.validate_positive(niters, "niters")
 
-    cdef vector[slice_hp_param_t] c_cparam
-    cdef vector[slice_hp_t] c_hparams
+    if plan is None:
+        plan = hp_plan(cparam, hparams)
+    elif cparam or hparams:
+        raise ValueError("cannot give both a plan and descriptors")
 
-    cdef vector[slice_hp_param_t] buf0
-    cdef vector[slice_update_param_t] buf1
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = NULL
+    if stats is not None:
+        ps = &stats._thisobj
+    with nogil:
+        c_hp(px[0], plan._cparam, plan._hparams, pr[0], niters, ps)
 
-    for update_descs, (prior, w) in cparam.iteritems():
-        if not hasattr(update_descs, '__iter__'):
-            update_descs = [update_descs]
-        buf1.clear()
-        for update_desc in update_descs:
-            key, idx = _parse_descriptor(update_desc, default=0)
-            buf1.push_back(slice_update_param_t(key, idx))
-        validator.validate_type(prior, scalar_function)
-        validator.validate_positive(w)
-        c_cparam.push_back(
-            slice_hp_param_t(
-                buf1,
-                (<scalar_function>prior)._func,
-                w))
-
-    for fi, hparam in hparams.iteritems():
-        buf0.clear()
-        for update_descs, (prior, w) in hparam.iteritems():
-            if not hasattr(update_descs, '__iter__'):
-                update_descs = [update_descs]
-            buf1.clear()
-            for update_desc in update_descs:
-                key, idx = _parse_descriptor(update_desc, default=0)
-                buf1.push_back(slice_update_param_t(key, idx))
-            validator.validate_type(prior, scalar_function)
-            validator.validate_positive(w)
-            buf0.push_back(
-                slice_hp_param_t(
-                    buf1,
-                    (<scalar_function>prior)._func,
-                    w))
-        c_hparams.push_back(slice_hp_t(fi, buf0))
 
-    c_hp(s._thisptr.get()[0], c_cparam, c_hparams, r._thisptr[0])
+def theta(entity_based_state_object s, rng r, tparams={}, int niters=1,
+          theta_plan plan=None, int nthreads=1, kernel_stats stats=None):
+    """
+    Runs `niters` sweeps natively, with the GIL released. Instead of
+    `tparams`, a precompiled `theta_plan` can be given as `plan`.
 
+    With `nthreads` > 1, the groups are split across `nthreads` threads,
+    each with its own random stream, and the draws left to adapt the step
+    widths on are split across the threads. The state must then support
+    concurrent `score_likelihood()` and suffstats mutator calls on distinct
+    groups. The result is reproducible for a fixed seed and `nthreads`.
 
-def theta(entity_based_state_object s, rng r, tparams={}):
+    The slice counters are accumulated into `stats`, if given.
+    """
     validator.validate_not_none(r, "r")
-    cdef vector[slice_theta_t] c_tparams
-    cdef vector[slice_theta_param_t] buf0
-    for fi, params in tparams.iteritems():
-        buf0.clear()
-        for k, w in params.iteritems():
-            buf0.push_back(slice_theta_param_t(k, w))
-        c_tparams.push_back(slice_theta_t(fi, buf0))
-    c_theta(s._thisptr.get()[0], c_tparams, r._thisptr[0])
+    validator.validate_positive(niters, "niters")
+    validator.validate_positive(nthreads, "nthreads")
+    if plan is None:
+        plan = theta_plan(tparams)
+    elif tparams:
+        raise ValueError("cannot give both a plan and descriptors")
+    cdef c_entity_based_state_object *px = s.raw_px()
+    cdef rng_t *pr = r._thisptr
+    cdef kernel_stats_t *ps = NULL
+    if stats is not None:
+        ps = &stats._thisobj
+    with nogil:
+        c_theta(px[0], plan._tparams, pr[0], niters, nthreads, ps)
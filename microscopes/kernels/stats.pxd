@@ -0,0 +1,4 @@
+from microscopes.kernels._stats_h cimport kernel_stats_t
+
+cdef class kernel_stats:
+    cdef kernel_stats_t _thisobj
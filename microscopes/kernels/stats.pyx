@@ -0,0 +1,78 @@
+# cython: embedsignature=True
+
+
+# cython imports
+from libc.stddef cimport size_t
+
+from microscopes.kernels._stats_h cimport (
+    kernel_stats_t,
+    phase_t,
+    phase_name,
+    NPHASES,
+)
+
+# python imports
+import numpy as np
+
+
+cdef class kernel_stats:
+    """Counters filled in by the kernels which take a `stats` argument
+    (`gibbs.assign`, `gibbs.assign_resample`, `gibbs.hp`, `slice.hp` and
+    `slice.theta`). The counters accumulate across calls until `reset()`.
+    Kernels called without a `stats` object collect nothing.
+
+    The counters are:
+
+    * `<phase>_seconds` and `<phase>_calls`, the wall time spent in (and the
+      number of calls to) each phase of the kernels: `remove_value`,
+      `inplace_score_value`, `score_likelihood`, `sample_discrete_log`,
+      `add_value`, `create_group` and `delete_group`
+    * `score_evals`, the number of model score evaluations
+    * `stepping_out`, the number of slice interval expansions (or doublings)
+    * `shrinks`, the number of slice bracket shrinks
+    * `max_iters`, the number of times a slice iteration limit was hit
+
+    """
+
+    def reset(self):
+        self._thisobj.reset()
+
+    def merge(self, kernel_stats that):
+        self._thisobj.merge(that._thisobj)
+
+    @staticmethod
+    def fields():
+        """The names of the counters, in the order of `as_array()`"""
+        cdef int i
+        names = []
+        for i in xrange(NPHASES):
+            names.append(phase_name(<phase_t>i) + '_seconds')
+        for i in xrange(NPHASES):
+            names.append(phase_name(<phase_t>i) + '_calls')
+        names.extend(['score_evals', 'stepping_out', 'shrinks', 'max_iters'])
+        return names
+
+    def as_array(self):
+        cdef int i
+        values = []
+        for i in xrange(NPHASES):
+            values.append(self._thisobj.seconds(<phase_t>i))
+        for i in xrange(NPHASES):
+            values.append(self._thisobj.calls(<phase_t>i))
+        values.extend([
+            self._thisobj.score_evals_,
+            self._thisobj.stepping_out_,
+            self._thisobj.shrinks_,
+            self._thisobj.max_iters_,
+        ])
+        return np.array(values, dtype=np.float64)
+
+    def as_dict(self):
+        d = dict(zip(self.fields(), self.as_array().tolist()))
+        for k in d:
+            if not k.endswith('_seconds'):
+                d[k] = int(d[k])
+        return d
+
+    def __repr__(self):
+        return 'kernel_stats({})'.format(self.as_dict())
@@ -209,6 +209,9 @@ def make_extension(module_name):
 extensions = cythonize([
     make_extension('microscopes.kernels.gibbs'),
     make_extension('microscopes.kernels.slice'),
+    make_extension('microscopes.kernels.schedule'),
+    make_extension('microscopes.kernels.stats'),
+    make_extension('microscopes.kernels._mh'),
 ], include_path=[microscopes_common_cython_inc])
 
 with open('README.md') as f:
@@ -1,5 +1,15 @@
 #include <microscopes/kernels/gibbs.hpp>
 
+#include <distributions/random.hpp>
+
+#include <algorithm>
+#include <cmath>
+#include <exception>
+#include <limits>
+#include <random>
+#include <thread>
+#include <unordered_set>
+
 using namespace std;
 using namespace microscopes::common;
 using namespace microscopes::kernels;
@@ -14,54 +24,231 @@ AssertAllAssigned(const entity_based_state_object &state)
 #endif
 }
 
-void
-gibbs::assign(entity_based_state_object &state, rng_t &rng)
+typedef kernel_stats_t ks;
+
+// the phases shared by the assignment kernels, timed when stats is not null
+
+static inline size_t
+RemoveValue(entity_based_state_object &state, size_t eid,
+            rng_t &rng, kernel_stats_t *stats)
 {
-  AssertAllAssigned(state);
+  size_t gid = 0;
+  ks::timed(stats, ks::REMOVE_VALUE,
+      [&]() { gid = state.remove_value(eid, rng); });
+  return gid;
+}
+
+static inline size_t
+ScoreAndChoose(entity_based_state_object &state,
+               pair<vector<size_t>, vector<float>> &scores,
+               size_t eid, rng_t &rng, kernel_stats_t *stats,
+               discrete::method_t sampler)
+{
+  ks::timed(stats, ks::SCORE_VALUE,
+      [&]() { state.inplace_score_value(scores, eid, rng); });
+  if (stats)
+    stats->score_evals_ += scores.first.size();
+  size_t choice = 0;
+  ks::timed(stats, ks::SAMPLE_DISCRETE,
+      [&]() { choice = discrete::sample_log(scores.second, rng, sampler); });
+  return scores.first[choice];
+}
+
+static inline void
+AddValue(entity_based_state_object &state, size_t gid, size_t eid,
+         rng_t &rng, kernel_stats_t *stats)
+{
+  ks::timed(stats, ks::ADD_VALUE,
+      [&]() { state.add_value(gid, eid, rng); });
+}
+
+static inline size_t
+CreateGroup(entity_based_state_object &state, rng_t &rng, kernel_stats_t *stats)
+{
+  size_t gid = 0;
+  ks::timed(stats, ks::CREATE_GROUP,
+      [&]() { gid = state.create_group(rng); });
+  return gid;
+}
+
+static inline void
+DeleteGroup(entity_based_state_object &state, size_t gid, kernel_stats_t *stats)
+{
+  ks::timed(stats, ks::DELETE_GROUP, [&]() { state.delete_group(gid); });
+}
+
+// the entities visited by a sweep: every entity (subset_ is null), or the
+// entities of subset_. a subset sweep may visit unassigned entities, so it
+// keeps track of the assignments itself (the snapshot is taken once per
+// call, as state.assignments() copies the whole vector). sampler_ is the
+// method used to sample each entity's group
+struct sweep_t {
+  explicit sweep_t(discrete::method_t sampler)
+    : subset_(nullptr), assignments_(), sampler_(sampler) {}
+  sweep_t(const vector<size_t> *subset,
+          const vector<ssize_t> &assignments,
+          discrete::method_t sampler)
+    : subset_(subset), assignments_(assignments), sampler_(sampler) {}
+
+  inline size_t
+  size(const entity_based_state_object &state) const
+  {
+    return subset_ ? subset_->size() : state.nentities();
+  }
+
+  inline size_t entity(size_t k) const { return subset_ ? (*subset_)[k] : k; }
+
+  inline bool
+  assigned(size_t eid) const
+  {
+    return !subset_ || assignments_[eid] != -1;
+  }
+
+  inline void
+  added(size_t eid, size_t gid)
+  {
+    if (subset_)
+      assignments_[eid] = gid;
+  }
+
+  const vector<size_t> *subset_;
+  vector<ssize_t> assignments_;
+  discrete::method_t sampler_;
+};
+
+static void
+AssignSweep(entity_based_state_object &state,
+            sweep_t &sweep,
+            rng_t &rng,
+            kernel_stats_t *stats)
+{
+  if (!sweep.subset_)
+    AssertAllAssigned(state);
   pair<vector<size_t>, vector<float>> scores;
   // ensure 1 empty group
   const auto empty_groups = state.empty_groups();
   size_t egid = 0;
   if (empty_groups.empty()) {
-    egid = state.create_group(rng);
+    egid = CreateGroup(state, rng, stats);
   } else {
     auto it = empty_groups.begin();
     egid = *it++;
     for (; it != empty_groups.end(); ++it)
-      state.delete_group(*it);
+      DeleteGroup(state, *it, stats);
   }
-  for (auto i : util::permute(state.nentities(), rng)) {
-    const size_t gid = state.remove_value(i, rng);
-    if (!state.groupsize(gid))
-      state.delete_group(gid);
+  for (auto k : util::permute(sweep.size(state), rng)) {
+    const size_t i = sweep.entity(k);
+    if (sweep.assigned(i)) {
+      const size_t gid = RemoveValue(state, i, rng, stats);
+      if (!state.groupsize(gid))
+        DeleteGroup(state, gid, stats);
+    }
     MICROSCOPES_ASSERT(state.empty_groups().size() == 1);
-    state.inplace_score_value(scores, i, rng);
-    const auto choice = scores.first[util::sample_discrete_log(scores.second, rng)];
-    state.add_value(choice, i, rng);
+    const auto choice = ScoreAndChoose(
+        state, scores, i, rng, stats, sweep.sampler_);
+    AddValue(state, choice, i, rng, stats);
+    sweep.added(i, choice);
     if (choice == egid)
-      egid = state.create_group(rng);
+      egid = CreateGroup(state, rng, stats);
   }
 }
 
-void
-gibbs::assign_resample(entity_based_state_object &state, size_t m, rng_t &rng)
+// brings the number of empty groups to exactly m: only the surplus is deleted
+// (never the group gid, if the entity was just removed from it), and only
+// the shortfall is created. this is what keeps the pool of empty groups
+// recycled by the pooled sweeps from growing. if redraw is not null, the
+// parameters of the groups kept are redrawn from G_0, as Alg 8 requires of
+// the auxiliary groups (except for gid, whose value Alg 8 lets us keep)
+static void
+RecycleEmptyGroups(entity_based_state_object &state,
+                   size_t m,
+                   bool assigned,
+                   size_t gid,
+                   gibbs::group_redraw_t *redraw,
+                   rng_t &rng,
+                   kernel_stats_t *stats)
+{
+  const auto empty_groups = state.empty_groups();
+  size_t nempty = empty_groups.size();
+  for (auto g : empty_groups) {
+    if (assigned && g == gid)
+      continue;
+    if (nempty > m) {
+      DeleteGroup(state, g, stats);
+      nempty--;
+    } else if (redraw) {
+      // a redraw stands in for the creation of a group
+      ks::timed(stats, ks::CREATE_GROUP,
+          [&]() { redraw->redraw_group(g, rng); });
+    }
+  }
+  for (; nempty < m; nempty++)
+    CreateGroup(state, rng, stats);
+  MICROSCOPES_ASSERT(state.empty_groups().size() == m);
+}
+
+// the state's redraw hook, for POOL_REDRAW (resolved once per call)
+static gibbs::group_redraw_t *
+PoolRedraw(entity_based_state_object &state, gibbs::pool_t pooled)
+{
+  if (pooled != gibbs::POOL_REDRAW)
+    return nullptr;
+  auto *redraw = dynamic_cast<gibbs::group_redraw_t *>(&state);
+  MICROSCOPES_DCHECK(redraw, "state does not implement group_redraw_t");
+  return redraw;
+}
+
+// like AssignSweep, but a group emptied by remove_value() is kept as the
+// empty group (in place of the current one), so a group is only created once
+// the empty group has been picked. with redraw null, this relies on all the
+// empty groups scoring the same, as they do for collapsed models
+static void
+PooledAssignSweep(entity_based_state_object &state,
+                  sweep_t &sweep,
+                  gibbs::group_redraw_t *redraw,
+                  rng_t &rng,
+                  kernel_stats_t *stats)
+{
+  if (!sweep.subset_)
+    AssertAllAssigned(state);
+  pair<vector<size_t>, vector<float>> scores;
+  for (auto k : util::permute(sweep.size(state), rng)) {
+    const size_t i = sweep.entity(k);
+    const bool assigned = sweep.assigned(i);
+    const size_t gid = assigned ? RemoveValue(state, i, rng, stats) : 0;
+    RecycleEmptyGroups(state, 1, assigned, gid, redraw, rng, stats);
+    const auto choice = ScoreAndChoose(
+        state, scores, i, rng, stats, sweep.sampler_);
+    AddValue(state, choice, i, rng, stats);
+    sweep.added(i, choice);
+  }
+}
+
+static void
+AssignResampleSweep(entity_based_state_object &state,
+                    size_t m,
+                    sweep_t &sweep,
+                    rng_t &rng,
+                    kernel_stats_t *stats)
 {
   // Implements Algorithm 8 from:
   //   Markov Chain Sampling Methods for Dirichlet Process Mixture Models
   //   Radford Neal
   //   Journal of Computational and Graphical Statistics, 2000
   //   http://www.cs.toronto.edu/~radford/mixmc.abstract.html
-  AssertAllAssigned(state);
+  if (!sweep.subset_)
+    AssertAllAssigned(state);
   pair<vector<size_t>, vector<float>> scores;
-  MICROSCOPES_DCHECK(m > 0, "need >=1 # of ephmeral groups");
-  for (auto i : util::permute(state.nentities(), rng)) {
-    const size_t gid = state.remove_value(i, rng);
+  for (auto k : util::permute(sweep.size(state), rng)) {
+    const size_t i = sweep.entity(k);
+    const bool assigned = sweep.assigned(i);
+    const size_t gid = assigned ? RemoveValue(state, i, rng, stats) : 0;
 
     // delete all empty groups
     // [except if we created an empty group by calling remove_value()]
     bool match = false;
     for (auto g : state.empty_groups()) {
-      if (g == gid) {
+      if (assigned && g == gid) {
         // Alg 8 allows us to keep the value drawn from G_0 in this case:
         // "If c_i \neq c_j for all j \neq i, let c_i have the label k^- + 1,
         // and draw values independently from G_0 for those \phi_c for which
@@ -69,54 +256,730 @@ gibbs::assign_resample(entity_based_state_object &state, size_t m, rng_t &rng)
         match = true;
         continue;
       }
-      state.delete_group(g);
+      DeleteGroup(state, g, stats);
     }
     MICROSCOPES_ASSERT(state.empty_groups().size() == 0 ||
                        state.empty_groups().size() == 1);
 
     // create m new groups
     for (size_t g = (match ? 1 : 0); g < m; g++)
-      state.create_group(rng);
+      CreateGroup(state, rng, stats);
 
     MICROSCOPES_ASSERT(state.empty_groups().size() == m);
 
-    state.inplace_score_value(scores, i, rng);
-    const auto choice = scores.first[util::sample_discrete_log(scores.second, rng)];
-    state.add_value(choice, i, rng);
+    const auto choice = ScoreAndChoose(
+        state, scores, i, rng, stats, sweep.sampler_);
+    AddValue(state, choice, i, rng, stats);
+    sweep.added(i, choice);
+  }
+}
+
+// like AssignResampleSweep, but the empty groups are recycled from one
+// entity to the next: only the surplus over m is deleted (never the group
+// the entity was removed from), and only the shortfall is created. the
+// groups kept are redrawn as in PooledAssignSweep
+static void
+PooledAssignResampleSweep(entity_based_state_object &state,
+                          size_t m,
+                          sweep_t &sweep,
+                          gibbs::group_redraw_t *redraw,
+                          rng_t &rng,
+                          kernel_stats_t *stats)
+{
+  if (!sweep.subset_)
+    AssertAllAssigned(state);
+  pair<vector<size_t>, vector<float>> scores;
+  for (auto k : util::permute(sweep.size(state), rng)) {
+    const size_t i = sweep.entity(k);
+    const bool assigned = sweep.assigned(i);
+    const size_t gid = assigned ? RemoveValue(state, i, rng, stats) : 0;
+    RecycleEmptyGroups(state, m, assigned, gid, redraw, rng, stats);
+
+    const auto choice = ScoreAndChoose(
+        state, scores, i, rng, stats, sweep.sampler_);
+    AddValue(state, choice, i, rng, stats);
+    sweep.added(i, choice);
+  }
+}
+
+// the entities a partial sweep may visit besides eids: the ones already
+// assigned. a sweep only (re)assigns the entities it visits, so this does
+// not change across the sweeps of a call
+static void
+OtherEntities(vector<size_t> &others,
+              const vector<ssize_t> &assignments,
+              const size_t *eids,
+              size_t n)
+{
+  const unordered_set<size_t> listed(eids, eids + n);
+  others.clear();
+  for (size_t eid = 0; eid < assignments.size(); eid++)
+    if (assignments[eid] != -1 && !listed.count(eid))
+      others.push_back(eid);
+}
+
+// the entities of a partial sweep: all of eids, plus round(fraction * #)
+// of the others, drawn uniformly without replacement
+static void
+SubsetEntities(vector<size_t> &subset,
+               const vector<size_t> &others,
+               const size_t *eids,
+               size_t n,
+               float fraction,
+               rng_t &rng)
+{
+  subset.assign(eids, eids + n);
+  if (fraction <= 0. || others.empty())
+    return;
+  size_t k = min(others.size(),
+                 static_cast<size_t>(round(fraction * others.size())));
+  unordered_set<size_t> seen;
+  uniform_int_distribution<size_t> dist(0, others.size() - 1);
+  while (k) {
+    const size_t idx = dist(rng);
+    if (seen.insert(idx).second) {
+      subset.push_back(others[idx]);
+      k--;
+    }
+  }
+}
+
+static void
+CheckSubset(const entity_based_state_object &state,
+            const size_t *eids,
+            size_t n,
+            float fraction)
+{
+  MICROSCOPES_DCHECK(fraction >= 0. && fraction <= 1., "fraction not in [0, 1]");
+  const size_t nentities = state.nentities();
+  for (size_t k = 0; k < n; k++)
+    MICROSCOPES_DCHECK(eids[k] < nentities, "entity index OOB");
+}
+
+void
+gibbs::assign(entity_based_state_object &state,
+              rng_t &rng,
+              size_t niters,
+              kernel_stats_t *stats,
+              pool_t pooled,
+              discrete::method_t sampler)
+{
+  sweep_t sweep(sampler);
+  const auto redraw = PoolRedraw(state, pooled);
+  for (size_t it = 0; it < niters; it++) {
+    if (pooled != UNPOOLED)
+      PooledAssignSweep(state, sweep, redraw, rng, stats);
+    else
+      AssignSweep(state, sweep, rng, stats);
+  }
+}
+
+void
+gibbs::assign_subset(entity_based_state_object &state,
+                     const size_t *eids,
+                     size_t n,
+                     float fraction,
+                     rng_t &rng,
+                     size_t niters,
+                     kernel_stats_t *stats,
+                     pool_t pooled,
+                     discrete::method_t sampler)
+{
+  CheckSubset(state, eids, n, fraction);
+  vector<size_t> subset, others;
+  sweep_t sweep(&subset, state.assignments(), sampler);
+  const auto redraw = PoolRedraw(state, pooled);
+  if (fraction > 0.)
+    OtherEntities(others, sweep.assignments_, eids, n);
+  for (size_t it = 0; it < niters; it++) {
+    SubsetEntities(subset, others, eids, n, fraction, rng);
+    if (pooled != UNPOOLED)
+      PooledAssignSweep(state, sweep, redraw, rng, stats);
+    else
+      AssignSweep(state, sweep, rng, stats);
+  }
+}
+
+void
+gibbs::assign_resample(entity_based_state_object &state,
+                       size_t m,
+                       rng_t &rng,
+                       size_t niters,
+                       kernel_stats_t *stats,
+                       pool_t pooled,
+                       discrete::method_t sampler)
+{
+  MICROSCOPES_DCHECK(m > 0, "need >=1 # of ephmeral groups");
+  sweep_t sweep(sampler);
+  const auto redraw = PoolRedraw(state, pooled);
+  for (size_t it = 0; it < niters; it++) {
+    if (pooled != UNPOOLED)
+      PooledAssignResampleSweep(state, m, sweep, redraw, rng, stats);
+    else
+      AssignResampleSweep(state, m, sweep, rng, stats);
+  }
+}
+
+void
+gibbs::assign_resample_subset(entity_based_state_object &state,
+                              size_t m,
+                              const size_t *eids,
+                              size_t n,
+                              float fraction,
+                              rng_t &rng,
+                              size_t niters,
+                              kernel_stats_t *stats,
+                              pool_t pooled,
+                              discrete::method_t sampler)
+{
+  MICROSCOPES_DCHECK(m > 0, "need >=1 # of ephmeral groups");
+  CheckSubset(state, eids, n, fraction);
+  vector<size_t> subset, others;
+  sweep_t sweep(&subset, state.assignments(), sampler);
+  const auto redraw = PoolRedraw(state, pooled);
+  if (fraction > 0.)
+    OtherEntities(others, sweep.assignments_, eids, n);
+  for (size_t it = 0; it < niters; it++) {
+    SubsetEntities(subset, others, eids, n, fraction, rng);
+    if (pooled != UNPOOLED)
+      PooledAssignResampleSweep(state, m, sweep, redraw, rng, stats);
+    else
+      AssignResampleSweep(state, m, sweep, rng, stats);
+  }
+}
+
+void
+gibbs::assign_parallel(entity_based_state_object &state,
+                       size_t m,
+                       rng_t &rng,
+                       size_t nthreads,
+                       size_t sync,
+                       size_t niters,
+                       kernel_stats_t *stats,
+                       discrete::method_t sampler)
+{
+  MICROSCOPES_DCHECK(m > 0, "need >=1 # of ephmeral groups");
+  MICROSCOPES_DCHECK(nthreads > 0, "need >=1 threads");
+
+  // a single thread gains nothing from the blocks: run exact sweeps
+  if (nthreads == 1) {
+    sweep_t sweep(sampler);
+    for (size_t it = 0; it < niters; it++)
+      AssignResampleSweep(state, m, sweep, rng, stats);
+    return;
+  }
+
+  // by default, a block holds about 1% of the entities, which keeps the
+  // entities which do not see each other's moves few
+  if (!sync)
+    sync = max<size_t>(1, state.nentities() / (100 * nthreads));
+
+  // one rng stream per thread, drawn up front so the result only depends
+  // on the seed, nthreads and sync
+  vector<rng_t> rngs;
+  rngs.reserve(nthreads);
+  for (size_t t = 0; t < nthreads; t++)
+    rngs.emplace_back(rng());
+
+  vector<kernel_stats_t> tstats(stats ? nthreads : 0);
+  vector<pair<vector<size_t>, vector<float>>> scores(nthreads);
+  vector<exception_ptr> errors(nthreads);
+  vector<size_t> choices, previous, pending;
+  const size_t bsize = nthreads * sync;
+  for (size_t it = 0; it < niters; it++) {
+    AssertAllAssigned(state);
+    const auto order = util::permute(state.nentities(), rng);
+    for (size_t begin = 0; begin < order.size(); begin += bsize) {
+      const size_t end = min(order.size(), begin + bsize);
+      const size_t n = end - begin;
+
+      // the state without the block is the snapshot every thread scores
+      // against, with m fresh empty groups (as in Alg 8). the groups the
+      // block empties are kept as candidates, so a cluster made up only of
+      // block entities can be rebuilt; the empty groups left over from the
+      // previous block are deleted
+      const auto stale = state.empty_groups();
+      previous.resize(n);
+      for (size_t k = 0; k < n; k++)
+        previous[k] = RemoveValue(state, order[begin + k], rng, stats);
+      for (auto g : stale)
+        DeleteGroup(state, g, stats);
+      for (size_t g = 0; g < m; g++)
+        CreateGroup(state, rng, stats);
+      const auto empty_groups = state.empty_groups();
+      const unordered_set<size_t> empty(
+          empty_groups.begin(), empty_groups.end());
+
+      choices.resize(n);
+      const size_t nt = min(nthreads, n);
+      auto worker = [&](size_t t) {
+        try {
+          kernel_stats_t *ts = stats ? &tstats[t] : nullptr;
+          for (size_t k = t * n / nt; k < (t + 1) * n / nt; k++)
+            choices[k] = ScoreAndChoose(
+                state, scores[t], order[begin + k], rngs[t], ts, sampler);
+        } catch (...) {
+          errors[t] = current_exception();
+        }
+      };
+      vector<thread> threads;
+      threads.reserve(nt);
+      for (size_t t = 0; t < nt; t++)
+        threads.emplace_back(worker, t);
+      for (auto &th : threads)
+        th.join();
+      for (auto &e : errors) {
+        if (!e)
+          continue;
+        // put the block back where it was before rethrowing
+        for (size_t k = 0; k < n; k++)
+          AddValue(state, previous[k], order[begin + k], rng, stats);
+        rethrow_exception(e);
+      }
+
+      // sync point: merge the block back in. the entities which picked an
+      // occupied group join it. an empty group, on the other hand, would
+      // end up holding every entity of the block which picked it, without
+      // any of them having seen the others: those entities are resampled
+      // one at a time against the merged state instead, as in Alg 8
+      pending.clear();
+      for (size_t k = 0; k < n; k++) {
+        if (empty.count(choices[k]))
+          pending.push_back(order[begin + k]);
+        else
+          AddValue(state, choices[k], order[begin + k], rng, stats);
+      }
+      for (auto eid : pending) {
+        for (auto g : state.empty_groups())
+          DeleteGroup(state, g, stats);
+        for (size_t g = 0; g < m; g++)
+          CreateGroup(state, rng, stats);
+        const auto choice = ScoreAndChoose(
+            state, scores[0], eid, rng, stats, sampler);
+        AddValue(state, choice, eid, rng, stats);
+      }
+    }
+  }
+
+  for (const auto &ts : tstats)
+    stats->merge(ts);
+}
+
+// log p(assignment) + the marginal likelihood of every feature
+static float
+JointScore(entity_based_state_object &state, rng_t &rng, kernel_stats_t *stats)
+{
+  float score = state.score_assignment();
+  const size_t ncomponents = state.ncomponents();
+  ks::timed(stats, ks::SCORE_LIKELIHOOD, [&]() {
+    for (size_t f = 0; f < ncomponents; f++)
+      score += state.score_likelihood(f, rng);
+  });
+  if (stats)
+    stats->score_evals_ += 1 + ncomponents;
+  return score;
+}
+
+static inline float
+LogAddExp(float a, float b)
+{
+  const float m = max(a, b);
+  if (isinf(m))
+    return m;
+  return m + logf(expf(a - m) + expf(b - m));
+}
+
+static inline void
+MoveValue(entity_based_state_object &state, size_t eid, size_t gid,
+          rng_t &rng, kernel_stats_t *stats)
+{
+  RemoveValue(state, eid, rng, stats);
+  AddValue(state, gid, eid, rng, stats);
+}
+
+// a restricted gibbs move of eid between groups a and b: eid is moved to a
+// or b in proportion to its conditional probability (or to forced, if
+// forced is a or b), and the log probability of that move is returned
+static float
+RestrictedMove(entity_based_state_object &state,
+               size_t eid,
+               size_t a,
+               size_t b,
+               ssize_t forced,
+               size_t &gid,
+               pair<vector<size_t>, vector<float>> &scores,
+               rng_t &rng,
+               kernel_stats_t *stats)
+{
+  RemoveValue(state, eid, rng, stats);
+  ks::timed(stats, ks::SCORE_VALUE,
+      [&]() { state.inplace_score_value(scores, eid, rng); });
+  if (stats)
+    stats->score_evals_ += scores.first.size();
+  float sa = -numeric_limits<float>::infinity();
+  float sb = sa;
+  for (size_t k = 0; k < scores.first.size(); k++) {
+    if (scores.first[k] == a)
+      sa = scores.second[k];
+    else if (scores.first[k] == b)
+      sb = scores.second[k];
+  }
+  const float lse = LogAddExp(sa, sb);
+  if (forced == -1)
+    gid = (logf(distributions::sample_unif01(rng)) < sa - lse) ? a : b;
+  else
+    gid = forced;
+  AddValue(state, gid, eid, rng, stats);
+  return ((gid == a) ? sa : sb) - lse;
+}
+
+// one split-merge proposal; returns true if it was accepted
+static bool
+SplitMergeMove(entity_based_state_object &state,
+               size_t nscans,
+               bool &split,
+               rng_t &rng,
+               kernel_stats_t *stats)
+{
+  const auto assignments = state.assignments();
+  const size_t n = assignments.size();
+  uniform_int_distribution<size_t> dist(0, n - 1);
+  const size_t i = dist(rng);
+  size_t j = dist(rng);
+  while (j == i)
+    j = dist(rng);
+  const size_t ci = assignments[i];
+  const size_t cj = assignments[j];
+  split = (ci == cj);
+
+  // the other entities of the two groups, and their current groups
+  vector<size_t> others, current;
+  for (size_t k = 0; k < n; k++) {
+    if (k == i || k == j)
+      continue;
+    if (assignments[k] == ssize_t(ci) || assignments[k] == ssize_t(cj)) {
+      others.push_back(k);
+      current.push_back(assignments[k]);
+    }
+  }
+
+  const float before = JointScore(state, rng, stats);
+  pair<vector<size_t>, vector<float>> scores;
+
+  // the launch state: i and j in different groups, the others at random,
+  // followed by nscans restricted gibbs scans
+  const size_t a = split ? CreateGroup(state, rng, stats) : ci;
+  const size_t b = cj;
+  if (split)
+    MoveValue(state, i, a, rng, stats);
+  for (size_t k = 0; k < others.size(); k++) {
+    const size_t g = (distributions::sample_unif01(rng) < 0.5) ? a : b;
+    if (g != current[k]) {
+      MoveValue(state, others[k], g, rng, stats);
+      current[k] = g;
+    }
+  }
+  for (size_t scan = 0; scan < nscans; scan++)
+    for (size_t k = 0; k < others.size(); k++)
+      RestrictedMove(state, others[k], a, b, -1, current[k], scores, rng, stats);
+
+  if (split) {
+    // the proposal is a final restricted scan from the launch state
+    float logq = 0.;
+    for (size_t k = 0; k < others.size(); k++)
+      logq += RestrictedMove(
+          state, others[k], a, b, -1, current[k], scores, rng, stats);
+    const float after = JointScore(state, rng, stats);
+    if (logf(distributions::sample_unif01(rng)) < after - before - logq)
+      return true;
+    for (size_t k = 0; k < others.size(); k++)
+      if (current[k] != cj)
+        MoveValue(state, others[k], cj, rng, stats);
+    MoveValue(state, i, cj, rng, stats);
+    DeleteGroup(state, a, stats);
+    return false;
   }
+
+  // the reverse (split) proposal probability: a final restricted scan from
+  // the launch state, forced back to the original assignment
+  float logq = 0.;
+  for (size_t k = 0; k < others.size(); k++)
+    logq += RestrictedMove(state, others[k], a, b,
+                           assignments[others[k]], current[k],
+                           scores, rng, stats);
+  vector<size_t> moved;
+  moved.push_back(i);
+  for (size_t k = 0; k < others.size(); k++)
+    if (current[k] == a)
+      moved.push_back(others[k]);
+  for (auto eid : moved)
+    MoveValue(state, eid, b, rng, stats);
+  const float after = JointScore(state, rng, stats);
+  if (logf(distributions::sample_unif01(rng)) < after - before + logq) {
+    DeleteGroup(state, a, stats);
+    return true;
+  }
+  for (auto eid : moved)
+    MoveValue(state, eid, a, rng, stats);
+  return false;
+}
+
+void
+gibbs::split_merge(entity_based_state_object &state,
+                   rng_t &rng,
+                   size_t nmoves,
+                   size_t nscans,
+                   split_merge_stats_t *acceptance,
+                   kernel_stats_t *stats)
+{
+  AssertAllAssigned(state);
+  if (state.nentities() < 2)
+    return;
+  for (size_t it = 0; it < nmoves; it++) {
+    bool split = false;
+    const bool accepted = SplitMergeMove(state, nscans, split, rng, stats);
+    if (!acceptance)
+      continue;
+    if (split) {
+      acceptance->nsplits_++;
+      acceptance->nsplits_accepted_ += accepted;
+    } else {
+      acceptance->nmerges_++;
+      acceptance->nmerges_accepted_ += accepted;
+    }
+  }
+}
+
+size_t
+gibbs::hp_memo_t::size() const
+{
+  size_t ret = 0;
+  for (const auto &p : tables_)
+    ret += p.second.scores_.size();
+  return ret;
+}
+
+// FNV-1a over the assignment vector
+static uint64_t
+AssignmentFingerprint(const entity_based_state_object &state)
+{
+  uint64_t h = 14695981039346656037ULL;
+  for (auto gid : state.assignments()) {
+    const uint64_t v = static_cast<uint64_t>(gid);
+    for (size_t i = 0; i < sizeof(v); i++) {
+      h ^= (v >> (8 * i)) & 0xFF;
+      h *= 1099511628211ULL;
+    }
+  }
+  return h;
+}
+
+static inline bool
+SameGrid(const gibbs::hp_memo_t::table_t &table, const gibbs::grid_t &g)
+{
+  if (table.grid_.size() != g.size())
+    return false;
+  for (size_t i = 0; i < g.size(); i++)
+    if (table.grid_[i] != g[i].first)
+      return false;
+  return true;
+}
+
+// returns, for each entry of params, the memo table to use for it (null if
+// the feature does not fit in the memo). all the bookkeeping (lookups,
+// resets and evictions) happens here, so the tables can then be used from
+// multiple threads, one feature per thread
+static vector<gibbs::hp_memo_t::table_t *>
+PrepareMemo(gibbs::hp_memo_t &memo,
+            const entity_based_state_object &state,
+            const vector<pair<size_t, gibbs::grid_t>> &params)
+{
+  const uint64_t version = AssignmentFingerprint(state);
+  const size_t tick = ++memo.tick_;
+
+  // make room, evicting the least recently used tables first (but never the
+  // tables of the features in params)
+  size_t needed = 0;
+  for (const auto &p : params)
+    needed += p.second.size();
+  size_t used = memo.size();
+  for (const auto &p : params) {
+    const auto it = memo.tables_.find(p.first);
+    if (it != memo.tables_.end())
+      used -= it->second.scores_.size();
+  }
+  vector<pair<size_t, size_t>> lru;
+  for (const auto &p : memo.tables_)
+    lru.emplace_back(p.second.last_used_, p.first);
+  sort(lru.begin(), lru.end());
+  for (const auto &e : lru) {
+    if (used + needed <= memo.capacity_)
+      break;
+    bool in_params = false;
+    for (const auto &p : params)
+      if (p.first == e.second)
+        in_params = true;
+    if (in_params)
+      continue;
+    used -= memo.tables_[e.second].scores_.size();
+    memo.tables_.erase(e.second);
+  }
+
+  vector<gibbs::hp_memo_t::table_t *> tables;
+  tables.reserve(params.size());
+  for (const auto &p : params) {
+    const gibbs::grid_t &g = p.second;
+    if (used + g.size() > memo.capacity_) {
+      // does not fit: not memoized
+      memo.tables_.erase(p.first);
+      tables.push_back(nullptr);
+      continue;
+    }
+    used += g.size();
+    auto &table = memo.tables_[p.first];
+    if (table.state_ != &state ||
+        table.version_ != version ||
+        !SameGrid(table, g)) {
+      table.state_ = &state;
+      table.version_ = version;
+      table.grid_.clear();
+      for (const auto &g0 : g)
+        table.grid_.push_back(g0.first);
+      table.valid_.assign(g.size(), 0);
+      table.scores_.assign(g.size(), 0.);
+    }
+    table.last_used_ = tick;
+    tables.push_back(&table);
+  }
+  return tables;
+}
+
+static inline void
+HpFeature(entity_based_state_object &state,
+          const pair<size_t, gibbs::grid_t> &p,
+          vector<float> &scores,
+          gibbs::hp_memo_t::table_t *table,
+          size_t &hits,
+          size_t &misses,
+          rng_t &rng,
+          kernel_stats_t *stats)
+{
+  const size_t fid = p.first;
+  const gibbs::grid_t &g = p.second;
+  scores.reserve(g.size());
+  scores.clear();
+  for (size_t i = 0; i < g.size(); i++) {
+    if (table && table->valid_[i]) {
+      scores.push_back(g[i].second + table->scores_[i]);
+      hits++;
+      continue;
+    }
+    state.set_component_hp(fid, *g[i].first);
+    float score = 0.;
+    ks::timed(stats, ks::SCORE_LIKELIHOOD,
+        [&]() { score = state.score_likelihood(fid, rng); });
+    if (stats)
+      stats->score_evals_++;
+    scores.push_back(g[i].second + score);
+    if (table) {
+      table->scores_[i] = score;
+      table->valid_[i] = 1;
+      misses++;
+    }
+  }
+  size_t choice = 0;
+  ks::timed(stats, ks::SAMPLE_DISCRETE,
+      [&]() { choice = util::sample_discrete_log(scores, rng); });
+  state.set_component_hp(fid, *g[choice].first);
 }
 
 void
 gibbs::hp(entity_based_state_object &state,
           const vector<pair<size_t, grid_t>> &params,
-          rng_t &rng)
+          rng_t &rng,
+          size_t niters,
+          size_t nthreads,
+          hp_memo_t *memo,
+          kernel_stats_t *stats)
 {
-  vector<float> scores;
-  for (const auto &p : params) {
-    const size_t fid = p.first;
-    const grid_t &g = p.second;
-    scores.reserve(g.size());
-    scores.clear();
-    for (const auto &g0 : g) {
-      state.set_component_hp(fid, *g0.first);
-      scores.push_back(g0.second + state.score_likelihood(fid, rng));
+  MICROSCOPES_DCHECK(nthreads > 0, "need >=1 threads");
+  vector<hp_memo_t::table_t *> tables(params.size(), nullptr);
+  if (memo)
+    tables = PrepareMemo(*memo, state, params);
+
+  nthreads = min(nthreads, params.size());
+  if (nthreads <= 1) {
+    vector<float> scores;
+    size_t hits = 0, misses = 0;
+    for (size_t it = 0; it < niters; it++)
+      for (size_t i = 0; i < params.size(); i++)
+        HpFeature(state, params[i], scores, tables[i], hits, misses, rng,
+                  stats);
+    if (memo) {
+      memo->hits_ += hits;
+      memo->misses_ += misses;
+    }
+    return;
+  }
+
+  // one rng stream per thread, drawn up front so the result only depends
+  // on the seed and nthreads (not on how the threads get scheduled)
+  vector<rng_t> rngs;
+  rngs.reserve(nthreads);
+  for (size_t t = 0; t < nthreads; t++)
+    rngs.emplace_back(rng());
+
+  vector<exception_ptr> errors(nthreads);
+  vector<size_t> hits(nthreads), misses(nthreads);
+  vector<kernel_stats_t> tstats(stats ? nthreads : 0);
+  auto worker = [&](size_t t) {
+    try {
+      vector<float> scores;
+      const size_t begin = t * params.size() / nthreads;
+      const size_t end = (t + 1) * params.size() / nthreads;
+      for (size_t it = 0; it < niters; it++)
+        for (size_t i = begin; i < end; i++)
+          HpFeature(state, params[i], scores, tables[i],
+                    hits[t], misses[t], rngs[t],
+                    stats ? &tstats[t] : nullptr);
+    } catch (...) {
+      errors[t] = current_exception();
+    }
+  };
+
+  vector<thread> threads;
+  threads.reserve(nthreads);
+  for (size_t t = 0; t < nthreads; t++)
+    threads.emplace_back(worker, t);
+  for (auto &th : threads)
+    th.join();
+  for (const auto &ts : tstats)
+    stats->merge(ts);
+  if (memo) {
+    for (size_t t = 0; t < nthreads; t++) {
+      memo->hits_ += hits[t];
+      memo->misses_ += misses[t];
     }
-    const auto choice = util::sample_discrete_log(scores, rng);
-    state.set_component_hp(fid, *g[choice].first);
   }
+  for (const auto &e : errors)
+    if (e)
+      rethrow_exception(e);
 }
 
 // for performance debugging purposes
 // doesn't change the group assignments
 void
-gibbs::perftest(entity_based_state_object &state, rng_t &rng)
+gibbs::perftest(entity_based_state_object &state,
+                rng_t &rng,
+                discrete::method_t sampler)
 {
   AssertAllAssigned(state);
   pair<vector<size_t>, vector<float>> scores;
   for (auto i : util::permute(state.nentities(), rng)) {
     const size_t gid = state.remove_value(i, rng);
     state.inplace_score_value(scores, i, rng);
-    const auto choice = scores.first[util::sample_discrete_log(scores.second, rng)];
+    const auto choice =
+      scores.first[discrete::sample_log(scores.second, rng, sampler)];
     (void)choice; // XXX: make sure compiler does not optimize this out
     state.add_value(gid, i, rng);
   }
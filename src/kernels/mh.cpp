@@ -0,0 +1,193 @@
+#include <microscopes/kernels/mh.hpp>
+#include <microscopes/common/macros.hpp>
+#include <microscopes/common/assert.hpp>
+#include <microscopes/common/util.hpp>
+
+#include <limits>
+
+using namespace std;
+using namespace microscopes::common;
+using namespace microscopes::kernels;
+using namespace microscopes::models;
+
+static inline void
+CheckMutator(const value_mutator &mut, size_t index)
+{
+  MICROSCOPES_DCHECK(index < mut.shape(), "update index OOB");
+  MICROSCOPES_DCHECK(
+      mut.type().t() == TYPE_F32 || mut.type().t() == TYPE_F64,
+      "need floats");
+}
+
+template <typename P>
+static inline void
+Record(const P &p, bool accepted)
+{
+  p.stats_.nproposals_++;
+  if (accepted)
+    p.stats_.naccepted_++;
+  p.sigma_ = mh::adapt(p.sigma_, p.stats_, p.nadapt_, p.target_, accepted);
+}
+
+static inline bool
+Accept(float lg_alpha, rng_t &rng)
+{
+  return lg_alpha >= 0. ||
+         logf(distributions::sample_unif01(rng)) <= lg_alpha;
+}
+
+// one step on all the coordinates of p, whose mutators are in mutators.
+// model is the model term at the current point (updated on acceptance), and
+// model_fn() scores it at the point set in the mutators
+template <typename T>
+static void
+StepParam(T model_fn,
+          const mh::mh_hp_param_t &p,
+          vector<value_mutator> &mutators,
+          float &model,
+          vector<float> &x,
+          vector<float> &xprop,
+          rng_t &rng,
+          kernel_stats_t *stats)
+{
+  const size_t n = p.updates_.size();
+  x.resize(n);
+  xprop.resize(n);
+  normal_distribution<float> noise(0., p.sigma_);
+  for (size_t i = 0; i < n; i++) {
+    x[i] = mutators[i].accessor().get<float>(p.updates_[i].index_);
+    xprop[i] = x[i] + noise(rng);
+  }
+
+  bool accepted = false;
+  const float prior = p.prior_(xprop);
+  if (prior != -numeric_limits<float>::infinity()) {
+    for (size_t i = 0; i < n; i++)
+      mutators[i].set<float>(xprop[i], p.updates_[i].index_);
+    const float mprop = model_fn();
+    if (stats)
+      stats->score_evals_++;
+    accepted = Accept(prior + mprop - p.prior_(x) - model, rng);
+    if (accepted)
+      model = mprop;
+    else
+      for (size_t i = 0; i < n; i++)
+        mutators[i].set<float>(x[i], p.updates_[i].index_);
+  }
+  Record(p, accepted);
+}
+
+void
+mh::hp(entity_based_state_object &s,
+       const vector<mh_hp_param_t> &cparams,
+       const vector<mh_hp_t> &hparams,
+       rng_t &rng,
+       size_t niters,
+       kernel_stats_t *stats)
+{
+  vector<vector<vector<value_mutator>>> fmutators(hparams.size());
+  for (size_t fi = 0; fi < hparams.size(); fi++) {
+    const auto &p = hparams[fi];
+    fmutators[fi].resize(p.params_.size());
+    for (size_t pi = 0; pi < p.params_.size(); pi++) {
+      for (const auto &update : p.params_[pi].updates_) {
+        fmutators[fi][pi].emplace_back(
+            s.get_component_hp_mutator(p.index_, update.key_));
+        CheckMutator(fmutators[fi][pi].back(), update.index_);
+      }
+    }
+  }
+  vector<vector<value_mutator>> cmutators(cparams.size());
+  for (size_t ci = 0; ci < cparams.size(); ci++) {
+    for (const auto &update : cparams[ci].updates_) {
+      cmutators[ci].emplace_back(s.get_cluster_hp_mutator(update.key_));
+      CheckMutator(cmutators[ci].back(), update.index_);
+    }
+  }
+
+  // the assignments are fixed, so the model term of a feature only changes
+  // with its own hyperparameters (and that of the clustering with the
+  // cluster hyperparameters): each is scored once up front
+  vector<float> fmodels;
+  for (const auto &p : hparams)
+    fmodels.push_back(s.score_likelihood(p.index_, rng));
+  float cmodel = cparams.empty() ? 0. : s.score_assignment();
+
+  vector<size_t> indices;
+  vector<float> x, xprop;
+  for (size_t it = 0; it < niters; it++) {
+    for (size_t fi = 0; fi < hparams.size(); fi++) {
+      const auto &p = hparams[fi];
+      const size_t feature = p.index_;
+      auto model_fn = [&s, &rng, feature]() {
+        return s.score_likelihood(feature, rng);
+      };
+      util::inplace_permute(indices, p.params_.size(), rng);
+      for (auto pi : indices)
+        StepParam(model_fn, p.params_[pi], fmutators[fi][pi],
+                  fmodels[fi], x, xprop, rng, stats);
+    }
+
+    auto model_fn = [&s]() { return s.score_assignment(); };
+    for (size_t ci = 0; ci < cparams.size(); ci++)
+      StepParam(model_fn, cparams[ci], cmutators[ci],
+                cmodel, x, xprop, rng, stats);
+  }
+}
+
+void
+mh::theta(entity_based_state_object &s,
+          const vector<mh_theta_t> &tparams,
+          rng_t &rng,
+          size_t niters,
+          kernel_stats_t *stats)
+{
+  vector<vector<ident_t>> idents(tparams.size());
+  vector<vector<vector<value_mutator>>> mutators(tparams.size());
+  vector<vector<float>> models(tparams.size());
+  for (size_t ti = 0; ti < tparams.size(); ti++) {
+    const auto &p = tparams[ti];
+    idents[ti] = s.suffstats_identifiers(p.index_);
+    for (auto id : idents[ti]) {
+      models[ti].push_back(s.score_likelihood(p.index_, id, rng));
+      mutators[ti].emplace_back();
+      for (const auto &param : p.params_) {
+        mutators[ti].back().emplace_back(
+            s.get_suffstats_mutator(p.index_, id, param.key_));
+        const value_mutator &mut = mutators[ti].back().back();
+        MICROSCOPES_DCHECK(
+            mut.type().t() == TYPE_F32 ||
+            mut.type().t() == TYPE_F64, "need floats");
+        MICROSCOPES_DCHECK(mut.shape() == 1, "assuming scalar parameter");
+      }
+    }
+  }
+
+  vector<size_t> indices;
+  for (size_t it = 0; it < niters; it++) {
+    for (size_t ti = 0; ti < tparams.size(); ti++) {
+      const auto &p = tparams[ti];
+      util::inplace_permute(indices, idents[ti].size(), rng);
+      for (auto ii : indices) {
+        const ident_t id = idents[ti][ii];
+        float &model = models[ti][ii];
+        for (size_t pi = 0; pi < p.params_.size(); pi++) {
+          const auto &param = p.params_[pi];
+          value_mutator &mut = mutators[ti][ii][pi];
+          const float x = mut.accessor().get<float>(0);
+          normal_distribution<float> noise(0., param.sigma_);
+          mut.set<float>(x + noise(rng), 0);
+          const float mprop = s.score_likelihood(p.index_, id, rng);
+          if (stats)
+            stats->score_evals_++;
+          const bool accepted = Accept(mprop - model, rng);
+          if (accepted)
+            model = mprop;
+          else
+            mut.set<float>(x, 0);
+          Record(param, accepted);
+        }
+      }
+    }
+  }
+}
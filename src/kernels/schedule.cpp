@@ -0,0 +1,52 @@
+#include <microscopes/kernels/schedule.hpp>
+#include <microscopes/common/assert.hpp>
+
+#include <chrono>
+
+using namespace std;
+using namespace microscopes::common;
+using namespace microscopes::kernels;
+
+void
+schedule::run(entity_based_state_object &state, rng_t &rng, size_t niters)
+{
+  typedef chrono::steady_clock clock;
+  for (size_t it = 0; it < niters; it++, nsweeps_++) {
+    for (auto &e : entries_) {
+      MICROSCOPES_DCHECK(e.every_ > 0, "every must be positive");
+      if (nsweeps_ % e.every_)
+        continue;
+      const auto start = clock::now();
+      switch (e.kernel_) {
+        case ASSIGN:
+          gibbs::assign(state, rng);
+          break;
+        case ASSIGN_RESAMPLE:
+          gibbs::assign_resample(state, e.m_, rng);
+          break;
+        case GIBBS_HP:
+          gibbs::hp(state, e.grid_, rng);
+          break;
+        case SLICE_HP:
+          slice::hp(state, e.cparams_, e.hparams_, rng);
+          break;
+        case SLICE_THETA:
+          slice::theta(state, e.tparams_, rng);
+          break;
+        default:
+          MICROSCOPES_DCHECK(false, "should not be reached");
+      }
+      e.ncalls_++;
+      e.seconds_ += chrono::duration<double>(clock::now() - start).count();
+    }
+  }
+}
+
+void
+schedule::reset_timings()
+{
+  for (auto &e : entries_) {
+    e.ncalls_ = 0;
+    e.seconds_ = 0.;
+  }
+}
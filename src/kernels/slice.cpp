@@ -3,6 +3,9 @@
 #include <microscopes/common/assert.hpp>
 #include <microscopes/common/util.hpp>
 
+#include <exception>
+#include <thread>
+
 using namespace std;
 using namespace microscopes::common;
 using namespace microscopes::kernels;
@@ -14,7 +17,12 @@ struct feature_scorefn {
   {
     mut_->set<float>(m, pos_);
     args_[argpos_] = m;
-    return prior_scorefn_(args_) + s_->score_likelihood(feature_, *rng_);
+    return prior_scorefn_(args_) + model();
+  }
+  inline float
+  model()
+  {
+    return s_->score_likelihood(feature_, *rng_);
   }
   value_mutator *mut_;
   size_t pos_;
@@ -32,7 +40,12 @@ struct cluster_scorefn {
   {
     mut_->set<float>(m, pos_);
     args_[argpos_] = m;
-    return prior_scorefn_(args_) + s_->score_assignment();
+    return prior_scorefn_(args_) + model();
+  }
+  inline float
+  model()
+  {
+    return s_->score_assignment();
   }
   value_mutator *mut_;
   size_t pos_;
@@ -42,85 +55,124 @@ struct cluster_scorefn {
   vector<float> args_;
 };
 
+// scores all the coordinates of a joint param at once, on top of the model
+// term of a feature_scorefn or a cluster_scorefn
+template <typename T>
+struct joint_scorefn {
+  inline float
+  operator()(const vector<float> &x)
+  {
+    for (size_t i = 0; i < x.size(); i++)
+      (*mutators_)[i].set<float>(x[i], p_->updates_[i].index_);
+    return p_->prior_(x) + base_->model();
+  }
+  T *base_;
+  vector<value_mutator> *mutators_;
+  const slice::slice_hp_param_t *p_;
+};
+
+static inline void
+CheckMutator(const value_mutator &mut, size_t index)
+{
+  MICROSCOPES_DCHECK(index < mut.shape(), "update index OOB");
+  MICROSCOPES_DCHECK(
+      mut.type().t() == TYPE_F32 || mut.type().t() == TYPE_F64,
+      "need floats");
+}
+
+// slices on each coordinate of p in turn (or on all of them at once, for a
+// joint p). func is either a feature_scorefn or a cluster_scorefn, and
+// mutators holds the mutator of each of p.updates_
+template <typename T>
+static void
+SliceParam(T &func,
+           const slice::slice_hp_param_t &p,
+           vector<value_mutator> &mutators,
+           rng_t &rng,
+           kernel_stats_t *stats)
+{
+  func.prior_scorefn_ = p.prior_;
+  func.args_.clear();
+  for (size_t i = 0; i < p.updates_.size(); i++)
+    func.args_.push_back(
+        mutators[i].accessor().get<float>(p.updates_[i].index_));
+
+  if (p.joint_ && p.updates_.size() > 1) {
+    joint_scorefn<T> joint_func;
+    joint_func.base_ = &func;
+    joint_func.mutators_ = &mutators;
+    joint_func.p_ = &p;
+    slice::draw_joint_param(joint_func, func.args_, p, rng, stats);
+    // the last point scored is not necessarily the one drawn
+    for (size_t i = 0; i < p.updates_.size(); i++)
+      mutators[i].set<float>(func.args_[i], p.updates_[i].index_);
+    return;
+  }
+
+  // XXX: permute this order?
+  for (size_t i = 0; i < p.updates_.size(); i++) {
+    value_mutator &mut = mutators[i];
+    const size_t index = p.updates_[i].index_;
+    func.mut_ = &mut;
+    func.pos_ = index;
+    func.argpos_ = i;
+    const float start = func.args_[i];
+    const float samp = slice::draw_param(func, start, p, rng, stats);
+    mut.set<float>(samp, index);
+    func.args_[i] = samp;
+  }
+}
+
 void
 slice::hp(entity_based_state_object &s,
           const vector<slice_hp_param_t> &cparams,
           const vector<slice_hp_t> &hparams,
-          rng_t &rng)
+          rng_t &rng,
+          size_t niters,
+          kernel_stats_t *stats)
 {
-  vector<size_t> indices;
-  vector<value_mutator> mutators;
-
-  // slice on the feature HPs
-  feature_scorefn feature_func;
-  feature_func.s_ = &s;
-  feature_func.rng_ = &rng;
-  for (const auto &p : hparams) { // XXX: permute the hparams?
-    feature_func.feature_ = p.index_;
-    util::inplace_permute(indices, p.params_.size(), rng);
-    for (auto pi : indices) {
-      const auto &p1 = p.params_[pi];
-      feature_func.prior_scorefn_ = p1.prior_;
-      feature_func.args_.clear();
-
-      // bootstrap the args (and save the mutators)
-      mutators.clear();
-      for (const auto &update : p1.updates_) {
-        mutators.emplace_back(s.get_component_hp_mutator(p.index_, update.key_));
-        MICROSCOPES_DCHECK(update.index_ < mutators.back().shape(), "update index OOB");
-        feature_func.args_.push_back(mutators.back().accessor().get<float>(update.index_));
-      }
-
-      // XXX: permute this order?
-      for (size_t i = 0; i < p1.updates_.size(); i++) {
-        value_mutator &mut = mutators[i];
-        const size_t index = p1.updates_[i].index_;
-        MICROSCOPES_DCHECK(
-            mut.type().t() == TYPE_F32 || mut.type().t() == TYPE_F64,
-            "need floats");
-        feature_func.mut_ = &mut;
-        feature_func.pos_ = index;
-        feature_func.argpos_ = i;
-        const float start = feature_func.args_[i];
-        const float samp = sample(feature_func, start, p1.w_, rng);
-        mut.set<float>(samp, index);
-        feature_func.args_[i] = samp;
+  // the mutators are resolved once per call, and reused by every sweep
+  vector<vector<vector<value_mutator>>> fmutators(hparams.size());
+  for (size_t fi = 0; fi < hparams.size(); fi++) {
+    const auto &p = hparams[fi];
+    fmutators[fi].resize(p.params_.size());
+    for (size_t pi = 0; pi < p.params_.size(); pi++) {
+      for (const auto &update : p.params_[pi].updates_) {
+        fmutators[fi][pi].emplace_back(
+            s.get_component_hp_mutator(p.index_, update.key_));
+        CheckMutator(fmutators[fi][pi].back(), update.index_);
       }
     }
   }
+  vector<vector<value_mutator>> cmutators(cparams.size());
+  for (size_t ci = 0; ci < cparams.size(); ci++) {
+    for (const auto &update : cparams[ci].updates_) {
+      cmutators[ci].emplace_back(s.get_cluster_hp_mutator(update.key_));
+      CheckMutator(cmutators[ci].back(), update.index_);
+    }
+  }
 
-  // XXX: fix the code duplication
-
-  // slice on the cluster HPs
+  vector<size_t> indices;
+  feature_scorefn feature_func;
+  feature_func.s_ = &s;
+  feature_func.rng_ = &rng;
   cluster_scorefn cluster_func;
   cluster_func.s_ = &s;
-  // XXX: permute the cparams?
-  for (const auto &p : cparams) {
-    cluster_func.prior_scorefn_ = p.prior_;
-    cluster_func.args_.clear();
-
-    mutators.clear();
-    for (const auto &update : p.updates_) {
-      mutators.emplace_back(s.get_cluster_hp_mutator(update.key_));
-      MICROSCOPES_DCHECK(update.index_ < mutators.back().shape(), "update index OOB");
-      cluster_func.args_.push_back(mutators.back().accessor().get<float>(update.index_));
+  for (size_t it = 0; it < niters; it++) {
+    // slice on the feature HPs
+    for (size_t fi = 0; fi < hparams.size(); fi++) { // XXX: permute the hparams?
+      const auto &p = hparams[fi];
+      feature_func.feature_ = p.index_;
+      util::inplace_permute(indices, p.params_.size(), rng);
+      for (auto pi : indices)
+        SliceParam(feature_func, p.params_[pi], fmutators[fi][pi], rng,
+                   stats);
     }
 
-    // XXX: permute this order?
-    for (size_t i = 0; i < p.updates_.size(); i++) {
-      value_mutator &mut = mutators[i];
-      const size_t index = p.updates_[i].index_;
-      MICROSCOPES_DCHECK(
-          mut.type().t() == TYPE_F32 || mut.type().t() == TYPE_F64,
-          "need floats");
-      cluster_func.mut_ = &mut;
-      cluster_func.pos_ = index;
-      cluster_func.argpos_ = i;
-      const float start = cluster_func.args_[i];
-      const float samp = sample(cluster_func, start, p.w_, rng);
-      mut.set<float>(samp, index);
-      cluster_func.args_[i] = samp;
-    }
+    // slice on the cluster HPs
+    // XXX: permute the cparams?
+    for (size_t ci = 0; ci < cparams.size(); ci++)
+      SliceParam(cluster_func, cparams[ci], cmutators[ci], rng, stats);
   }
 }
 
@@ -138,31 +190,179 @@ struct theta_scorefn {
   ident_t id_;
 };
 
-void
-slice::theta(entity_based_state_object &s,
-             const vector<slice_theta_t> &tparams,
-             rng_t &rng)
+// runs niters sweeps over the groups [ranges[ti].first, ranges[ti].second)
+// of each component ti. the draws go through tparams, so each thread passes
+// its own copy (the params carry the adapted widths and stats)
+static void
+ThetaSweeps(entity_based_state_object &s,
+            const vector<slice::slice_theta_t> &tparams,
+            const vector<vector<ident_t>> &idents,
+            vector<vector<vector<value_mutator>>> &mutators,
+            const vector<pair<size_t, size_t>> &ranges,
+            rng_t &rng,
+            size_t niters,
+            kernel_stats_t *stats)
 {
   vector<size_t> indices;
   theta_scorefn theta_func;
   theta_func.s_ = &s;
   theta_func.rng_ = &rng;
-  for (const auto &p : tparams) {
-    theta_func.component_ = p.index_;
-    const auto idents = s.suffstats_identifiers(p.index_);
-    for (const auto &p1 : p.params_) {
-      util::inplace_permute(indices, idents.size(), rng);
-      for (auto pi : indices) {
-        value_mutator mut = s.get_suffstats_mutator(p.index_, idents[pi], p1.key_);
-        theta_func.mut_ = &mut;
+  for (size_t it = 0; it < niters; it++) {
+    for (size_t ti = 0; ti < tparams.size(); ti++) {
+      const auto &p = tparams[ti];
+      const size_t begin = ranges[ti].first;
+      const size_t end = ranges[ti].second;
+      if (begin == end)
+        continue;
+      theta_func.component_ = p.index_;
+      for (size_t pi = 0; pi < p.params_.size(); pi++) {
+        util::inplace_permute(indices, end - begin, rng);
+        for (auto offset : indices) {
+          const size_t ii = begin + offset;
+          value_mutator &mut = mutators[ti][pi][ii];
+          theta_func.mut_ = &mut;
+          theta_func.id_ = idents[ti][ii];
+          const float start = mut.accessor().get<float>(0);
+          mut.set<float>(
+              slice::draw_param(
+                theta_func, start, p.params_[pi], rng, stats), 0);
+        }
+      }
+    }
+  }
+}
+
+// folds the draws a thread made with its copy `local` of p (which started
+// out with the stats `base`) back into p
+static void
+MergeThetaParam(const slice::slice_theta_param_t &p,
+                const slice::slice_theta_param_t &local,
+                const slice::draw_stats_t &base)
+{
+  p.stats_.ndraws_ += local.stats_.ndraws_ - base.ndraws_;
+  p.stats_.nevals_ += local.stats_.nevals_ - base.nevals_;
+  p.stats_.nadapted_ += local.stats_.nadapted_ - base.nadapted_;
+  p.stats_.width_sum_ += local.stats_.width_sum_ - base.width_sum_;
+  if (p.stats_.nadapted_ > base.nadapted_)
+    p.w_ = p.stats_.width_sum_ / p.stats_.nadapted_;
+}
+
+void
+slice::theta(entity_based_state_object &s,
+             const vector<slice_theta_t> &tparams,
+             rng_t &rng,
+             size_t niters,
+             size_t nthreads,
+             kernel_stats_t *stats)
+{
+  MICROSCOPES_DCHECK(nthreads > 0, "need >=1 threads");
+
+  // the identifiers and mutators are resolved once per call (the groups do
+  // not change while theta runs), and reused by every sweep
+  vector<vector<ident_t>> idents(tparams.size());
+  vector<vector<vector<value_mutator>>> mutators(tparams.size());
+  size_t ngroups = 0;
+  for (size_t ti = 0; ti < tparams.size(); ti++) {
+    const auto &p = tparams[ti];
+    idents[ti] = s.suffstats_identifiers(p.index_);
+    ngroups += idents[ti].size();
+    mutators[ti].resize(p.params_.size());
+    for (size_t pi = 0; pi < p.params_.size(); pi++) {
+      for (auto id : idents[ti]) {
+        mutators[ti][pi].emplace_back(
+            s.get_suffstats_mutator(p.index_, id, p.params_[pi].key_));
+        const value_mutator &mut = mutators[ti][pi].back();
         MICROSCOPES_DCHECK(
             mut.type().t() == TYPE_F32 ||
             mut.type().t() == TYPE_F64, "need floats");
         MICROSCOPES_DCHECK(mut.shape() == 1, "assuming scalar parameter");
-        theta_func.id_ = idents[pi];
-        const float start = mut.accessor().get<float>(0);
-        mut.set<float>(sample(theta_func, start, p1.w_, rng), 0);
       }
     }
   }
+
+  nthreads = min(nthreads, ngroups);
+  if (nthreads <= 1) {
+    vector<pair<size_t, size_t>> ranges;
+    for (const auto &ids : idents)
+      ranges.emplace_back(0, ids.size());
+    ThetaSweeps(s, tparams, idents, mutators, ranges, rng, niters, stats);
+    return;
+  }
+
+  // given the assignments, the groups are independent: each thread gets a
+  // contiguous block of the (component, group) pairs, its own copy of the
+  // params, and its own rng stream, drawn up front so the result only
+  // depends on the seed and nthreads
+  vector<rng_t> rngs;
+  rngs.reserve(nthreads);
+  for (size_t t = 0; t < nthreads; t++)
+    rngs.emplace_back(rng());
+
+  vector<vector<pair<size_t, size_t>>> ranges(nthreads);
+  for (size_t t = 0; t < nthreads; t++) {
+    const size_t begin = t * ngroups / nthreads;
+    const size_t end = (t + 1) * ngroups / nthreads;
+    size_t offset = 0;
+    for (const auto &ids : idents) {
+      const size_t n = ids.size();
+      ranges[t].emplace_back(
+          min(n, begin - min(begin, offset)),
+          min(n, end - min(end, offset)));
+      offset += n;
+    }
+  }
+
+  // the draws left to adapt on are split across the threads, in proportion
+  // to the number of groups each one draws the component for, so that the
+  // threads do not each adapt on the whole budget
+  vector<vector<slice_theta_t>> locals(nthreads, tparams);
+  for (size_t ti = 0; ti < tparams.size(); ti++) {
+    const size_t n = idents[ti].size();
+    if (!n)
+      continue;
+    for (size_t pi = 0; pi < tparams[ti].params_.size(); pi++) {
+      const auto &p = tparams[ti].params_[pi];
+      const size_t remaining =
+        p.nadapt_ > p.stats_.ndraws_ ? p.nadapt_ - p.stats_.ndraws_ : 0;
+      size_t before = 0;
+      for (size_t t = 0; t < nthreads; t++) {
+        const auto &range = ranges[t][ti];
+        const size_t after = before + (range.second - range.first);
+        locals[t][ti].params_[pi].nadapt_ = p.stats_.ndraws_ +
+          remaining * after / n - remaining * before / n;
+        before = after;
+      }
+    }
+  }
+  vector<exception_ptr> errors(nthreads);
+  vector<kernel_stats_t> tstats(stats ? nthreads : 0);
+  auto worker = [&](size_t t) {
+    try {
+      ThetaSweeps(s, locals[t], idents, mutators, ranges[t], rngs[t], niters,
+                  stats ? &tstats[t] : nullptr);
+    } catch (...) {
+      errors[t] = current_exception();
+    }
+  };
+
+  vector<thread> threads;
+  threads.reserve(nthreads);
+  for (size_t t = 0; t < nthreads; t++)
+    threads.emplace_back(worker, t);
+  for (auto &th : threads)
+    th.join();
+  for (const auto &ts : tstats)
+    stats->merge(ts);
+  for (const auto &e : errors)
+    if (e)
+      rethrow_exception(e);
+
+  for (size_t ti = 0; ti < tparams.size(); ti++) {
+    for (size_t pi = 0; pi < tparams[ti].params_.size(); pi++) {
+      const auto &p = tparams[ti].params_[pi];
+      const draw_stats_t base = p.stats_;
+      for (size_t t = 0; t < nthreads; t++)
+        MergeThetaParam(p, locals[t][ti].params_[pi], base);
+    }
+  }
 }
@@ -0,0 +1,32 @@
+from microscopes.kernels.convergence import split_rhat, ess
+
+import numpy as np
+
+
+def test_mixed_chains():
+    prng = np.random.RandomState(0)
+    draws = prng.normal(size=(4, 1000))
+    assert abs(split_rhat(draws) - 1.) <= 0.01
+    # independent draws: the ESS is about the number of draws
+    assert 3000 <= ess(draws) <= 5000
+
+
+def test_stuck_chains():
+    prng = np.random.RandomState(0)
+    draws = prng.normal(size=(4, 1000))
+    draws[0] += 5.
+    assert split_rhat(draws) >= 1.5
+
+
+def test_autocorrelated_chains():
+    prng = np.random.RandomState(0)
+    draws = np.zeros((4, 1000))
+    for t in xrange(1, 1000):
+        draws[:, t] = 0.9 * draws[:, t - 1] + prng.normal(size=4)
+    # for an AR(1) process, ESS/N = (1 - rho)/(1 + rho) ~ 0.05
+    assert 100 <= ess(draws) <= 400
+
+
+def test_constant_chains():
+    assert split_rhat(np.ones((2, 10))) == 1.
+    assert ess(np.ones((2, 10))) == 20.
@@ -2,11 +2,34 @@ def test_import_gibbs():
     from microscopes.kernels.gibbs import (
         assign,
         assign_resample,
+        assign_subset,
+        assign_resample_subset,
+        assign_parallel,
+        split_merge,
         hp,
+        grid,
+        hp_memo,
     )
-    assert assign and assign_resample and hp
+    assert assign and assign_resample and hp and grid and hp_memo
+    assert assign_subset and assign_resample_subset and assign_parallel
+    assert split_merge
 
 
 def test_import_slice():
-    from microscopes.kernels.slice import hp, theta
-    assert hp and theta
+    from microscopes.kernels.slice import hp, theta, hp_plan, theta_plan
+    assert hp and theta and hp_plan and theta_plan
+
+
+def test_import_schedule():
+    from microscopes.kernels.schedule import schedule
+    assert schedule
+
+
+def test_import_mh():
+    from microscopes.kernels.mh import sample_1d, hp, theta
+    assert sample_1d and hp and theta
+
+
+def test_import_stats():
+    from microscopes.kernels.stats import kernel_stats
+    assert kernel_stats
@@ -0,0 +1,41 @@
+from microscopes.kernels.gibbs import sample_discrete_log
+from microscopes.common.rng import rng
+
+import numpy as np
+
+
+def _test_sampler(sampler, prng):
+    scores = np.log([0.1, 0.2, 0.3, 0.4, 1e-8])
+    ndraws = 100000
+    draws = sample_discrete_log(scores, prng, size=ndraws, sampler=sampler)
+    assert draws.min() >= 0 and draws.max() < len(scores)
+    freqs = np.bincount(draws, minlength=len(scores)) / float(ndraws)
+    probs = np.exp(scores) / np.exp(scores).sum()
+    maxdiff = np.abs(freqs - probs).max()
+    print sampler, 'maxdiff:', maxdiff
+    assert maxdiff <= 0.01
+
+
+def test_exact_sampler():
+    _test_sampler('exact', rng(0))
+
+
+def test_fast_sampler():
+    _test_sampler('fast', rng(0))
+
+
+def test_fast_sampler_extreme_scores():
+    # scores far below the max have no mass
+    scores = [0., -1000., -np.inf]
+    draws = sample_discrete_log(scores, rng(0), size=1000, sampler='fast')
+    assert (draws == 0).all()
+
+
+def test_fast_sampler_all_infinite():
+    # no index is more likely than the others
+    scores = [-np.inf] * 4
+    ndraws = 10000
+    draws = sample_discrete_log(scores, rng(0), size=ndraws, sampler='fast')
+    assert draws.min() >= 0 and draws.max() < len(scores)
+    freqs = np.bincount(draws, minlength=len(scores)) / float(ndraws)
+    assert np.abs(freqs - 0.25).max() <= 0.02
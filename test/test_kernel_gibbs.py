@@ -0,0 +1,218 @@
+from microscopes.kernels import gibbs
+from microscopes.common.rng import rng
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises
+
+import numpy as np
+
+try:
+    from microscopes.mixture.definition import model_definition
+    from microscopes.mixture.model import initialize, bind
+    from microscopes.common.recarray.dataview import numpy_dataview
+    from microscopes.models import bb
+    _has_mixture = True
+except ImportError:
+    _has_mixture = False
+
+
+def _state(seed, n=60, d=5, assignment=None):
+    """A small beta-bernoulli mixture (collapsed), made of two well
+    separated clusters, with a random initial assignment (unless one is
+    given). Returns the latent, the state bound to the data, and the data
+
+    """
+    if not _has_mixture:
+        raise SkipTest("requires microscopes.mixture")
+    prng = np.random.RandomState(seed)
+    probs = np.where(np.arange(n)[:, np.newaxis] < n // 2, 0.9, 0.1)
+    data = np.array(
+        [tuple(row) for row in prng.uniform(size=(n, d)) < probs],
+        dtype=[('', bool)] * d)
+    view = numpy_dataview(data)
+    defn = model_definition(n, [bb] * d)
+    latent = initialize(defn, view, r=rng(seed), cluster_hp={'alpha': 2.},
+                        assignment=assignment)
+    return latent, bind(latent, view), view
+
+
+def _assert_consistent(latent, n=60):
+    assignments = _assignments(latent)
+    assert len(assignments) == n
+    assert all(gid >= 0 for gid in assignments)
+    groups = latent.groups()
+    assert set(assignments) <= set(groups)
+    counts = np.bincount(assignments, minlength=max(groups) + 1)
+    for gid in groups:
+        assert latent.groupsize(gid) == counts[gid]
+    assert sum(latent.groupsize(gid) for gid in groups) == n
+
+
+def _assignments(latent):
+    return list(latent.assignments())
+
+
+def _nempty(latent):
+    return len([gid for gid in latent.groups() if not latent.groupsize(gid)])
+
+
+def _run(kernel, seed):
+    latent, s, _ = _state(0)
+    ret = kernel(s, rng(seed))
+    _assert_consistent(latent)
+    return latent, ret
+
+
+def test_assign_pooled():
+    def kernel(s, r):
+        gibbs.assign(s, r, niters=5, pooled='collapsed')
+    latent, _ = _run(kernel, 1)
+    # the pool of empty groups does not grow
+    assert _nempty(latent) <= 1
+    # reproducible for a fixed seed
+    assert _assignments(_run(kernel, 1)[0]) == _assignments(latent)
+
+
+def test_assign_resample_pooled():
+    for m in (1, 3):
+        def kernel(s, r):
+            gibbs.assign_resample(s, m, r, niters=5, pooled='collapsed')
+        latent, _ = _run(kernel, 1)
+        assert _nempty(latent) <= m
+        # reproducible for a fixed seed
+        assert _assignments(_run(kernel, 1)[0]) == _assignments(latent)
+
+
+def test_assign_pooled_invalid():
+    latent, s, _ = _state(0)
+    before = _assignments(latent)
+    # the pooling has to be declared
+    assert_raises(ValueError, gibbs.assign, s, rng(1), pooled=True)
+    assert_raises(
+        ValueError, gibbs.assign_resample, s, 2, rng(1), pooled='yes')
+    # the mixture state cannot redraw its groups
+    assert_raises(RuntimeError, gibbs.assign, s, rng(1), pooled='redraw')
+    assert _assignments(latent) == before
+
+
+def test_assign_parallel():
+    for nthreads, sync in ((1, 4), (2, 0), (2, 4), (4, 100)):
+        def kernel(s, r):
+            gibbs.assign_parallel(s, r, nthreads, m=2, sync=sync, niters=5)
+        latent, _ = _run(kernel, 1)
+        assert _assignments(_run(kernel, 1)[0]) == _assignments(latent)
+
+
+def _ngroups_freqs(kernel, nsamples, n=6):
+    latent, s, _ = _state(0, n=n, d=2)
+    r = rng(2)
+    counts = np.zeros(n + 1)
+    for _ in xrange(nsamples):
+        kernel(s, r)
+        counts[len(latent.groups()) - _nempty(latent)] += 1
+    return counts / nsamples
+
+
+def test_assign_parallel_single_thread():
+    # with a single thread, the sweeps are exact: the number of clusters
+    # follows the same distribution as under assign
+    def assign(s, r):
+        gibbs.assign(s, r)
+
+    def assign_parallel(s, r):
+        gibbs.assign_parallel(s, r, 1, m=2)
+    expected = _ngroups_freqs(assign, 5000)
+    actual = _ngroups_freqs(assign_parallel, 5000)
+    assert np.abs(expected - actual).max() <= 0.05
+
+
+def test_split_merge():
+    def kernel(s, r):
+        return gibbs.split_merge(s, r, nmoves=20, nscans=3)
+    latent, acceptance = _run(kernel, 1)
+    assert acceptance['splits'] + acceptance['merges'] == 20
+    assert acceptance['splits_accepted'] <= acceptance['splits']
+    assert acceptance['merges_accepted'] <= acceptance['merges']
+    latent2, acceptance2 = _run(kernel, 1)
+    assert _assignments(latent2) == _assignments(latent)
+    assert acceptance2 == acceptance
+
+
+def _subset_kernels():
+    yield gibbs.assign_subset
+    yield lambda s, entities, r, **kwargs: gibbs.assign_resample_subset(
+        s, 2, entities, r, **kwargs)
+
+
+def test_assign_subset():
+    for kernel in _subset_kernels():
+        latent, s, view = _state(0)
+        r = rng(1)
+        # 5 and 6 are unassigned and not listed, 7 is unassigned and listed
+        for eid in (5, 6, 7):
+            latent.remove_value(eid, view, r)
+        before = _assignments(latent)
+        kernel(s, [0, 1, 2, 7], r, niters=3)
+        after = _assignments(latent)
+        assert after[7] != -1
+        # only the listed entities are visited
+        unlisted = [eid for eid in xrange(60) if eid not in (0, 1, 2, 7)]
+        assert [after[eid] for eid in unlisted] == \
+            [before[eid] for eid in unlisted]
+
+        # the fraction is only drawn from the entities already assigned
+        kernel(s, [0], r, fraction=1., niters=3)
+        after = _assignments(latent)
+        assert after[5] == after[6] == -1
+        assert all(gid != -1 for eid, gid in enumerate(after)
+                   if eid not in (5, 6))
+
+
+def test_assign_subset_invalid():
+    for kernel in _subset_kernels():
+        _, s, _ = _state(0)
+        r = rng(1)
+        assert_raises(ValueError, kernel, s, [60], r)
+        assert_raises(ValueError, kernel, s, [[0, 1]], r)
+        assert_raises(ValueError, kernel, s, [0], r, fraction=1.5)
+        assert_raises(ValueError, kernel, s, [0], r, fraction=-0.1)
+
+
+def _hp_grid(s, d=5):
+    hgrid = [{'alpha': alpha, 'beta': beta}
+             for alpha in (0.5, 1., 2.) for beta in (0.5, 1., 2.)]
+    return gibbs.grid(
+        s, {fid: {'hpdf': lambda hp: 0., 'hgrid': hgrid}
+            for fid in xrange(d)})
+
+
+def test_hp_memo():
+    latent, s, _ = _state(0)
+    g = _hp_grid(s)
+    memo = gibbs.hp_memo()
+    r = rng(1)
+
+    def hp(s):
+        hits, misses = memo.hits, memo.misses
+        gibbs.hp(s, g, r, memo=memo)
+        return memo.hits - hits, memo.misses - misses
+
+    assert hp(s) == (0, 45)
+    # nothing changed: every score is reused
+    assert hp(s) == (45, 0)
+    assert memo.stats()['size'] == 45
+
+    # another state, with the same assignment but other data, misses
+    _, s2, _ = _state(1, assignment=_assignments(latent))
+    assert hp(s2) == (0, 45)
+    assert hp(s) == (0, 45)
+
+    memo.invalidate(0)
+    assert hp(s) == (36, 9)
+    memo.invalidate()
+    assert memo.stats()['size'] == 0
+    assert hp(s) == (0, 45)
+
+    # a new assignment
+    gibbs.assign(s, r)
+    assert hp(s) == (0, 45)
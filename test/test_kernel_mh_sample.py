@@ -1,9 +1,30 @@
 from scipy.stats import norm
-from microscopes.kernels.mh import sample
+from microscopes.kernels.mh import (
+    sample,
+    sample_chains,
+    sample_1d,
+    hp,
+    hp_plan,
+    theta,
+    theta_plan,
+)
+from microscopes.common.scalar_functions import log_exponential, log_normal
+from microscopes.common.rng import rng
 from microscopes.common.util import KL_approx
 
+from nose.plugins.skip import SkipTest
+
 import numpy as np
 
+try:
+    from microscopes.mixture.definition import model_definition
+    from microscopes.mixture.model import initialize, bind
+    from microscopes.common.recarray.dataview import numpy_dataview
+    from microscopes.models import bb, bbnc
+    _has_mixture = True
+except ImportError:
+    _has_mixture = False
+
 
 def hist(data, bins):
     H, _ = np.histogram(data, bins=bins, density=False)
@@ -35,3 +56,119 @@ def test_gauss():
     slice_hist /= slice_hist.sum()
 
     assert KL_approx(actual_hist, slice_hist, bins[1] - bins[0]) <= 0.1
+
+
+def test_gauss_cxx():
+    import time
+    prng = rng(int(time.time()))
+    pdf = log_normal(0., 1.)
+
+    x, acceptance = sample_1d(pdf, 1.0, 1.0, prng, nsteps=100)
+    assert 0. < acceptance < 1.
+
+    bins = np.linspace(-3, 3, 1000)
+    smoothing = 1e-5
+
+    actual_samples = np.random.normal(size=1000)
+    actual_hist = hist(actual_samples, bins) + smoothing
+    actual_hist /= actual_hist.sum()
+
+    samples = []
+    for _ in xrange(1000):
+        x, _ = sample_1d(pdf, x, 1.0, prng, nsteps=10)
+        samples.append(x)
+    mh_hist = hist(np.array(samples), bins) + smoothing
+    mh_hist /= mh_hist.sum()
+
+    assert KL_approx(actual_hist, mh_hist, bins[1] - bins[0]) <= 0.1
+
+
+def test_gauss_chains():
+    # 1000 independent chains targeting N(0,1), advanced together
+
+    pdf = lambda x: norm.logpdf(x)
+    condpdf = lambda a, b: norm.logpdf(b, loc=a)
+    condsamp = lambda a: np.random.normal(loc=a)
+
+    x, acceptance = sample_chains(
+        np.ones(1000), pdf, condpdf, condsamp, nsteps=100)
+    assert x.shape == (1000,)
+    assert acceptance.shape == (1000,)
+    assert ((acceptance >= 0.) & (acceptance <= 1.)).all()
+    assert 0.5 <= acceptance.mean() <= 0.9
+
+    bins = np.linspace(-3, 3, 1000)
+    smoothing = 1e-5
+
+    actual_samples = np.random.normal(size=1000)
+    actual_hist = hist(actual_samples, bins) + smoothing
+    actual_hist /= actual_hist.sum()
+
+    mh_hist = hist(x, bins) + smoothing
+    mh_hist /= mh_hist.sum()
+
+    assert KL_approx(actual_hist, mh_hist, bins[1] - bins[0]) <= 0.1
+
+
+def _state(model, nclusters=20, m=50):
+    """A mixture of a single bernoulli feature, with `nclusters` clusters of
+    `m` entities and a fixed assignment
+
+    """
+    if not _has_mixture:
+        raise SkipTest("requires microscopes.mixture")
+    prng = np.random.RandomState(0)
+    probs = np.repeat(prng.beta(4., 6., size=nclusters), m)
+    data = prng.uniform(size=nclusters * m) < probs
+    view = numpy_dataview(np.array([(x,) for x in data], dtype=[('', bool)]))
+    defn = model_definition(nclusters * m, [model])
+    latent = initialize(defn, view, r=rng(0),
+                        assignment=np.repeat(np.arange(nclusters), m))
+    return bind(latent, view)
+
+
+def _check_adapted(kernel, plan, sigma0, nadapt):
+    """Runs kernel (sweeps) past the adaptation, and checks that sigma moved
+    away from sigma0 toward the target acceptance rate, and was then frozen
+
+    """
+    while plan.stats()[0]['nproposals'] < nadapt:
+        kernel(1)
+    stats, = plan.stats()
+    sigma = stats['sigma']
+    assert sigma != sigma0
+
+    while plan.stats()[0]['nproposals'] < stats['nproposals'] + 2000:
+        kernel(1)
+    after, = plan.stats()
+    assert after['sigma'] == sigma
+    acceptance = (float(after['naccepted'] - stats['naccepted']) /
+                  (after['nproposals'] - stats['nproposals']))
+    print sigma0, '->', sigma, 'acceptance:', acceptance
+    assert abs(acceptance - 0.44) <= 0.15
+    return sigma
+
+
+def test_mh_hp_adapt():
+    s = _state(bb)
+    r = rng(0)
+    # from a scale far too small and far too large
+    sigmas = []
+    for sigma0 in (1e-3, 100.):
+        plan = hp_plan(cparam={'alpha': (log_exponential(1.), sigma0)},
+                       nadapt=1000)
+        sigmas.append(_check_adapted(
+            lambda niters: hp(s, r, plan=plan, niters=niters),
+            plan, sigma0, 1000))
+    assert sigmas[0] > 1e-3 and sigmas[1] < 100.
+
+
+def test_mh_theta_adapt():
+    s = _state(bbnc)
+    r = rng(0)
+    plan = theta_plan({0: {'p': 1.}}, nadapt=1000)
+    sigma = _check_adapted(
+        lambda niters: theta(s, r, plan=plan, niters=niters),
+        plan, 1., 1000)
+    # the groups have 50 entities each, so p is known to within ~0.07
+    assert sigma < 0.5
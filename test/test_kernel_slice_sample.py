@@ -1,10 +1,31 @@
-from microscopes.kernels.slice import sample as cxx_slice_sample
-from microscopes.common.scalar_functions import log_normal
+from microscopes.kernels.slice import (
+    sample as cxx_slice_sample,
+    hp,
+    hp_plan,
+    theta,
+    theta_plan,
+)
+from microscopes.common.scalar_functions import (
+    log_exponential,
+    log_normal,
+    log_noninformative_beta_prior,
+)
 from microscopes.common.rng import rng
 from microscopes.common.util import KL_approx
 
+from nose.plugins.skip import SkipTest
+
 import numpy as np
 
+try:
+    from microscopes.mixture.definition import model_definition
+    from microscopes.mixture.model import initialize, bind
+    from microscopes.common.recarray.dataview import numpy_dataview
+    from microscopes.models import bb, bbnc
+    _has_mixture = True
+except ImportError:
+    _has_mixture = False
+
 
 def hist(data, bins):
     H, _ = np.histogram(data, bins=bins, density=False)
@@ -47,3 +68,143 @@ def _test_gauss(slice_sample_fn, prng):
 def test_gauss_cxx():
     import time
     _test_gauss(cxx_slice_sample, rng(int(time.time())))
+
+
+def test_gauss_cxx_doubling():
+    import time
+
+    def sample_doubling(func, x0, w, r):
+        return cxx_slice_sample(func, x0, w, r, interval='doubling')
+
+    _test_gauss(sample_doubling, rng(int(time.time())))
+
+
+def _bb_posterior(counts, m, alphas, betas):
+    """The posterior of the (alpha, beta) of a beta-bernoulli feature under
+    the noninformative prior, on a grid, given the number of successes in
+    each cluster of m entities
+
+    """
+    alphas, betas = np.meshgrid(alphas, betas)
+    # lgamma(x + k) - lgamma(x) is the sum of log(x + j) for j < k
+    j = np.arange(m)[:, np.newaxis, np.newaxis]
+    zero = np.zeros((1,) + alphas.shape)
+    la = np.vstack([zero, np.cumsum(np.log(alphas + j), axis=0)])
+    lb = np.vstack([zero, np.cumsum(np.log(betas + j), axis=0)])
+    ls = np.log(alphas + betas + j).sum(axis=0)
+    lp = -2.5 * np.log(alphas + betas)
+    for k in counts:
+        lp += la[k] + lb[m - k] - ls
+    p = np.exp(lp - lp.max())
+    return alphas, betas, p / p.sum()
+
+
+def _state(nclusters=20, m=50, model=None):
+    """A mixture of a single bernoulli feature, with `nclusters` clusters of
+    `m` entities and a fixed assignment. Returns the latent, the state bound
+    to the data, and the number of successes in each cluster
+
+    """
+    if not _has_mixture:
+        raise SkipTest("requires microscopes.mixture")
+    prng = np.random.RandomState(0)
+    probs = np.repeat(prng.beta(4., 6., size=nclusters), m)
+    data = prng.uniform(size=nclusters * m) < probs
+    counts = data.reshape((nclusters, m)).sum(axis=1)
+    view = numpy_dataview(np.array([(x,) for x in data], dtype=[('', bool)]))
+    defn = model_definition(nclusters * m, [model or bb])
+    latent = initialize(defn, view, r=rng(0),
+                        assignment=np.repeat(np.arange(nclusters), m))
+    return latent, bind(latent, view), counts
+
+
+def test_hp_adapt():
+    latent, s, _ = _state()
+    plan = hp_plan(cparam={'alpha': (log_exponential(1.), 1e-3)}, nadapt=5)
+    r = rng(0)
+    hp(s, r, plan=plan, niters=5)
+    stats, = plan.stats()
+    assert stats['ndraws'] == stats['nadapted'] == 5
+    # a step width far too small is adapted to the slice
+    w = stats['w']
+    assert w > 1e-2
+
+    # and then frozen
+    hp(s, r, plan=plan, niters=10)
+    stats, = plan.stats()
+    assert stats['ndraws'] == 15 and stats['nadapted'] == 5
+    assert stats['w'] == w
+
+    # every draw evaluates the score at least twice (the slice level and
+    # the accepted point)
+    assert stats['nevals'] >= 2 * stats['ndraws']
+    assert stats['nevals_per_draw'] == \
+        float(stats['nevals']) / stats['ndraws']
+
+
+def test_hp_doubling():
+    # with a step width far too small, doubling finds the slice in far
+    # fewer evaluations than stepping out
+    nevals_per_draw = {}
+    for interval in ('stepping_out', 'doubling'):
+        latent, s, _ = _state()
+        plan = hp_plan(cparam={'alpha': (log_exponential(1.), 1e-3)},
+                       interval=interval)
+        hp(s, rng(0), plan=plan, niters=20)
+        stats, = plan.stats()
+        assert stats['ndraws'] == 20 and stats['nadapted'] == 0
+        assert stats['w'] == np.float32(1e-3)
+        nevals_per_draw[interval] = stats['nevals_per_draw']
+    assert nevals_per_draw['doubling'] * 10 < \
+        nevals_per_draw['stepping_out']
+
+
+def test_hp_joint():
+    latent, s, counts = _state()
+
+    plan = hp_plan(
+        hparams={0: {('alpha', 'beta'): (log_noninformative_beta_prior, 4.)}},
+        nadapt=100, joint=True)
+    r = rng(1)
+    draws = []
+    for _ in xrange(3000):
+        hp(s, r, plan=plan)
+        hps = latent.get_feature_hp(0)
+        draws.append((hps['alpha'], hps['beta']))
+    draws = np.array(draws[500:])
+
+    # the width of a joint parameter is not adapted
+    assert plan.stats()[0]['w'] == 4.
+
+    alphas, betas, p = _bb_posterior(
+        counts, 50, np.linspace(0.05, 40, 200), np.linspace(0.05, 60, 200))
+    mean = (p * alphas / (alphas + betas)).sum()
+    logscale = (p * np.log(alphas + betas)).sum()
+    actual_mean = (draws[:, 0] / draws.sum(axis=1)).mean()
+    actual_logscale = np.log(draws.sum(axis=1)).mean()
+    print 'mean:', mean, actual_mean
+    print 'log scale:', logscale, actual_logscale
+    assert abs(actual_mean - mean) <= 0.01
+    assert abs(actual_logscale - logscale) <= 0.25
+
+
+def test_theta_threads():
+    def run(nthreads):
+        latent, s, _ = _state(nclusters=40, m=10, model=bbnc)
+        plan = theta_plan({0: {'p': 0.1}}, nadapt=10)
+        theta(s, rng(0), plan=plan, nthreads=nthreads)
+        return latent, plan
+
+    for nthreads in (1, 4):
+        latent, plan = run(nthreads)
+        stats, = plan.stats()
+        # one draw per group, and the adaptation budget is shared by the
+        # threads
+        assert stats['ndraws'] == 40
+        assert stats['nadapted'] == 10
+
+        # reproducible for a fixed seed and nthreads
+        latent2, plan2 = run(nthreads)
+        assert plan2.stats() == plan.stats()
+        assert latent2.score_data(None, None, rng(0)) == \
+            latent.score_data(None, None, rng(0))
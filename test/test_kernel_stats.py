@@ -0,0 +1,95 @@
+from microscopes.kernels.stats import kernel_stats
+from microscopes.kernels import gibbs
+from microscopes.kernels.slice import hp as slice_hp, theta as slice_theta
+from microscopes.common.rng import rng
+from microscopes.common.scalar_functions import log_exponential
+
+from nose.plugins.skip import SkipTest
+
+import numpy as np
+
+try:
+    from microscopes.mixture.definition import model_definition
+    from microscopes.mixture.model import initialize, bind
+    from microscopes.common.recarray.dataview import numpy_dataview
+    from microscopes.models import bb, bbnc
+    _has_mixture = True
+except ImportError:
+    _has_mixture = False
+
+
+def _state(model, n=60, d=3):
+    if not _has_mixture:
+        raise SkipTest("requires microscopes.mixture")
+    prng = np.random.RandomState(0)
+    data = np.array(
+        [tuple(row) for row in prng.uniform(size=(n, d)) < 0.5],
+        dtype=[('', bool)] * d)
+    view = numpy_dataview(data)
+    latent = initialize(model_definition(n, [model] * d), view, r=rng(0))
+    return bind(latent, view)
+
+
+def test_kernel_stats_empty():
+    stats = kernel_stats()
+    fields = kernel_stats.fields()
+    values = stats.as_array()
+    assert len(fields) == len(values)
+    assert (values == 0).all()
+    d = stats.as_dict()
+    assert set(d.keys()) == set(fields)
+    assert d['remove_value_calls'] == 0
+    assert d['sample_discrete_log_seconds'] == 0.
+    assert d['max_iters'] == 0
+
+
+def test_kernel_stats_assign():
+    s = _state(bb)
+    stats = kernel_stats()
+    gibbs.assign(s, rng(0), niters=2, stats=stats)
+    d = stats.as_dict()
+    # one visit per entity and sweep
+    for phase in ('remove_value', 'inplace_score_value',
+                  'sample_discrete_log', 'add_value'):
+        assert d[phase + '_calls'] == 120
+        assert d[phase + '_seconds'] > 0.
+    # every visit scores at least the empty group
+    assert d['score_evals'] >= 120
+
+    # the counters accumulate, and merge
+    gibbs.assign_resample(s, 2, rng(0), stats=stats)
+    assert stats.as_dict()['remove_value_calls'] == 180
+    other = kernel_stats()
+    other.merge(stats)
+    other.merge(stats)
+    assert other.as_dict()['remove_value_calls'] == 360
+    stats.reset()
+    assert (stats.as_array() == 0).all()
+
+
+def test_kernel_stats_hp():
+    s = _state(bb)
+    stats = kernel_stats()
+    hgrid = [{'alpha': alpha, 'beta': 1.} for alpha in (0.5, 1., 2., 4.)]
+    gibbs.hp(s, {fid: {'hpdf': lambda hp: 0., 'hgrid': hgrid}
+                 for fid in xrange(3)}, rng(0), niters=2, stats=stats)
+    d = stats.as_dict()
+    assert d['score_likelihood_calls'] == d['score_evals'] == 24
+    assert d['sample_discrete_log_calls'] == 6
+
+    # a step width far too small steps out
+    stats.reset()
+    slice_hp(s, rng(0), cparam={'alpha': (log_exponential(1.), 1e-3)},
+             stats=stats)
+    d = stats.as_dict()
+    assert d['stepping_out'] > 0
+    assert d['score_evals'] > d['stepping_out']
+
+
+def test_kernel_stats_theta():
+    s = _state(bbnc)
+    stats = kernel_stats()
+    slice_theta(s, rng(0), tparams={0: {'p': 0.1}}, stats=stats)
+    d = stats.as_dict()
+    assert d['score_evals'] > 0
+    assert d['shrinks'] + d['stepping_out'] > 0
@@ -0,0 +1,437 @@
+from microscopes.kernels import parallel
+from microscopes.common.rng import rng
+
+from nose.tools import assert_raises
+
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+class counting_runner(object):
+    """A stand-in for a model runner: counts the iterations it was run for
+
+    """
+
+    def __init__(self):
+        self.niters = 0
+        self.expensive_state = None
+
+    def run(self, r, niters):
+        self.niters += niters
+
+    def get_latent(self):
+        return self.niters
+
+
+def test_multiprocessing():
+    runners = [counting_runner() for _ in xrange(5)]
+    prunner = parallel.runner(runners, processes=2)
+    prunner.run(r=rng(0), niters=10)
+    prunner.run(r=rng(1), niters=5)
+    assert prunner.get_latents() == [15] * 5
+
+
+def test_multiprocessing_persistent():
+    runners = [counting_runner() for _ in xrange(5)]
+    prunner = parallel.runner(runners, processes=2, persistent=True)
+    try:
+        prunner.run(r=rng(0), niters=10)
+        prunner.run(r=rng(1), niters=5)
+        assert prunner.get_latents() == [15] * 5
+        # the local copies are stale until explicitly fetched
+        assert [runner.niters for runner in runners] == [0] * 5
+        fetched = prunner.get_runners()
+        assert [runner.niters for runner in fetched] == [15] * 5
+        prunner.run(r=rng(2), niters=5)
+        # closing fetches the runners, and a later run() carries on
+        prunner.close()
+        assert [runner.niters for runner in prunner.get_runners()] == \
+            [20] * 5
+        prunner.run(r=rng(3), niters=5)
+        assert prunner.get_latents() == [25] * 5
+    finally:
+        prunner.close()
+
+
+class stateful_runner(counting_runner):
+    """Records the size of the expensive state it was run against
+
+    """
+
+    def __init__(self, state):
+        super(stateful_runner, self).__init__()
+        self.expensive_state = state
+        self.seen = None
+
+    def expensive_state_digest(self, h):
+        h.update(str(self.expensive_state))
+
+    def run(self, r, niters):
+        super(stateful_runner, self).run(r, niters)
+        self.seen = len(self.expensive_state)
+
+
+def test_multiprocessing_shared_state():
+    state = range(1000)
+    runners = [stateful_runner(state) for _ in xrange(4)]
+    runners.append(stateful_runner(range(10)))
+    for persistent in (False, True):
+        prunner = parallel.runner(
+            runners, processes=2, persistent=persistent)
+        try:
+            prunner.run(r=rng(0), niters=10)
+            fetched = prunner.get_runners()
+        finally:
+            prunner.close()
+        assert [runner.seen for runner in fetched] == [1000] * 4 + [10]
+        assert all(runner.expensive_state is state for runner in fetched[:4])
+
+
+def test_multiprocessing_state_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        runners = [stateful_runner(range(1000)) for _ in xrange(2)]
+        runners.append(stateful_runner(range(10)))
+        for persistent in (False, True):
+            prunner = parallel.runner(
+                runners, processes=2, persistent=persistent,
+                cache_dir=cache_dir)
+            try:
+                prunner.run(r=rng(0), niters=10)
+                fetched = prunner.get_runners()
+            finally:
+                prunner.close()
+            assert [runner.seen for runner in fetched] == [1000] * 2 + [10]
+            # the states are only read back from the cache without fork
+            kind = prunner._mp_statearg(prunner._digests[0])[0]
+            assert kind == ('shared' if parallel._has_fork else 'local')
+        names = [name for name in os.listdir(cache_dir)
+                 if name.startswith('state-')]
+        assert len(names) == 2
+
+        # a size cap only keeps the states in use by the newest runner
+        parallel.runner(
+            [stateful_runner(range(5))], cache_dir=cache_dir, cache_size=1)
+        names = [name for name in os.listdir(cache_dir)
+                 if name.startswith('state-')]
+        assert len(names) == 1
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_multiprocessing_dynamic():
+    runners = [counting_runner() for _ in xrange(5)]
+    for slices in (1, 3, 100):
+        prunner = parallel.runner(
+            runners, processes=2, schedule='dynamic', slices=slices)
+        prunner.run(r=rng(0), niters=10)
+        prunner.run(r=rng(1), niters=5)
+        assert prunner.get_latents() == [15] * 5
+
+
+class unpicklable_runner(counting_runner):
+
+    def __init__(self):
+        super(unpicklable_runner, self).__init__()
+        self.fn = lambda: None
+
+
+def test_multiprocessing_dynamic_unpicklable():
+    # fails instead of waiting on a slice which was never dispatched
+    runners = [counting_runner(), unpicklable_runner()]
+    prunner = parallel.runner(runners, processes=2, schedule='dynamic')
+    assert_raises(Exception, prunner.run, r=rng(0), niters=10)
+
+
+def test_lpt_placement():
+    # equal costs are placed round-robin
+    assert parallel._lpt_placement([1] * 5, 2) == [0, 1, 0, 1, 0]
+    # the two large chains go to different workers, and the small ones
+    # fill in behind them
+    assert parallel._lpt_placement([1, 10, 1, 9, 1], 2) == [1, 0, 0, 1, 1]
+
+
+def _niters(runner):
+    return runner.niters
+
+
+def test_multiprocessing_iter_run():
+    runners = [counting_runner() for _ in xrange(3)]
+    for persistent in (False, True):
+        prunner = parallel.runner(runners, processes=2, persistent=persistent)
+        try:
+            progress = list(prunner.iter_run(
+                r=rng(0), niters=10, every=4, snapshot=_niters))
+            assert prunner.get_latents() == [10] * 3
+            # a latent without assignments has no default snapshot
+            assert_raises(
+                RuntimeError, list, prunner.iter_run(r=rng(0), niters=10))
+        finally:
+            prunner.close()
+        for idx in xrange(3):
+            assert [(it, snap) for chain, it, snap in progress
+                    if chain == idx] == [(4, 4), (8, 8), (10, 10)]
+
+
+class normal_runner(counting_runner):
+    """Draws an independent N(0,1) on every call to run(), which takes a
+    millisecond (so that the chains do not outrun the parent)
+
+    """
+
+    def __init__(self, seed):
+        super(normal_runner, self).__init__()
+        self.prng = np.random.RandomState(seed)
+        self.x = 0.
+
+    def run(self, r, niters):
+        super(normal_runner, self).run(r, niters)
+        self.x = self.prng.normal()
+        time.sleep(0.001)
+
+
+def _summaries(runner):
+    return runner.x
+
+
+def test_multiprocessing_run_until_converged():
+    runners = [normal_runner(seed) for seed in xrange(4)]
+    # without resident workers, every chain needs a process of its own,
+    # otherwise the chains are not run side by side
+    for persistent, processes in ((False, 4), (True, 2)):
+        prunner = parallel.runner(
+            runners, processes=processes, persistent=persistent)
+        try:
+            diag = prunner.run_until_converged(
+                r=rng(0), summaries=_summaries, max_iters=100000, every=10,
+                rhat=1.1, min_ess=100)
+            latents = prunner.get_latents()
+        finally:
+            prunner.close()
+        assert diag['converged']
+        # the chains stop early, where they said they did
+        assert latents == diag['niters']
+        assert max(diag['niters']) < 100000
+        assert max(diag['rhat']) <= 1.1 and min(diag['ess']) >= 100
+
+
+def test_multiprocessing_iter_run_close():
+    runners = [normal_runner(seed) for seed in xrange(2)]
+    prunner = parallel.runner(runners, processes=2, persistent=True)
+    try:
+        it = prunner.iter_run(
+            r=rng(0), niters=100000, every=1, snapshot=_summaries)
+        next(it)
+        # the resident chains are stopped, not run to completion
+        it.close()
+        assert max(prunner.get_latents()) < 100000
+    finally:
+        prunner.close()
+
+
+class tempered_runner(counting_runner):
+    """Has a fixed log-likelihood, and records its temperatures
+
+    """
+
+    def __init__(self, loglik):
+        super(tempered_runner, self).__init__()
+        self.loglik = loglik
+        self.betas = []
+
+    def set_temperature(self, beta):
+        self.betas.append(beta)
+
+    def score_likelihood(self):
+        return self.loglik
+
+
+def test_multiprocessing_tempered():
+    runners = [tempered_runner(loglik) for loglik in (1000., 0., 0.)]
+    prunner = parallel.runner(
+        runners, processes=2, persistent=True,
+        temperatures=[1., 0.5, 0.25], swap_every=10)
+    try:
+        prunner.run(r=rng(0), niters=20)
+        fetched = prunner.get_runners()
+    finally:
+        prunner.close()
+    assert [runner.niters for runner in fetched] == [20] * 3
+    # the cold replica is far more likely, so the first (even) swap is
+    # rejected; the second (odd) one between equally likely replicas is not
+    assert [runner.betas for runner in fetched] == \
+        [[1., 1.], [0.5, 0.5], [0.25, 0.25]]
+    assert prunner.temperatures() == [1., 0.25, 0.5]
+    stats = prunner.swap_stats()
+    assert [s['betas'] for s in stats] == [(1., 0.5), (0.5, 0.25)]
+    assert [(s['attempts'], s['accepted']) for s in stats] == [(1, 0), (1, 1)]
+
+
+def test_multiprocessing_tempered_unsupported():
+    # the runners have to provide the tempering
+    assert_raises(
+        ValueError, parallel.runner, [counting_runner() for _ in xrange(2)],
+        processes=2, persistent=True, temperatures=[1., 0.5])
+    prunner = parallel.runner(
+        [tempered_runner(0.) for _ in xrange(2)],
+        processes=2, persistent=True, temperatures=[1., 0.5])
+    try:
+        assert_raises(
+            ValueError, list, prunner.iter_run(r=rng(0), niters=10))
+        assert_raises(
+            ValueError, prunner.run_until_converged, r=rng(0),
+            summaries=_summaries)
+    finally:
+        prunner.close()
+
+
+def test_tempered_requires_persistent():
+    runners = [tempered_runner(0.) for _ in xrange(2)]
+    assert_raises(ValueError, parallel.runner, runners,
+                  temperatures=[1., 0.5])
+
+
+class seeded_runner(stateful_runner):
+    """Records a number drawn from the rng of every call to run(), and
+    fails while the file `failfile` exists
+
+    """
+
+    def __init__(self, state, failfile):
+        super(seeded_runner, self).__init__(state)
+        self.failfile = failfile
+        self.draws = []
+
+    def run(self, r, niters):
+        if len(self.draws) == 2 and os.path.exists(self.failfile):
+            raise RuntimeError("interrupted")
+        super(seeded_runner, self).run(r, niters)
+        self.draws.append(r.next())
+
+
+def test_multiprocessing_checkpoint_resume():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        failfile = os.path.join(tmpdir, 'fail')
+
+        def make_runner(subdir):
+            runners = [seeded_runner(range(1000), failfile) for _ in xrange(2)]
+            runners.append(seeded_runner(range(10), failfile))
+            return parallel.runner(
+                runners, processes=2, persistent=True,
+                checkpoint_dir=os.path.join(tmpdir, subdir),
+                checkpoint_every=10)
+
+        prunner = make_runner('full')
+        try:
+            prunner.run(r=rng(0), niters=45)
+            expected = [runner.draws for runner in prunner.get_runners()]
+        finally:
+            prunner.close()
+        names = os.listdir(os.path.join(tmpdir, 'full'))
+        assert len([n for n in names if n.startswith('chain-')]) == 3
+        assert len([n for n in names if n.startswith('state-')]) == 2
+
+        # interrupted during the third round, after two checkpoints
+        open(failfile, 'w').close()
+        prunner = make_runner('interrupted')
+        try:
+            assert_raises(Exception, prunner.run, r=rng(0), niters=45)
+        finally:
+            prunner.close()
+        os.unlink(failfile)
+
+        prunner = make_runner('interrupted')
+        try:
+            prunner.resume(os.path.join(tmpdir, 'interrupted'))
+            resumed = prunner.get_runners()
+        finally:
+            prunner.close()
+        assert [runner.niters for runner in resumed] == [45] * 3
+        assert [runner.draws for runner in resumed] == expected
+        assert [runner.seen for runner in resumed] == [1000] * 2 + [10]
+        shutil.rmtree(os.path.join(tmpdir, 'full'))
+        shutil.rmtree(os.path.join(tmpdir, 'interrupted'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_multiprocessing_checkpoint_lock():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        runners = [seeded_runner(range(10), os.path.join(tmpdir, 'fail'))
+                   for _ in xrange(2)]
+        nthreads = threading.active_count()
+        prunner = parallel.runner(
+            runners, processes=2, persistent=True, checkpoint_dir=tmpdir,
+            checkpoint_every=10)
+        try:
+            # another run checkpointing to the same directory
+            with parallel._checkpoint_writer(tmpdir).locked():
+                assert_raises(RuntimeError, prunner.run, r=rng(0), niters=20)
+            prunner.run(r=rng(0), niters=20)
+        finally:
+            prunner.close()
+        # the writer thread is stopped at the end of the run
+        assert threading.active_count() == nthreads
+        # the workers pickle the runners of the checkpoints
+        assert_raises(ValueError, parallel.runner, runners, processes=2,
+                      checkpoint_dir=tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_multiprocessing_checkpoint_tempered():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        def make_runner(**kwargs):
+            runners = [tempered_runner(0.) for _ in xrange(3)]
+            return parallel.runner(
+                runners, processes=2, persistent=True,
+                temperatures=[1., 0.5, 0.25], checkpoint_dir=tmpdir,
+                checkpoint_every=10, **kwargs)
+
+        prunner = make_runner(swap_every=5)
+        try:
+            prunner.run(r=rng(0), niters=20)
+        finally:
+            prunner.close()
+
+        # the swap schedule is restored along with the ladder, so the two
+        # rounds of this run swap the (0, 1) then the (1, 2) pair
+        prunner = make_runner()
+        try:
+            prunner.resume(tmpdir)
+            prunner.run(r=rng(1), niters=10)
+            stats = prunner.swap_stats()
+        finally:
+            prunner.close()
+        assert [s['attempts'] for s in stats] == [3, 3]
+
+        # checkpoints need resident workers
+        prunner = parallel.runner(
+            [tempered_runner(0.) for _ in xrange(3)], processes=2)
+        assert_raises(ValueError, prunner.resume, tmpdir)
+        prunner.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prunner = parallel.runner(
+            [tempered_runner(0.) for _ in xrange(3)], processes=2,
+            persistent=True, checkpoint_dir=tmpdir, checkpoint_every=10)
+        prunner.run(r=rng(0), niters=10)
+        prunner.close()
+        # and a tempered runner cannot resume an untempered checkpoint
+        prunner = parallel.runner(
+            [tempered_runner(0.) for _ in xrange(3)], processes=2,
+            persistent=True, temperatures=[1., 0.5, 0.25])
+        assert_raises(ValueError, prunner.resume, tmpdir)
+        prunner.close()
+    finally:
+        shutil.rmtree(tmpdir)